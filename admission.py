@@ -0,0 +1,199 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+
+from cachetools import TTLCache
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is refused instead of admitted"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Too many requests ({reason}), retry in {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, with bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def take(self, now):
+        """Take one token; returns 0 on success, else seconds until a token is available"""
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+
+class Permit:
+    """A held admission slot; release it once the response has been sent"""
+
+    def __init__(self, controller, waited):
+        self.controller = controller
+        self.waited = waited
+        self.acquired = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(time.monotonic() - self.acquired)
+
+
+class _Waiter:
+    def __init__(self, notify):
+        self.notify = notify
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class AdmissionController:
+    """Admit LLM requests under a global concurrency limit and per-client rate limits
+
+    Each client IP and session gets a token bucket (a rate of 0 disables
+    that limit). Once max_concurrent requests hold permits, further requests
+    wait in FIFO order, at most max_queued of them and for at most max_wait
+    seconds; anything beyond that is rejected straight away so clients can
+    back off rather than pile onto a saturated upstream quota.
+    """
+
+    def __init__(self, max_concurrent=16, max_queued=64, max_wait=10.0,
+                 ip_rate=2.0, ip_burst=20, session_rate=0.5, session_burst=5, max_clients=10000):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.limits = {'ip': (ip_rate, ip_burst), 'session': (session_rate, session_burst)}
+        # An idle bucket is full again after burst / rate seconds, so it can be dropped then
+        ttl = max([burst / rate for rate, burst in self.limits.values() if rate > 0] or [1])
+        self._buckets = TTLCache(maxsize=max_clients, ttl=ttl)
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self.active = 0
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = {}
+        # Smoothed permit hold time, used to estimate Retry-After for queue rejections
+        self._hold_seconds = 1.0
+
+    def acquire(self, client_ip=None, session_id=None):
+        """Return a Permit, waiting in the queue if needed; raises AdmissionRejected"""
+        event = threading.Event()
+        waiter = self._enqueue(client_ip, session_id, event.set)
+        if not waiter.granted:
+            event.wait(self.max_wait)
+        return self._settle(waiter)
+
+    async def aacquire(self, client_ip=None, session_id=None):
+        """Await a Permit on the event loop, without parking a thread while queued"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+
+        waiter = self._enqueue(client_ip, session_id, lambda: loop.call_soon_threadsafe(resolve))
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(future, self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        return self._settle(waiter)
+
+    def check_rate(self, client_ip=None, session_id=None):
+        """Charge the rate limits only, for work that is bounded elsewhere; raises AdmissionRejected"""
+        with self._lock:
+            for kind, key in (('ip', client_ip), ('session', session_id)):
+                self._take_token(kind, key, time.monotonic())
+
+    def _enqueue(self, client_ip, session_id, notify):
+        """Check the rate limits, then grant a permit at once or queue for one"""
+        waiter = _Waiter(notify)
+        with self._lock:
+            for kind, key in (('ip', client_ip), ('session', session_id)):
+                self._take_token(kind, key, waiter.enqueued)
+
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                waiter.granted = True
+                return waiter
+
+            if len(self._waiters) >= self.max_queued:
+                self._reject('queue_full', self._queue_retry_after())
+
+            self._waiters.append(waiter)
+            self.queued_total += 1
+        return waiter
+
+    def _settle(self, waiter):
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                self._reject('queue_timeout', self._queue_retry_after())
+            self.admitted += 1
+        return Permit(self, time.monotonic() - waiter.enqueued)
+
+    def _abandon(self, waiter):
+        """Withdraw a cancelled waiter, passing on a permit it was already granted"""
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        self._release()
+
+    def _take_token(self, kind, key, now):
+        rate, burst = self.limits[kind]
+        if not key or rate <= 0:
+            return
+        bucket = self._buckets.get((kind, key)) or TokenBucket(rate, burst)
+        # Re-insert on every use: TTLCache expiry counts from insertion, and an active
+        # client's bucket must not be swapped for a full one
+        self._buckets[(kind, key)] = bucket
+        wait = bucket.take(now)
+        if wait:
+            self._reject(f'{kind}_rate', wait)
+
+    def _reject(self, reason, retry_after):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        raise AdmissionRejected(reason, max(1, math.ceil(retry_after)))
+
+    def _queue_retry_after(self):
+        # Time for the queue ahead to drain through the concurrency limit
+        return min(self.max_wait, self._hold_seconds * (len(self._waiters) + 1) / self.max_concurrent)
+
+    def _release(self, held=None):
+        with self._lock:
+            if held is not None:
+                self._hold_seconds += 0.1 * (held - self._hold_seconds)
+            if self._waiters:
+                # Released slots are handed to the oldest waiter, so the queue is FIFO
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.notify()
+            else:
+                self.active -= 1
+
+    def stats(self):
+        """Return active and queued requests plus admission and rejection counts"""
+        with self._lock:
+            return {
+                'active': self.active,
+                'queued': len(self._waiters),
+                'max_concurrent': self.max_concurrent,
+                'admitted': self.admitted,
+                'queued_total': self.queued_total,
+                'rejected': dict(self.rejected),
+            }
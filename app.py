@@ -1,20 +1,38 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g, url_for
 import os
-import google.generativeai as genai
+import functools
+import hmac
 from dotenv import load_dotenv
+import json
+import math
 import uuid
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import llm_backends
+import model_registry
+import model_router
+import recommendation_cache
+import session_store
+import session_tokens
+import session_locks
+import singleflight
+import traffic_log
+import request_timing
+import metrics
+import token_usage
+import upstream_client
+import jobs
+import admission
+import scheduler
+import idempotency
 
 # Load environment variables
 load_dotenv()
 
-# Validate essential environment variable
-if not os.getenv("GEMINI_API_KEY"):
-    raise ValueError("GEMINI_API_KEY environment variable not set")
-
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Configure the LLM backend: real Gemini (needs GEMINI_API_KEY) or the offline stub
+model_registry.set_backend(llm_backends.create_backend())
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False  # Maintain response order
@@ -34,8 +52,391 @@ SAFETY_SETTINGS = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
 ]
 
-# Store conversation history (in-memory, consider Redis for production)
-conversation_history = {}
+# Model tiers and the rules routing each request to one (MODEL_TIERS, MODEL_ROUTING_RULES)
+router = model_router.ModelRouter.from_env()
+
+# The large model: the default for recommendations and the escalation target
+MODEL_NAME = router.tiers[router.escalation_tier]
+
+# Bump whenever construct_base_prompt changes so cached answers are not reused
+PROMPT_VERSION = 1
+
+# Generate the structure section first, then the other sections concurrently from it
+SECTIONED_RECOMMENDATIONS = os.getenv("SECTIONED_RECOMMENDATIONS", "0") == "1"
+
+# Recommendation sections in output order; the first conditions the others
+RECOMMENDATION_SECTIONS = [
+    ("## 🔹 RECOMMENDED STRUCTURE", [
+        "Layer-by-layer material structure",
+        "Thickness recommendations",
+        "Special treatments/additives",
+    ]),
+    ("## 🔸 MATERIALS DESCRIPTION", [
+        "Technical properties of each material",
+        "Compatibility between layers",
+        "Manufacturing considerations",
+    ]),
+    ("## 🔹 KEY PROPERTIES", [
+        "Barrier performance metrics",
+        "Thermal properties",
+        "Mechanical strengths",
+        "Sustainability features",
+    ]),
+    ("## 🔸 BENEFITS FOR APPLICATION", [
+        "Product-specific protection",
+        "Cost-effectiveness",
+        "Sustainability advantages",
+        "Market appeal factors",
+    ]),
+]
+
+# Threads generating the sections that follow the structure
+section_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SECTION_WORKERS", "16")), thread_name_prefix='section'
+) if SECTIONED_RECOMMENDATIONS else None
+
+# Model handles are created on first use (model_registry.get_model) in the worker that calls
+# them, so no gRPC client is opened at import time and shared across a fork
+
+# Cache recommendations for identical specs (in-memory, per worker)
+recommendations = recommendation_cache.RecommendationCache(
+    maxsize=int(os.getenv("RECOMMENDATION_CACHE_SIZE", "256")),
+    ttl=int(os.getenv("RECOMMENDATION_CACHE_TTL", "3600"))
+)
+
+# Coalesce concurrent generations of the same spec onto one upstream call
+inflight = singleflight.SingleFlight()
+
+# Every coalescer in this worker (the ASGI entry point adds its own), for metrics
+coalescers = [inflight]
+
+# Store conversation history (memory per worker, or sqlite/redis shared across workers)
+conversation_history = session_store.create_session_store()
+
+# Optionally capture LLM endpoint traffic for replay by benchmarks/loadtest.py
+traffic = traffic_log.TrafficLog(os.getenv("TRAFFIC_LOG_PATH")) if os.getenv("TRAFFIC_LOG_PATH") else None
+
+LLM_ENDPOINTS = {
+    'get_recommendation',
+    'get_recommendation_stream',
+    'ask_question',
+    'ask_question_stream',
+}
+
+# Endpoints that start LLM work without holding an admission slot (the job pool bounds
+# their concurrency) but still pay the per-IP and per-session rate limits
+RATE_LIMITED_ENDPOINTS = {
+    'create_recommendation_job',
+}
+
+# Reverse proxies (e.g. nginx) in front of the app whose X-Forwarded-For entries are trusted
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+# Client-supplied request IDs are echoed and logged only if they look like an ID
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+# Fraction of LLM requests timed into Server-Timing headers and the timing log
+TIMING_SAMPLE_RATE = float(os.getenv("TIMING_SAMPLE_RATE", "1.0"))
+
+# Per-session locks (striped) serialize read-modify-write of a session
+session_conditions = session_locks.StripedLocks()
+
+# How long a follow-up waits for its recommendation to finish generating
+FOLLOW_UP_WAIT_TIMEOUT = float(os.getenv("FOLLOW_UP_WAIT_TIMEOUT", "120"))
+
+# Optionally carry follow-up context in signed tokens instead of server sessions
+STATELESS_SESSIONS = os.getenv("STATELESS_SESSIONS", "0") == "1"
+if STATELESS_SESSIONS and not os.getenv("SESSION_TOKEN_SECRET"):
+    raise ValueError("SESSION_TOKEN_SECRET environment variable not set")
+
+# Per-endpoint upstream deadlines (seconds), covering every retry of a call
+RECOMMENDATION_DEADLINE = float(os.getenv("RECOMMENDATION_DEADLINE", "90"))
+FOLLOW_UP_DEADLINE = float(os.getenv("FOLLOW_UP_DEADLINE", "45"))
+
+# Opt-in hedging: race a second attempt when the first token is later than the observed p90
+hedge_policy = upstream_client.HedgePolicy(
+    quantile=float(os.getenv("HEDGE_QUANTILE", "0.9")),
+    initial_delay=float(os.getenv("HEDGE_INITIAL_DELAY", "2.0")),
+    budget=upstream_client.RetryBudget(
+        ratio=float(os.getenv("HEDGE_BUDGET_RATIO", "0.05")), min_per_sec=0.1, max_tokens=5.0
+    )
+) if os.getenv("HEDGE_REQUESTS", "0") == "1" else None
+
+# Upstream slots shared by priority class, so follow-ups overtake new recommendations under load
+UPSTREAM_MAX_CONCURRENT = int(os.getenv("UPSTREAM_MAX_CONCURRENT", "16"))
+upstream_scheduler = scheduler.PriorityScheduler(
+    slots=UPSTREAM_MAX_CONCURRENT,
+    weights=scheduler.parse_weights(os.getenv("UPSTREAM_PRIORITY_WEIGHTS", "")),
+    max_age=float(os.getenv("UPSTREAM_PRIORITY_MAX_AGE", "5"))
+) if UPSTREAM_MAX_CONCURRENT > 0 else None
+
+# Upstream priority class per endpoint; other callers count as new recommendations.
+# A job's client is polling for its result, so jobs rank as recommendations too;
+# BACKGROUND is left for calls nobody waits on, such as warm-up and benchmarks
+UPSTREAM_PRIORITIES = {
+    'ask_question': scheduler.INTERACTIVE,
+    'ask_question_stream': scheduler.INTERACTIVE,
+    'create_recommendation_job': scheduler.RECOMMENDATION,
+}
+
+# Retries transient upstream errors and fails fast while the upstream is unhealthy
+upstream = upstream_client.UpstreamClient(
+    max_attempts=int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3")),
+    budget=upstream_client.RetryBudget(ratio=float(os.getenv("UPSTREAM_RETRY_RATIO", "0.1"))),
+    breaker=upstream_client.CircuitBreaker(
+        failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+    ),
+    hedge=hedge_policy,
+    scheduler=upstream_scheduler
+)
+
+# Admission control in front of the LLM endpoints: a global limit on requests in flight
+# (upstream calls themselves are capped by the scheduler's slots), per-IP and per-session
+# token buckets, and a short bounded wait queue
+admission_control = admission.AdmissionController(
+    max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", "32")),
+    max_queued=int(os.getenv("ADMISSION_MAX_QUEUED", "64")),
+    max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "10")),
+    ip_rate=float(os.getenv("ADMISSION_IP_RATE", "2")),
+    ip_burst=int(os.getenv("ADMISSION_IP_BURST", "20")),
+    session_rate=float(os.getenv("ADMISSION_SESSION_RATE", "0.5")),
+    session_burst=int(os.getenv("ADMISSION_SESSION_BURST", "5"))
+)
+
+# Prometheus-style metrics; METRICS_DIR aggregates them across gunicorn workers
+metrics_registry = metrics.Registry(
+    os.getenv("METRICS_DIR"),
+    flush_interval=float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+)
+http_requests = metrics_registry.counter(
+    'http_requests_total', 'HTTP requests by endpoint and status', ['endpoint', 'status']
+)
+http_latency = metrics_registry.histogram(
+    'http_request_duration_seconds', 'Time until the response (or its stream) finished', ['endpoint']
+)
+upstream_latency = metrics_registry.histogram(
+    'upstream_request_duration_seconds', 'LLM call duration, streams until exhausted', ['model', 'stream']
+)
+upstream_errors = metrics_registry.counter(
+    'upstream_errors_total', 'Failed LLM calls by error class', ['model', 'error_class']
+)
+llm_tokens = metrics_registry.counter(
+    'llm_tokens_total', 'Tokens reported by response.usage_metadata', ['model', 'kind']
+)
+# The hit ratio is computed in the query from these, summed over workers:
+# sum(rate(..{result="hit"}[5m])) / sum(rate(..[5m]))
+cache_lookups = metrics_registry.counter(
+    'recommendation_cache_lookups_total', 'Recommendation cache lookups by result', ['result']
+)
+coalesced_requests = metrics_registry.counter(
+    'singleflight_coalesced_total', 'Recommendations served by joining an in-flight generation'
+)
+stream_disconnects = metrics_registry.counter(
+    'stream_disconnects_total', 'Streams whose client went away before the last event', ['endpoint']
+)
+upstream_cancellations = metrics_registry.counter(
+    'upstream_cancellations_total', 'Upstream streams stopped before they finished', ['model']
+)
+cancelled_generations = metrics_registry.counter(
+    'singleflight_cancelled_total', 'Shared generations stopped because every subscriber left'
+)
+upstream_retries = metrics_registry.counter(
+    'upstream_retries_total', 'LLM call retries by error class', ['error_class']
+)
+upstream_rejections = metrics_registry.counter(
+    'upstream_rejections_total', 'LLM calls failed fast without a retry', ['reason']
+)
+breaker_state = metrics_registry.gauge(
+    'upstream_circuit_breaker_state', 'Circuit breaker state (0 closed, 1 half-open, 2 open)', mode='max'
+)
+breaker_opened = metrics_registry.counter(
+    'upstream_circuit_breaker_opened_total', 'Times the circuit breaker opened'
+)
+retry_budget = metrics_registry.gauge(
+    'upstream_retry_budget_tokens', 'Retries currently allowed by the retry budget'
+)
+upstream_hedges = metrics_registry.counter(
+    'upstream_hedges_total', 'Hedged LLM calls by outcome (won, lost, skipped over budget)', ['outcome']
+)
+hedge_delay = metrics_registry.gauge(
+    'upstream_hedge_delay_seconds', 'Current delay before a hedged attempt starts', ['model', 'priority', 'mode'],
+    mode='max'
+)
+model_routes = metrics_registry.counter(
+    'model_routes_total', 'Requests routed to each model tier', ['endpoint', 'tier']
+)
+model_escalations = metrics_registry.counter(
+    'model_escalations_total', 'Answers re-asked on the escalation tier by reason', ['endpoint', 'reason']
+)
+jobs_queued = metrics_registry.gauge('jobs_queued', 'Recommendation jobs waiting for a worker')
+jobs_running = metrics_registry.gauge('jobs_running', 'Recommendation jobs being generated')
+jobs_finished = metrics_registry.counter('jobs_finished_total', 'Finished recommendation jobs', ['status'])
+idempotent_requests = metrics_registry.counter(
+    'idempotent_requests_total', 'Requests carrying an Idempotency-Key by outcome', ['endpoint', 'outcome']
+)
+jobs_rejected = metrics_registry.counter('jobs_rejected_total', 'Jobs refused because the queue was full')
+job_queue_wait = metrics_registry.histogram(
+    'job_queue_wait_seconds', 'Time recommendation jobs waited for a worker'
+)
+admission_active = metrics_registry.gauge('admission_active', 'LLM requests holding an admission slot')
+admission_queued = metrics_registry.gauge('admission_queued', 'LLM requests waiting for an admission slot')
+admission_wait = metrics_registry.histogram(
+    'admission_wait_seconds', 'Time admitted LLM requests waited for a slot'
+)
+admission_rejections = metrics_registry.counter(
+    'admission_rejections_total', 'LLM requests rejected with 429 by reason', ['reason']
+)
+upstream_slot_wait = metrics_registry.histogram(
+    'upstream_slot_wait_seconds', 'Time LLM calls waited for an upstream slot', ['priority']
+)
+upstream_class_latency = metrics_registry.histogram(
+    'upstream_priority_duration_seconds', 'LLM call duration including the slot wait', ['priority']
+)
+upstream_slots_active = metrics_registry.gauge('upstream_slots_active', 'Upstream slots in use')
+upstream_slots_queued = metrics_registry.gauge(
+    'upstream_slots_queued', 'LLM calls waiting for an upstream slot', ['priority']
+)
+upstream_promotions = metrics_registry.counter(
+    'upstream_priority_promotions_total', 'Slots granted out of turn to calls waiting too long', ['priority']
+)
+upstream_slot_timeouts = metrics_registry.counter(
+    'upstream_slot_timeouts_total', 'LLM calls whose deadline passed waiting for a slot', ['priority']
+)
+# A shared session backend reports the same figures from every worker
+SESSION_STORE_MODE = 'sum' if isinstance(conversation_history, session_store.MemorySessionStore) else 'max'
+session_store_entries = metrics_registry.gauge(
+    'session_store_entries', 'Live entries per session store namespace', ['store'], mode=SESSION_STORE_MODE
+)
+session_store_bytes = metrics_registry.gauge(
+    'session_store_bytes', 'Bytes held per session store namespace', ['store'], mode=SESSION_STORE_MODE
+)
+session_store_evictions = metrics_registry.counter(
+    'session_store_evictions_total', 'Entries evicted over the count or size caps', ['store']
+)
+
+def observe_upstream_call(model_name, stream, seconds, usage_metadata, error):
+    """model_registry listener: upstream latency, error classes and token counts"""
+    upstream_latency.observe(seconds, model=model_name, stream=str(stream).lower())
+    if error is not None:
+        upstream_errors.inc(model=model_name, error_class=type(error).__name__)
+    if usage_metadata is not None:
+        llm_tokens.inc(getattr(usage_metadata, 'prompt_token_count', 0) or 0, model=model_name, kind='prompt')
+        llm_tokens.inc(getattr(usage_metadata, 'candidates_token_count', 0) or 0, model=model_name, kind='output')
+
+def observe_upstream_slot(priority, waited, held):
+    """PriorityScheduler listener: per-class slot wait and end-to-end call latency"""
+    upstream_slot_wait.observe(waited, priority=priority)
+    upstream_class_latency.observe(waited + held, priority=priority)
+
+def collect_app_metrics():
+    """Refresh metrics mirrored from the cache, single-flight and session store"""
+    cache_stats = recommendations.stats()
+    cache_lookups.set_total(cache_stats['hits'], result='hit')
+    cache_lookups.set_total(cache_stats['misses'], result='miss')
+    coalesced_requests.set_total(sum(flight.stats()['coalesced'] for flight in coalescers))
+    cancelled_generations.set_total(sum(flight.stats().get('cancelled', 0) for flight in coalescers))
+    upstream_stats = upstream.stats()
+    for error_class, count in upstream_stats['retries'].items():
+        upstream_retries.set_total(count, error_class=error_class)
+    upstream_rejections.set_total(upstream_stats['rejected'], reason='circuit_open')
+    upstream_rejections.set_total(upstream_stats['budget_exhausted'], reason='retry_budget')
+    breaker_state.set(upstream_stats['breaker_state_value'])
+    breaker_opened.set_total(upstream_stats['breaker_opened'])
+    retry_budget.set(upstream_stats['retry_budget_tokens'])
+    admission_stats = admission_control.stats()
+    admission_active.set(admission_stats['active'])
+    admission_queued.set(admission_stats['queued'])
+    for reason, count in admission_stats['rejected'].items():
+        admission_rejections.set_total(count, reason=reason)
+    if upstream_scheduler:
+        scheduler_stats = upstream_scheduler.stats()
+        upstream_slots_active.set(scheduler_stats['active'])
+        for priority in scheduler.PRIORITIES:
+            upstream_slots_queued.set(scheduler_stats['queued'][priority], priority=priority)
+            upstream_promotions.set_total(scheduler_stats['promoted'][priority], priority=priority)
+            upstream_slot_timeouts.set_total(scheduler_stats['timeouts'][priority], priority=priority)
+    job_stats = job_queue.stats()
+    jobs_queued.set(job_stats['queued'])
+    jobs_running.set(job_stats['running'])
+    jobs_rejected.set_total(job_stats['rejected'])
+    router_stats = router.stats()
+    for route in router_stats['routes']:
+        model_routes.set_total(route['count'], endpoint=route['endpoint'], tier=route['tier'])
+    for escalation in router_stats['escalations']:
+        model_escalations.set_total(escalation['count'], endpoint=escalation['endpoint'],
+                                    reason=escalation['reason'])
+    for outcome, count in upstream_stats['hedges'].items():
+        upstream_hedges.set_total(count, outcome=outcome)
+    for (model_name, priority, mode), seconds in upstream_stats['hedge_delay'].items():
+        hedge_delay.set(seconds, model=model_name, priority=priority, mode=mode)
+    stores = {'sessions': conversation_history, 'jobs': job_store.store, 'idempotency': idempotency_keys.store}
+    for name, store in stores.items():
+        try:
+            store_stats = store.stats()
+        except Exception as e:
+            app.logger.warning(f"Session store stats unavailable for {name}: {str(e)}")
+            continue
+        session_store_entries.set(store_stats['sessions'], store=name)
+        session_store_bytes.set(store_stats['bytes'], store=name)
+        # Redis leaves eviction to the server's maxmemory policy, so it reports none
+        if 'evictions' in store_stats:
+            session_store_evictions.set_total(store_stats['evictions'], store=name)
+
+# Token and cost totals per endpoint, spec and session (per worker)
+token_ledger = token_usage.TokenLedger(
+    prices=token_usage.parse_prices(os.getenv("LLM_PRICES", "")),
+    session_ttl=int(os.getenv("SESSION_TTL", "3600"))
+)
+
+# Also ask count_tokens for each prompt before generating (one extra upstream call)
+TOKEN_ESTIMATE = os.getenv("TOKEN_ESTIMATE", "0") == "1"
+
+# Shared secret for /admin endpoints (X-Admin-Token header); they are disabled without one
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+model_registry.add_listener(observe_upstream_call)
+if upstream_scheduler:
+    upstream_scheduler.add_listener(observe_upstream_slot)
+metrics_registry.add_collector(collect_app_metrics)
+
+tokens = session_tokens.SessionTokens(
+    os.getenv("SESSION_TOKEN_SECRET", ""),
+    PROMPT_VERSION,
+    max_age=int(os.getenv("SESSION_TOKEN_MAX_AGE", "86400"))
+) if STATELESS_SESSIONS else None
+
+# Background recommendation jobs: state on the session backend, run by a bounded worker pool.
+# Jobs get their own namespace so they neither count as sessions nor evict them.
+job_store = jobs.JobStore(session_store.create_session_store(namespace='jobs'), session_conditions)
+job_queue = jobs.JobQueue(
+    workers=int(os.getenv("JOB_WORKERS", "4")),
+    max_queued=int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+)
+
+# Longest a GET /jobs/<id>?wait= long-poll may hold its connection
+JOB_LONG_POLL_MAX = float(os.getenv("JOB_LONG_POLL_MAX", "30"))
+
+# Interval between keep-alive comments on an idle job event stream
+JOB_EVENTS_KEEPALIVE = float(os.getenv("JOB_EVENTS_KEEPALIVE", "15"))
+
+# Outcomes of Idempotency-Key requests, kept on the session backend (in their own namespace)
+# for IDEMPOTENCY_WINDOW seconds; an in-flight marker outlives its request's deadline only if
+# its worker died
+idempotency_keys = idempotency.IdempotencyStore(
+    session_store.create_session_store(namespace='idempotency'),
+    session_conditions,
+    window=int(os.getenv("IDEMPOTENCY_WINDOW", "600")),
+    lease=RECOMMENDATION_DEADLINE + 30
+)
+
+# How long a repeat waits for the in-flight original before getting 409
+IDEMPOTENCY_WAIT = {
+    'get_recommendation': RECOMMENDATION_DEADLINE,
+    'get_recommendation_stream': RECOMMENDATION_DEADLINE,
+    'ask_question': FOLLOW_UP_DEADLINE,
+    'ask_question_stream': FOLLOW_UP_DEADLINE,
+}
 
 def validate_form_data(form_data):
     """Validate required form fields"""
@@ -52,6 +453,329 @@ def validate_form_data(form_data):
             return False, f"Missing required field: {field}"
     return True, ""
 
+def parse_recommendation_form(form=None):
+    """Collect recommendation form fields including multi-select lists"""
+    form = request.form if form is None else form
+    form_data = form.to_dict()
+    form_data['barrier_requirements'] = form.getlist('barrier_requirements')
+    form_data['sustainability_options'] = form.getlist('sustainability_options')
+    form_data['special_features'] = form.getlist('special_features')
+    return form_data
+
+def recommendation_key(form_data, model_name=MODEL_NAME):
+    """Cache key for the canonical spec, model, generation config and prompt version"""
+    prompt_version = [PROMPT_VERSION, 'sectioned'] if SECTIONED_RECOMMENDATIONS else PROMPT_VERSION
+    return recommendation_cache.spec_key(
+        recommendation_cache.canonical_spec(form_data),
+        model_name, GENERATION_CONFIG, prompt_version
+    )
+
+def create_session(form_data):
+    """Create a conversation session with a placeholder for the recommendation"""
+    session_id = f"{datetime.now().timestamp()}-{uuid.uuid4().hex[:8]}"
+    g.session_id = session_id
+    if STATELESS_SESSIONS:
+        return session_id  # Follow-up context travels in the signed session token
+    conversation_history[session_id] = {
+        'context': form_data,
+        'status': 'pending',
+        'chat_history': [
+            {'seq': 0, 'role': 'system', 'content': 'Initial recommendation generated'},
+            {'seq': 1, 'role': 'assistant', 'content': ''}  # Placeholder for recommendation
+        ],
+        'next_seq': 2,
+        'timestamp': time.time()
+    }
+    return session_id
+
+def issue_session_token(form_data):
+    """Signed follow-up context for the client, when stateless sessions are enabled"""
+    if not STATELESS_SESSIONS:
+        return None
+    return tokens.issue(recommendation_cache.canonical_spec(form_data))
+
+def resolve_follow_up(session_id, session_token):
+    """Return (session, context) for a follow-up from its token or the session store
+
+    session is None in stateless mode; context is None if neither resolves.
+    A session whose recommendation is still generating is waited on first.
+    """
+    if STATELESS_SESSIONS and session_token:
+        try:
+            return None, tokens.context(session_token)
+        except session_tokens.InvalidSessionToken as e:
+            app.logger.warning(f"Rejected session token: {str(e)}")
+            return None, None
+    session = wait_for_recommendation(session_id) if session_id else None
+    if not session:
+        return None, None
+    return session, session['context']
+
+def wait_for_recommendation(session_id, timeout=None):
+    """Return the session once its recommendation is no longer pending
+
+    Also polls the store, so a recommendation finishing on another worker
+    sharing the session backend is picked up too.
+    """
+    timeout = FOLLOW_UP_WAIT_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    condition = session_conditions.condition_for(session_id)
+    with condition:
+        while True:
+            session = conversation_history.get(session_id)
+            if session is None or session.get('status') != 'pending':
+                return session
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return session
+            condition.wait(min(remaining, 0.25))
+
+def finish_recommendation(session_id, recommendation=None):
+    """Fill the recommendation placeholder, or mark it failed, and wake waiters"""
+    if STATELESS_SESSIONS:
+        return
+    def fill(session):
+        if session is None:
+            return None  # Session expired while generating
+        if recommendation is None:
+            session['status'] = 'failed'
+        else:
+            session['status'] = 'ready'
+            session['chat_history'][1]['content'] = recommendation
+        return session
+
+    condition = session_conditions.condition_for(session_id)
+    with condition:
+        conversation_history.update(session_id, fill)
+        condition.notify_all()
+
+def record_follow_up(session_id, question, answer):
+    """Append a completed user/assistant exchange to the session in one step"""
+    if STATELESS_SESSIONS:
+        return  # Stateless follow-ups keep no server-side history
+    def append(session):
+        if session is None:
+            return None
+        seq = session['next_seq']
+        session['chat_history'].extend([
+            {'seq': seq, 'role': 'user', 'content': question},
+            {'seq': seq + 1, 'role': 'assistant', 'content': answer}
+        ])
+        session['next_seq'] = seq + 2
+        return session
+
+    # An atomic update, so concurrent follow-ups on any worker never drop each other's turns
+    conversation_history.update(session_id, append)
+
+def estimate_prompt_tokens(model, prompt):
+    """Pre-call prompt token count when TOKEN_ESTIMATE is on, else None"""
+    if not TOKEN_ESTIMATE:
+        return None
+    try:
+        return model.count_tokens(prompt).total_tokens
+    except Exception as e:
+        app.logger.warning(f"Token estimate failed: {str(e)}")
+        return None
+
+def usage_labels(endpoint, session_id, context, language):
+    """Attribution recorded with each LLM call's token usage"""
+    return {
+        'endpoint': endpoint,
+        'session_id': session_id or None,
+        'product_category': context.get('product_category'),
+        'language': language,
+    }
+
+def upstream_priority(usage):
+    """Scheduler class for a call, from the endpoint its usage is attributed to"""
+    return UPSTREAM_PRIORITIES.get(usage['endpoint'], scheduler.RECOMMENDATION)
+
+def call_model(prompt, tier, deadline, usage):
+    """Generate a complete answer on a model tier and record its token usage
+
+    usage holds the usage_labels the call's tokens are attributed to.
+    """
+    model_name = router.tiers[tier]
+    model = model_registry.get_model(model_name, GENERATION_CONFIG, SAFETY_SETTINGS)
+    estimated = estimate_prompt_tokens(model, prompt)
+    response = upstream.generate(model, prompt, deadline, priority=upstream_priority(usage))
+    token_ledger.record(model_name, response.usage_metadata, estimated_prompt_tokens=estimated, **usage)
+    return response.text
+
+def stream_model(prompt, tier, deadline, usage):
+    """Yield text deltas from a model tier and record token usage once the stream ends"""
+    model_name = router.tiers[tier]
+    model = model_registry.get_model(model_name, GENERATION_CONFIG, SAFETY_SETTINGS)
+    estimated = estimate_prompt_tokens(model, prompt)
+    response = upstream.generate(model, prompt, deadline, stream=True, priority=upstream_priority(usage))
+    try:
+        yield from iter_stream_text(response)
+    except GeneratorExit:
+        # Nobody is reading any more: stop the upstream stream instead of draining it
+        response.cancel()
+        upstream_cancellations.inc(model=model_name)
+        raise
+    finally:
+        token_ledger.record(model_name, response.usage_metadata, estimated_prompt_tokens=estimated, **usage)
+
+def answer_follow_up(prompt, tier, usage):
+    """Answer on the routed tier, re-asking the escalation tier if the answer fails the quality check
+
+    Returns (answer, tier that produced it).
+    """
+    answer = call_model(prompt, tier, FOLLOW_UP_DEADLINE, usage)
+    reason = router.escalation_reason(tier, answer, usage['language'])
+    if reason is None:
+        return answer, tier
+    router.record_escalation(usage['endpoint'], reason)
+    tier = router.escalation_tier
+    return call_model(prompt, tier, FOLLOW_UP_DEADLINE, usage), tier
+
+def generate_recommendation(form_data, language, prompt, cache_key, tier, usage, stream=False):
+    """Yield recommendation text from the routed model and cache the complete result
+
+    prompt is the single-call prompt; sectioned mode builds its own per section.
+    """
+    if SECTIONED_RECOMMENDATIONS:
+        chunks = generate_sections(form_data, language, tier, usage, stream)
+    elif stream:
+        chunks = stream_model(prompt, tier, RECOMMENDATION_DEADLINE, usage)
+    else:
+        chunks = iter([call_model(prompt, tier, RECOMMENDATION_DEADLINE, usage)])
+    parts = []
+    for text in chunks:
+        parts.append(text)
+        yield text
+    # Cache before the flight closes so no request falls between the two
+    recommendations.set(cache_key, ''.join(parts))
+
+def generate_sections(form_data, language, tier, usage, stream=False):
+    """Yield the structure section, then the remaining sections in order as each completes
+
+    The remaining sections are generated concurrently, each conditioned on
+    the structure, so wall-clock time approaches structure + longest section.
+    """
+    deadline = time.monotonic() + RECOMMENDATION_DEADLINE
+    heading = RECOMMENDATION_SECTIONS[0][0]
+    structure_prompt = construct_section_prompt(form_data, language, RECOMMENDATION_SECTIONS[0])
+    if stream:
+        parts = []
+        for text in stream_model(structure_prompt, tier, RECOMMENDATION_DEADLINE, usage):
+            if not parts and not text.lstrip().startswith('#'):
+                text = f"{heading}\n{text}"
+            parts.append(text)
+            yield text
+        structure = ''.join(parts)
+    else:
+        structure = with_heading(heading, call_model(structure_prompt, tier, RECOMMENDATION_DEADLINE, usage))
+        yield structure
+
+    futures = [
+        section_executor.submit(
+            call_model,
+            construct_section_prompt(form_data, language, section, structure),
+            tier, max(deadline - time.monotonic(), 0), usage
+        )
+        for section in RECOMMENDATION_SECTIONS[1:]
+    ]
+    try:
+        for (heading, _), future in zip(RECOMMENDATION_SECTIONS[1:], futures):
+            yield "\n\n" + with_heading(heading, future.result())
+    finally:
+        for future in futures:
+            future.cancel()
+
+def with_heading(heading, text):
+    """Make sure a generated section starts with its markdown heading"""
+    text = text.strip()
+    return text if text.startswith('#') else f"{heading}\n{text}"
+
+def run_recommendation_job(job_id, session_id, form_data, language, prompt, tier, queued_seconds=0.0):
+    """Generate a job's recommendation on a job worker, recording the outcome in the job"""
+    job_queue_wait.observe(queued_seconds)
+    job_store.update(job_id, status=jobs.RUNNING, started=time.time())
+    try:
+        cache_key = recommendation_key(form_data, router.tiers[tier])
+        recommendation = recommendations.get(cache_key)
+        cached = recommendation is not None
+        if not cached:
+            flight, leader = inflight.acquire(cache_key)
+            if leader:
+                usage = usage_labels('create_recommendation_job', session_id, form_data, language)
+                inflight.run(flight, lambda: generate_recommendation(
+                    form_data, language, prompt, cache_key, tier, usage
+                ))
+            recommendation = flight.result()
+
+        finish_recommendation(session_id, recommendation)
+        job_store.update(job_id, status=jobs.SUCCEEDED, finished=time.time(),
+                         recommendation=recommendation, cached=cached)
+        jobs_finished.inc(status=jobs.SUCCEEDED)
+
+    except Exception as e:
+        app.logger.error(f"Recommendation job error: {str(e)}")
+        finish_recommendation(session_id)
+        status, _ = upstream_error_status(e)
+        job_store.update(job_id, status=jobs.FAILED, finished=time.time(), error_status=status,
+                         message=f"Failed to generate recommendation: {str(e)}")
+        jobs_finished.inc(status=jobs.FAILED)
+
+def upstream_error_status(error):
+    """HTTP status and headers for a request failed by an upstream error"""
+    if isinstance(error, upstream_client.CircuitOpenError):
+        return 503, {'Retry-After': str(math.ceil(error.retry_after))}
+    error_class = upstream_client.classify(error)
+    if error_class == 'deadline':
+        return 504, {}
+    if error_class is not None:
+        return 503, {}
+    return 500, {}
+
+def timed_stream(chunks, started=None):
+    """Pass stream chunks through, recording upstream time-to-first-token and total
+
+    started is when the upstream call was made, if before iteration begins.
+    Time spent writing each delta to the client is excluded from the upstream span.
+    """
+    started = started or time.perf_counter()
+    waiting = time.perf_counter() - started
+    first = True
+    iterator = iter(chunks)
+    while True:
+        wait_started = time.perf_counter()
+        try:
+            text = next(iterator)
+        except StopIteration:
+            waiting += time.perf_counter() - wait_started
+            break
+        waiting += time.perf_counter() - wait_started
+        if first:
+            request_timing.record('upstream_ttft', time.perf_counter() - started)
+            first = False
+        yield text
+    request_timing.record('upstream', waiting)
+
+def log_stream_timing(status):
+    """Log a streamed request's spans once its stream has finished"""
+    timer = request_timing.current()
+    if timer:
+        timer.log(200, stream_status=status)
+
+def sse_event(event, data):
+    """Format a single Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def iter_stream_text(response):
+    """Yield text deltas from a streamed Gemini response"""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. finish metadata) carry no delta
+            continue
+        if text:
+            yield text
+
 def construct_base_prompt(form_data, language):
     """Construct the main recommendation prompt with structured sections"""
     lang_prefix = "निम्नलिखित प्रारूप में उत्तर दें:\n\n" if language == "Hindi" else ""
@@ -101,133 +825,666 @@ def construct_base_prompt(form_data, language):
     Response language: {language}
     """
 
+def construct_section_prompt(form_data, language, section, structure=None):
+    """Construct the prompt for one recommendation section, optionally given the structure"""
+    heading, points = section
+    lang_prefix = "निम्नलिखित प्रारूप में उत्तर दें:\n\n" if language == "Hindi" else ""
+    bullets = '\n    '.join(f"- {point}" for point in points)
+    # Pass the structure without its heading so the model writes only its own section
+    decided = '\n'.join(line for line in (structure or '').splitlines() if not line.startswith('#'))
+    structure_block = f"""
+    The recommended structure has already been decided:
+    {decided.strip()}
+
+    Base this section on that structure and do not repeat it.
+    """ if structure else ""
+
+    return f"""
+    As a senior flexible packaging engineer, you are writing one section of a
+    material structure recommendation for:
+    
+    Product Category: {form_data['product_category']}
+    Printing Type: {form_data['printing_type']}
+    Layer Structure: {form_data['layer_structure']}
+    Primary Material: {form_data['packaging_material']}
+    Packaging Format: {form_data['packaging_type']}
+    Sealing Type: {form_data.get('sealing_type', 'Not specified')}
+    Barrier Requirements: {', '.join(form_data.get('barrier_requirements', []))}
+    Sustainability Options: {', '.join(form_data.get('sustainability_options', []))}
+    Shelf Life: {form_data.get('shelf_life', 'Not specified')}
+    Special Features: {', '.join(form_data.get('special_features', []))}
+    Production Volume: {form_data.get('production_volume', 'Not specified')}
+    Custom Requirements: {form_data.get('custom_requirements', 'None')}
+    {structure_block}
+    {lang_prefix}Write ONLY this MARKDOWN section with emojis, starting with its heading:
+    
+    {heading}
+    {bullets}
+    
+    Include technical specifications and industry standards where applicable.
+    Use metric units and material science terminology.
+    Response language: {language}
+    """
+
+def construct_follow_up_prompt(context, question, language):
+    """Construct the follow-up prompt with the full recommendation context"""
+    return f"""
+    Packaging Expert Context:
+    - Product: {context['product_category']}
+    - Structure: {context['layer_structure']} layers
+    - Materials: {context['packaging_material']} base
+    - Printing: {context['printing_type']}
+    - Barriers: {', '.join(context.get('barrier_requirements', []))}
+    - Sustainability: {', '.join(context.get('sustainability_options', []))}
+    
+    User Question: "{question}"
+    
+    Required Answer Format:
+    - Technical depth with material science principles
+    - Reference industry standards (ISO, ASTM)
+    - Compare alternatives if relevant
+    - Highlight cost-performance tradeoffs
+    - Language: {language}
+    
+    Structure Response As:
+    📌 **Key Analysis**: [Core technical explanation]
+    🔍 **Considerations**: [Critical factors]
+    💡 **Recommendation**: [Expert opinion]
+    """
+
+@app.before_request
+def assign_request_id():
+    # Clients may name their requests (chat.js does) so logs can be matched to them
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else uuid.uuid4().hex
+
+@app.before_request
+def start_request_timing():
+    if request.endpoint in LLM_ENDPOINTS:
+        request_timing.start(request.endpoint, TIMING_SAMPLE_RATE, g.request_id)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+
+def client_ip():
+    """The client's address, believing X-Forwarded-For only as far as TRUSTED_PROXY_HOPS proxies"""
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [addr.strip() for addr in request.headers.get('X-Forwarded-For', '').split(',')
+                     if addr.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr
+
+def admission_identity():
+    """The client IP and session ID an LLM request is rate limited under"""
+    return client_ip(), request.form.get('session_id', '').strip()
+
+def reject_admission(error):
+    return jsonify({'status': 'error', 'message': str(error)}), 429, {'Retry-After': str(error.retry_after)}
+
+def hold_permit(permit):
+    """Keep an admitted request's permit until its response has been sent"""
+    admission_wait.observe(permit.waited)
+    g.admission_permit = permit
+
+def admit_request():
+    """Take an admission slot for an LLM request; returns a 429 response if rejected"""
+    try:
+        permit = admission_control.acquire(*admission_identity())
+    except admission.AdmissionRejected as e:
+        return reject_admission(e)
+    hold_permit(permit)
+    return None
+
+@app.before_request
+def admit_llm_request():
+    # The ASGI entry point admits its async views off the event loop instead
+    if request.endpoint in LLM_ENDPOINTS and not request.environ.get('admission.deferred'):
+        return admit_request()
+    if request.endpoint in RATE_LIMITED_ENDPOINTS:
+        try:
+            admission_control.check_rate(*admission_identity())
+        except admission.AdmissionRejected as e:
+            return reject_admission(e)
+
+@app.after_request
+def release_admission(response):
+    permit = g.pop('admission_permit', None)
+    if permit:
+        # Streams hold their slot until the last event has been sent
+        response.call_on_close(permit.release)
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unmatched'
+    started = g.get('metrics_started', time.perf_counter())
+    status = response.status_code
+
+    # Runs once the body, including any stream, has been sent
+    def observe():
+        http_requests.inc(endpoint=endpoint, status=status)
+        http_latency.observe(time.perf_counter() - started, endpoint=endpoint)
+
+    response.call_on_close(observe)
+    return response
+
+@app.after_request
+def echo_request_id(response):
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    return response
+
+@app.after_request
+def emit_request_timing(response):
+    timer = request_timing.current()
+    if timer:
+        response.headers['Server-Timing'] = timer.server_timing()
+        # Streamed responses log once the stream finishes
+        if not response.is_streamed:
+            timer.log(response.status_code)
+    return response
+
+@app.after_request
+def capture_traffic(response):
+    if traffic and request.endpoint in LLM_ENDPOINTS:
+        traffic.record(
+            request.path,
+            request.form.to_dict(flat=False),
+            response.status_code,
+            created_session_id=g.get('session_id')
+        )
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics_registry.exposition(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/token_usage')
+def admin_token_usage():
+    """Token and cost totals for this worker, or for one session with ?session_id="""
+    # Session IDs are enough to post into a conversation: never serve them without a token
+    if not ADMIN_TOKEN:
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+    session_id = request.args.get('session_id', '').strip()
+    if session_id:
+        usage = token_ledger.session(session_id)
+        if usage is None:
+            return jsonify({'status': 'error', 'message': 'No usage for session'}), 404
+        return jsonify({'status': 'success', 'session_id': session_id, 'usage': usage})
+    return jsonify({'status': 'success', 'pid': os.getpid(), 'usage': token_ledger.stats()})
+
+def claim_idempotency_key():
+    """Check the request's Idempotency-Key header (or idempotency_key field)
+
+    Returns (claim, response): claim is set when this request must run and
+    record its outcome; response is the reply to send instead of running it.
+    """
+    claim, response = idempotency_claim()
+    if claim is None:
+        return None, response
+    try:
+        record = idempotency_keys.claim(*claim, timeout=idempotency_wait())
+    except idempotency.IdempotencyConflict as e:
+        return idempotency_conflict(e)
+    return idempotency_outcome(claim, record)
+
+def idempotency_claim():
+    """The request's (key, digest) claim, or (None, response) if it has no usable key"""
+    key = (request.headers.get('Idempotency-Key') or request.form.get('idempotency_key', '')).strip()
+    if not key:
+        return None, None
+    if len(key) > 255:
+        return None, (jsonify({'status': 'error', 'message': 'Idempotency-Key is too long'}), 400)
+    form = request.form.to_dict(flat=False)
+    form.pop('idempotency_key', None)
+    return (f"{request.endpoint}:{key}", idempotency.fingerprint(request.endpoint, form)), None
+
+def idempotency_wait():
+    """How long this endpoint's repeats wait for an in-flight original"""
+    return IDEMPOTENCY_WAIT.get(request.endpoint, FOLLOW_UP_DEADLINE)
+
+def idempotency_conflict(error):
+    """claim_idempotency_key's reply to a key reused for a different payload"""
+    idempotent_requests.inc(endpoint=request.endpoint, outcome='conflict')
+    return None, (jsonify({'status': 'error', 'message': str(error)}), 422)
+
+def idempotency_outcome(claim, record):
+    """claim_idempotency_key's result for the record a claim found (None if it won the key)"""
+    endpoint = request.endpoint
+    if record is None:
+        idempotent_requests.inc(endpoint=endpoint, outcome='new')
+        return claim, None
+    if record['status'] == idempotency.IN_FLIGHT:
+        idempotent_requests.inc(endpoint=endpoint, outcome='in_flight')
+        return None, (jsonify({
+            'status': 'error',
+            'message': 'A request with this Idempotency-Key is still in progress'
+        }), 409, {'Retry-After': '1'})
+
+    idempotent_requests.inc(endpoint=endpoint, outcome='replayed')
+    stored = record['response']
+    return None, Response(stored['body'], status=stored['status'], mimetype=stored['mimetype'],
+                          headers={'Idempotent-Replayed': 'true'})
+
+def settle_idempotency_key(claim, response):
+    """Store a successful response for repeats; release the key of a failed one for retries"""
+    key, digest = claim
+    if response is not None and 200 <= response.status_code < 300:
+        idempotency_keys.complete(key, digest, response.status_code,
+                                  response.get_data(as_text=True), response.mimetype)
+    else:
+        idempotency_keys.release(key)
+
+def complete_idempotent_stream(claim, *events):
+    """Store a finished stream as the (event, data) pairs its repeats are replayed"""
+    key, digest = claim
+    idempotency_keys.complete(key, digest, 200, ''.join(sse_event(event, data) for event, data in events),
+                              'text/event-stream')
+
+def idempotent(view):
+    """Answer repeats of a keyed request with its stored response instead of calling the model again"""
+    @functools.wraps(view)
+    def wrapper():
+        claim, response = claim_idempotency_key()
+        if response is not None:
+            return response
+        if claim is None:
+            return view()
+        response = None
+        try:
+            response = app.make_response(view())
+            return response
+        finally:
+            settle_idempotency_key(claim, response)
+    return wrapper
+
 @app.route('/get_recommendation', methods=['POST'])
+@idempotent
 def get_recommendation():
+    session_id = None
     try:
-        form_data = request.form.to_dict()
-        form_data['barrier_requirements'] = request.form.getlist('barrier_requirements')
-        form_data['sustainability_options'] = request.form.getlist('sustainability_options')
-        form_data['special_features'] = request.form.getlist('special_features')
+        with request_timing.span('parse'):
+            form_data = parse_recommendation_form()
 
         # Validate form data
-        is_valid, message = validate_form_data(form_data)
+        with request_timing.span('validate'):
+            is_valid, message = validate_form_data(form_data)
         if not is_valid:
             return jsonify({'status': 'error', 'message': message}), 400
 
-        # Create unique session ID
-        session_id = f"{datetime.now().timestamp()}-{uuid.uuid4().hex[:8]}"
-        
         # Construct AI prompt
-        language = form_data.get('language', 'English')
-        prompt = construct_base_prompt(form_data, language)
-        
-        # Initialize conversation history
-        conversation_history[session_id] = {
-            'context': form_data,
-            'chat_history': [
-                {'role': 'system', 'content': 'Initial recommendation generated'},
-                {'role': 'assistant', 'content': ''}  # Placeholder for recommendation
-            ],
-            'timestamp': time.time()
-        }
-
-        # Generate recommendation
-        model = genai.GenerativeModel(
-            model_name='gemini-1.5-pro',
-            generation_config=GENERATION_CONFIG,
-            safety_settings=SAFETY_SETTINGS
-        )
+        with request_timing.span('prompt'):
+            language = form_data.get('language', 'English')
+            prompt = construct_base_prompt(form_data, language)
         
-        response = model.generate_content(prompt)
-        recommendation = response.text
+        # Initialize conversation history under a unique session ID
+        with request_timing.span('session'):
+            session_id = create_session(form_data)
+
+        # Reuse the recommendation for an identical spec if we have one
+        with request_timing.span('cache'):
+            tier = router.route('recommendation')
+            cache_key = recommendation_key(form_data, router.tiers[tier])
+            recommendation = recommendations.get(cache_key)
+        cached = recommendation is not None
+
+        if not cached:
+            # Generate recommendation, or wait on an identical one already in flight
+            with request_timing.span('upstream'):
+                flight, leader = inflight.acquire(cache_key)
+                if leader:
+                    usage = usage_labels('get_recommendation', session_id, form_data, language)
+                    inflight.run(flight, lambda: generate_recommendation(
+                        form_data, language, prompt, cache_key, tier, usage
+                    ))
+                recommendation = flight.result()
         
         # Store generated recommendation
-        conversation_history[session_id]['chat_history'][1]['content'] = recommendation
+        with request_timing.span('session'):
+            finish_recommendation(session_id, recommendation)
 
-        return jsonify({
-            'status': 'success',
-            'recommendation': recommendation,
-            'session_id': session_id
-        })
+        with request_timing.span('serialize'):
+            return jsonify({
+                'status': 'success',
+                'recommendation': recommendation,
+                'session_id': session_id,
+                'session_token': issue_session_token(form_data),
+                'cached': cached
+            })
 
     except Exception as e:
         app.logger.error(f"Recommendation error: {str(e)}")
+        if session_id:
+            finish_recommendation(session_id)
+        status, headers = upstream_error_status(e)
         return jsonify({
             'status': 'error',
             'message': f"Failed to generate recommendation: {str(e)}"
-        }), 500
+        }), status, headers
+
+@app.route('/get_recommendation/stream', methods=['POST'])
+def get_recommendation_stream():
+    """Stream the recommendation as Server-Sent Events, session ID first"""
+    with request_timing.span('parse'):
+        form_data = parse_recommendation_form()
+
+    # Validate form data before opening the stream
+    with request_timing.span('validate'):
+        is_valid, message = validate_form_data(form_data)
+    if not is_valid:
+        return jsonify({'status': 'error', 'message': message}), 400
+
+    # A repeat of a keyed stream that already finished is replayed as a single delta
+    claim, response = claim_idempotency_key()
+    if response is not None:
+        return response
+
+    with request_timing.span('prompt'):
+        language = form_data.get('language', 'English')
+        prompt = construct_base_prompt(form_data, language)
+    with request_timing.span('session'):
+        session_id = create_session(form_data)
+        session_token = issue_session_token(form_data)
+    tier = router.route('recommendation')
+    cache_key = recommendation_key(form_data, router.tiers[tier])
+    session_event = {'session_id': session_id, 'session_token': session_token}
+
+    def generate():
+        status = 'success'
+        flight, pending = None, True
+        try:
+            # Inside the try, so a client gone after the session event is still cleaned up
+            yield sse_event('session', session_event)
+            with request_timing.span('cache'):
+                recommendation = recommendations.get(cache_key)
+            if recommendation is not None:
+                # Identical spec already generated: send it as a single delta
+                finish_recommendation(session_id, recommendation)
+                pending = False
+                if claim is not None:
+                    complete_idempotent_stream(claim, ('session', session_event),
+                                               ('delta', {'text': recommendation}),
+                                               ('done', {'status': 'success', 'cached': True}))
+                yield sse_event('delta', {'text': recommendation})
+                yield sse_event('done', {'status': 'success', 'cached': True})
+                return
+
+            # Subscribe to the shared token stream for this spec, starting it if needed
+            flight, leader = inflight.acquire(cache_key)
+            if leader:
+                usage = usage_labels('get_recommendation_stream', session_id, form_data, language)
+                inflight.run_in_background(
+                    flight, lambda: generate_recommendation(
+                        form_data, language, prompt, cache_key, tier, usage, stream=True
+                    )
+                )
+
+            parts = []
+            for text in timed_stream(flight):
+                parts.append(text)
+                yield sse_event('delta', {'text': text})
+
+            # Store the assembled recommendation once the stream completes
+            with request_timing.span('session'):
+                recommendation = ''.join(parts)
+                finish_recommendation(session_id, recommendation)
+                pending = False
+            if claim is not None:
+                complete_idempotent_stream(claim, ('session', session_event),
+                                           ('delta', {'text': recommendation}),
+                                           ('done', {'status': 'success', 'cached': False}))
+            yield sse_event('done', {'status': 'success', 'cached': False})
+
+        except GeneratorExit:
+            # The client disconnected (or resubmitted): the shared generation stops once nobody reads it
+            status = 'cancelled'
+            stream_disconnects.inc(endpoint='get_recommendation_stream')
+            if pending:
+                finish_recommendation(session_id)
+            raise
+        except Exception as e:
+            status = 'error'
+            app.logger.error(f"Recommendation stream error: {str(e)}")
+            finish_recommendation(session_id)
+            yield sse_event('error', {
+                'status': 'error',
+                'message': f"Failed to generate recommendation: {str(e)}"
+            })
+        finally:
+            if flight is not None:
+                inflight.leave(flight)
+            if claim is not None and pending:
+                idempotency_keys.release(claim[0])
+            log_stream_timing(status)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/jobs/recommendation', methods=['POST'])
+def create_recommendation_job():
+    """Queue a recommendation and return its job and session IDs at once"""
+    form_data = parse_recommendation_form()
+    is_valid, message = validate_form_data(form_data)
+    if not is_valid:
+        return jsonify({'status': 'error', 'message': message}), 400
+
+    language = form_data.get('language', 'English')
+    prompt = construct_base_prompt(form_data, language)
+    session_id = create_session(form_data)
+    job = job_store.create(kind='recommendation', session_id=session_id)
+    job_id = job['job_id']
+
+    if not job_queue.submit(run_recommendation_job, job_id, session_id, form_data, language,
+                            prompt, router.route('recommendation')):
+        finish_recommendation(session_id)
+        job_store.update(job_id, status=jobs.FAILED, error_status=503, message='Job queue is full')
+        return jsonify({'status': 'error', 'message': 'Too many queued recommendations'}), 503, {'Retry-After': '5'}
+
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job_id,
+        'session_id': session_id,
+        'session_token': issue_session_token(form_data),
+        'poll_url': url_for('get_job', job_id=job_id),
+        'events_url': url_for('job_events', job_id=job_id)
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return a job's state; ?wait=N long-polls up to N seconds for it to finish"""
+    try:
+        wait = min(float(request.args.get('wait') or 0), JOB_LONG_POLL_MAX)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid wait'}), 400
+    job = job_store.wait(job_id, wait) if wait > 0 else job_store.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+    return jsonify({'status': 'success', 'job': job})
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream a job's status changes, then its result, as Server-Sent Events"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+
+    def generate():
+        current, seen = job, None
+        while True:
+            if current is None:
+                yield sse_event('error', {'status': 'error', 'message': 'Job expired'})
+                return
+            if current['status'] != seen:
+                seen = current['status']
+                yield sse_event('status', {'job_id': job_id, 'status': seen})
+            if seen == jobs.SUCCEEDED:
+                yield sse_event('result', {
+                    'recommendation': current['recommendation'],
+                    'session_id': current['session_id'],
+                    'cached': current['cached']
+                })
+                yield sse_event('done', {'status': 'success'})
+                return
+            if seen == jobs.FAILED:
+                yield sse_event('error', {'status': 'error', 'message': current['message']})
+                return
+            current = job_store.wait(job_id, JOB_EVENTS_KEEPALIVE, seen)
+            if current is not None and current['status'] == seen:
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/ask_question', methods=['POST'])
+@idempotent
 def ask_question():
     try:
-        question = request.form.get('question', '').strip()
-        session_id = request.form.get('session_id', '').strip()
-        language = request.form.get('language', 'English')
+        with request_timing.span('parse'):
+            question = request.form.get('question', '').strip()
+            session_id = request.form.get('session_id', '').strip()
+            session_token = request.form.get('session_token', '').strip()
+            language = request.form.get('language', 'English')
 
-        if not question or not session_id:
+        if not question or not (session_id or session_token):
             return jsonify({'status': 'error', 'message': 'Missing parameters'}), 400
 
-        session = conversation_history.get(session_id)
-        if not session:
+        with request_timing.span('session'):
+            session, context = resolve_follow_up(session_id, session_token)
+        if not context:
             return jsonify({'status': 'error', 'message': 'Invalid session'}), 404
+        if session and session.get('status') == 'pending':
+            return jsonify({'status': 'error', 'message': 'Recommendation still in progress'}), 409
 
         # Construct follow-up prompt with full context
-        context = session['context']
-        follow_up_prompt = f"""
-        Packaging Expert Context:
-        - Product: {context['product_category']}
-        - Structure: {context['layer_structure']} layers
-        - Materials: {context['packaging_material']} base
-        - Printing: {context['printing_type']}
-        - Barriers: {', '.join(context.get('barrier_requirements', []))}
-        - Sustainability: {', '.join(context.get('sustainability_options', []))}
-        
-        User Question: "{question}"
-        
-        Required Answer Format:
-        - Technical depth with material science principles
-        - Reference industry standards (ISO, ASTM)
-        - Compare alternatives if relevant
-        - Highlight cost-performance tradeoffs
-        - Language: {language}
-        
-        Structure Response As:
-        📌 **Key Analysis**: [Core technical explanation]
-        🔍 **Considerations**: [Critical factors]
-        💡 **Recommendation**: [Expert opinion]
-        """
-
-        # Generate answer
-        model = genai.GenerativeModel(
-            model_name='gemini-1.5-pro',
-            generation_config=GENERATION_CONFIG,
-            safety_settings=SAFETY_SETTINGS
-        )
-        
-        response = model.generate_content(follow_up_prompt)
-        answer = response.text
+        with request_timing.span('prompt'):
+            follow_up_prompt = construct_follow_up_prompt(context, question, language)
+
+        # Generate answer on the tier routed for this question
+        with request_timing.span('upstream'):
+            answer, tier = answer_follow_up(
+                follow_up_prompt,
+                router.route('follow_up', question),
+                usage_labels('ask_question', session_id, context, language)
+            )
 
         # Update conversation history
-        session['chat_history'].extend([
-            {'role': 'user', 'content': question},
-            {'role': 'assistant', 'content': answer}
-        ])
+        with request_timing.span('session'):
+            record_follow_up(session_id, question, answer)
 
-        return jsonify({
-            'status': 'success',
-            'answer': answer
-        })
+        with request_timing.span('serialize'):
+            return jsonify({
+                'status': 'success',
+                'answer': answer,
+                'tier': tier
+            })
 
     except Exception as e:
         app.logger.error(f"Question error: {str(e)}")
+        status, headers = upstream_error_status(e)
         return jsonify({
             'status': 'error',
             'message': f"Failed to process question: {str(e)}"
-        }), 500
+        }), status, headers
+
+@app.route('/ask_question/stream', methods=['POST'])
+def ask_question_stream():
+    """Stream a follow-up answer as Server-Sent Events"""
+    with request_timing.span('parse'):
+        question = request.form.get('question', '').strip()
+        session_id = request.form.get('session_id', '').strip()
+        session_token = request.form.get('session_token', '').strip()
+        language = request.form.get('language', 'English')
+
+    if not question or not (session_id or session_token):
+        return jsonify({'status': 'error', 'message': 'Missing parameters'}), 400
+
+    with request_timing.span('session'):
+        session, context = resolve_follow_up(session_id, session_token)
+    if not context:
+        return jsonify({'status': 'error', 'message': 'Invalid session'}), 404
+    if session and session.get('status') == 'pending':
+        return jsonify({'status': 'error', 'message': 'Recommendation still in progress'}), 409
+
+    # A repeat of a keyed stream that already finished is replayed as a single delta
+    claim, response = claim_idempotency_key()
+    if response is not None:
+        return response
+
+    with request_timing.span('prompt'):
+        follow_up_prompt = construct_follow_up_prompt(context, question, language)
+
+    def generate():
+        status = 'success'
+        chunks, completed = None, False
+        try:
+            upstream_started = time.perf_counter()
+            usage = usage_labels('ask_question_stream', session_id, context, language)
+            tier = router.route('follow_up', question)
+            parts = []
+            chunks = stream_model(follow_up_prompt, tier, FOLLOW_UP_DEADLINE, usage)
+            for text in timed_stream(chunks, upstream_started):
+                parts.append(text)
+                yield sse_event('delta', {'text': text})
+
+            reason = router.escalation_reason(tier, ''.join(parts), language)
+            if reason:
+                # Tell the client to discard the streamed answer, then stream the large model's
+                router.record_escalation('ask_question_stream', reason)
+                tier = router.escalation_tier
+                yield sse_event('reset', {'reason': reason, 'tier': tier})
+                parts = []
+                chunks = stream_model(follow_up_prompt, tier, FOLLOW_UP_DEADLINE, usage)
+                for text in timed_stream(chunks):
+                    parts.append(text)
+                    yield sse_event('delta', {'text': text})
+
+            # Only a completed answer becomes part of the conversation
+            with request_timing.span('session'):
+                answer = ''.join(parts)
+                record_follow_up(session_id, question, answer)
+            if claim is not None:
+                complete_idempotent_stream(claim, ('delta', {'text': answer}),
+                                           ('done', {'status': 'success', 'tier': tier}))
+            completed = True
+            yield sse_event('done', {'status': 'success', 'tier': tier})
+
+        except GeneratorExit:
+            # The client disconnected: stop the upstream stream and record no turn
+            status = 'cancelled'
+            stream_disconnects.inc(endpoint='ask_question_stream')
+            if chunks is not None:
+                chunks.close()
+            raise
+        except Exception as e:
+            status = 'error'
+            app.logger.error(f"Question stream error: {str(e)}")
+            yield sse_event('error', {
+                'status': 'error',
+                'message': f"Failed to process question: {str(e)}"
+            })
+        finally:
+            if claim is not None and not completed:
+                idempotency_keys.release(claim[0])
+            log_stream_timing(status)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 if __name__ == '__main__':
     app.run(debug=True)
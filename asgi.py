@@ -0,0 +1,733 @@
+"""ASGI entry point: LLM and long-lived endpoints on an event loop, everything else via the Flask app
+
+The LLM endpoints (POST /get_recommendation and /ask_question and their
+SSE streams) and the job long-poll and event stream are served by
+coroutines that await generate_content_async and the stores' async
+waits, so slow upstream calls and idle streams multiplex on one event
+loop per worker instead of each pinning a thread. Every other route runs
+on the unchanged Flask app through a WSGI bridge, whose ASGI_WSGI_THREADS
+threads then only serve short requests.
+
+    gunicorn -k uvicorn.workers.UvicornWorker --workers 4 --bind 0.0.0.0:8000 asgi:app
+    uvicorn asgi:app --workers 4
+
+gunicorn empties METRICS_DIR on start (gunicorn.conf.py); under plain
+uvicorn, empty it before starting the server.
+"""
+import asyncio
+import contextlib
+import io
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from flask import g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+import admission
+import app as application
+import idempotency
+import model_registry
+import request_timing
+import singleflight
+from app import (
+    FOLLOW_UP_DEADLINE, GENERATION_CONFIG, RECOMMENDATION_DEADLINE, RECOMMENDATION_SECTIONS,
+    SAFETY_SETTINGS, SECTIONED_RECOMMENDATIONS, TOKEN_ESTIMATE,
+    recommendations, router, sse_event, token_ledger, upstream,
+)
+
+flask_app = application.app
+
+# Threads serving the WSGI routes (Flask views that still block)
+wsgi = WSGIMiddleware(flask_app, workers=int(os.getenv("ASGI_WSGI_THREADS", "10")))
+
+# Coalesce identical in-flight recommendations on this worker's event loop
+inflight = singleflight.AsyncSingleFlight()
+application.coalescers.append(inflight)
+
+
+async def call_model(prompt, tier, deadline, usage):
+    """Await a complete answer from a model tier and record its token usage"""
+    model_name = router.tiers[tier]
+    model = model_registry.get_model(model_name, GENERATION_CONFIG, SAFETY_SETTINGS)
+    estimated = None
+    if TOKEN_ESTIMATE:
+        estimated = await asyncio.to_thread(application.estimate_prompt_tokens, model, prompt)
+    response = await upstream.agenerate(model, prompt, deadline, priority=application.upstream_priority(usage))
+    token_ledger.record(model_name, response.usage_metadata, estimated_prompt_tokens=estimated, **usage)
+    return response.text
+
+
+async def stream_model(prompt, tier, deadline, usage):
+    """Async app.stream_model: yield text deltas as they arrive and record token usage at the end"""
+    model_name = router.tiers[tier]
+    model = model_registry.get_model(model_name, GENERATION_CONFIG, SAFETY_SETTINGS)
+    estimated = None
+    if TOKEN_ESTIMATE:
+        estimated = await asyncio.to_thread(application.estimate_prompt_tokens, model, prompt)
+    response = await upstream.agenerate(model, prompt, deadline, stream=True,
+                                        priority=application.upstream_priority(usage))
+    try:
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. finish metadata) carry no delta
+                continue
+            if text:
+                yield text
+    except (GeneratorExit, asyncio.CancelledError):
+        # Nobody is reading any more: stop the upstream stream instead of draining it
+        await response.acancel()
+        application.upstream_cancellations.inc(model=model_name)
+        raise
+    finally:
+        token_ledger.record(model_name, response.usage_metadata, estimated_prompt_tokens=estimated, **usage)
+
+
+async def timed_stream(chunks, started=None):
+    """Async app.timed_stream: pass chunks through, recording upstream time-to-first-token and total"""
+    started = started or time.perf_counter()
+    waiting = time.perf_counter() - started
+    first = True
+    iterator = chunks.__aiter__()
+    while True:
+        wait_started = time.perf_counter()
+        try:
+            text = await anext(iterator)
+        except StopAsyncIteration:
+            waiting += time.perf_counter() - wait_started
+            break
+        waiting += time.perf_counter() - wait_started
+        if first:
+            request_timing.record('upstream_ttft', time.perf_counter() - started)
+            first = False
+        yield text
+    request_timing.record('upstream', waiting)
+
+
+async def answer_follow_up(prompt, tier, usage):
+    """Async answer_follow_up: escalate to the large model if the answer fails the quality check"""
+    answer = await call_model(prompt, tier, FOLLOW_UP_DEADLINE, usage)
+    reason = router.escalation_reason(tier, answer, usage['language'])
+    if reason is None:
+        return answer, tier
+    router.record_escalation(usage['endpoint'], reason)
+    tier = router.escalation_tier
+    return await call_model(prompt, tier, FOLLOW_UP_DEADLINE, usage), tier
+
+
+async def generate_recommendation(form_data, language, prompt, cache_key, tier, usage):
+    """Generate (sections concurrently in sectioned mode) and cache a recommendation"""
+    if SECTIONED_RECOMMENDATIONS:
+        expires = time.monotonic() + RECOMMENDATION_DEADLINE
+        heading = RECOMMENDATION_SECTIONS[0][0]
+        structure_prompt = application.construct_section_prompt(form_data, language, RECOMMENDATION_SECTIONS[0])
+        structure = application.with_heading(
+            heading, await call_model(structure_prompt, tier, RECOMMENDATION_DEADLINE, usage)
+        )
+        remaining = max(expires - time.monotonic(), 0)
+        sections = await asyncio.gather(*[
+            call_model(
+                application.construct_section_prompt(form_data, language, section, structure),
+                tier, remaining, usage
+            )
+            for section in RECOMMENDATION_SECTIONS[1:]
+        ])
+        recommendation = structure + ''.join(
+            "\n\n" + application.with_heading(heading, text)
+            for (heading, _), text in zip(RECOMMENDATION_SECTIONS[1:], sections)
+        )
+    else:
+        recommendation = await call_model(prompt, tier, RECOMMENDATION_DEADLINE, usage)
+    recommendations.set(cache_key, recommendation)
+    return recommendation
+
+
+async def stream_recommendation(form_data, language, prompt, cache_key, tier, usage):
+    """Async app.generate_recommendation(stream=True): yield text as it arrives, then cache it whole"""
+    if SECTIONED_RECOMMENDATIONS:
+        chunks = stream_sections(form_data, language, tier, usage)
+    else:
+        chunks = stream_model(prompt, tier, RECOMMENDATION_DEADLINE, usage)
+    parts = []
+    async with contextlib.aclosing(chunks):
+        async for text in chunks:
+            parts.append(text)
+            yield text
+    recommendations.set(cache_key, ''.join(parts))
+
+
+async def stream_sections(form_data, language, tier, usage):
+    """Async app.generate_sections(stream=True): the structure as it streams, then each section in order"""
+    expires = time.monotonic() + RECOMMENDATION_DEADLINE
+    heading = RECOMMENDATION_SECTIONS[0][0]
+    structure_prompt = application.construct_section_prompt(form_data, language, RECOMMENDATION_SECTIONS[0])
+    parts = []
+    async with contextlib.aclosing(stream_model(structure_prompt, tier, RECOMMENDATION_DEADLINE, usage)) as chunks:
+        async for text in chunks:
+            if not parts and not text.lstrip().startswith('#'):
+                text = f"{heading}\n{text}"
+            parts.append(text)
+            yield text
+    structure = ''.join(parts)
+
+    remaining = max(expires - time.monotonic(), 0)
+    tasks = [
+        asyncio.ensure_future(call_model(
+            application.construct_section_prompt(form_data, language, section, structure),
+            tier, remaining, usage
+        ))
+        for section in RECOMMENDATION_SECTIONS[1:]
+    ]
+    try:
+        for (heading, _), task in zip(RECOMMENDATION_SECTIONS[1:], tasks):
+            yield "\n\n" + application.with_heading(heading, await task)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def event_stream(body):
+    """A text/event-stream response whose body, an async generator, serve_async_view streams"""
+    response = flask_app.response_class(
+        iter(()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.async_body = body
+    return response
+
+
+async def resolve_follow_up(session_id, session_token):
+    """Async app.resolve_follow_up: a pending recommendation is awaited on the event loop"""
+    if application.STATELESS_SESSIONS and session_token:
+        # Only verifies the token, it never waits
+        return application.resolve_follow_up(session_id, session_token)
+    session = await wait_for_recommendation(session_id) if session_id else None
+    if not session:
+        return None, None
+    return session, session['context']
+
+
+async def wait_for_recommendation(session_id):
+    """Async app.wait_for_recommendation, woken by finish_recommendation or the store poll"""
+    deadline = time.monotonic() + application.FOLLOW_UP_WAIT_TIMEOUT
+    condition = application.session_conditions.condition_for(session_id)
+    while True:
+        session = await asyncio.to_thread(application.conversation_history.get, session_id)
+        if session is None or session.get('status') != 'pending':
+            return session
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return session
+        await condition.wait_async(min(remaining, 0.25))
+
+
+async def claim_idempotency_key():
+    """Async app.claim_idempotency_key: a repeat awaits its in-flight original on the event loop"""
+    claim, response = application.idempotency_claim()
+    if claim is None:
+        return None, response
+    try:
+        record = await application.idempotency_keys.aclaim(*claim, timeout=application.idempotency_wait())
+    except idempotency.IdempotencyConflict as e:
+        return application.idempotency_conflict(e)
+    return application.idempotency_outcome(claim, record)
+
+
+async def get_recommendation():
+    session_id = None
+    try:
+        with request_timing.span('parse'):
+            form_data = application.parse_recommendation_form()
+        with request_timing.span('validate'):
+            is_valid, message = application.validate_form_data(form_data)
+        if not is_valid:
+            return jsonify({'status': 'error', 'message': message}), 400
+
+        with request_timing.span('prompt'):
+            language = form_data.get('language', 'English')
+            prompt = application.construct_base_prompt(form_data, language)
+        # Session stores may do blocking I/O (sqlite, redis): keep it off the event loop
+        with request_timing.span('session'):
+            session_id = await asyncio.to_thread(application.create_session, form_data)
+
+        with request_timing.span('cache'):
+            tier = router.route('recommendation')
+            cache_key = application.recommendation_key(form_data, router.tiers[tier])
+            recommendation = recommendations.get(cache_key)
+        cached = recommendation is not None
+
+        if not cached:
+            with request_timing.span('upstream'):
+                usage = application.usage_labels('get_recommendation', session_id, form_data, language)
+                recommendation = await inflight.run(cache_key, lambda: generate_recommendation(
+                    form_data, language, prompt, cache_key, tier, usage
+                ))
+
+        with request_timing.span('session'):
+            await asyncio.to_thread(application.finish_recommendation, session_id, recommendation)
+        with request_timing.span('serialize'):
+            return jsonify({
+                'status': 'success',
+                'recommendation': recommendation,
+                'session_id': session_id,
+                'session_token': application.issue_session_token(form_data),
+                'cached': cached
+            })
+
+    except Exception as e:
+        flask_app.logger.error(f"Recommendation error: {str(e)}")
+        if session_id:
+            await asyncio.to_thread(application.finish_recommendation, session_id)
+        status, headers = application.upstream_error_status(e)
+        return jsonify({
+            'status': 'error',
+            'message': f"Failed to generate recommendation: {str(e)}"
+        }), status, headers
+
+
+async def ask_question():
+    try:
+        with request_timing.span('parse'):
+            question = request.form.get('question', '').strip()
+            session_id = request.form.get('session_id', '').strip()
+            session_token = request.form.get('session_token', '').strip()
+            language = request.form.get('language', 'English')
+
+        if not question or not (session_id or session_token):
+            return jsonify({'status': 'error', 'message': 'Missing parameters'}), 400
+
+        # May wait for the session's recommendation to finish generating
+        with request_timing.span('session'):
+            session, context = await resolve_follow_up(session_id, session_token)
+        if not context:
+            return jsonify({'status': 'error', 'message': 'Invalid session'}), 404
+        if session and session.get('status') == 'pending':
+            return jsonify({'status': 'error', 'message': 'Recommendation still in progress'}), 409
+
+        with request_timing.span('prompt'):
+            follow_up_prompt = application.construct_follow_up_prompt(context, question, language)
+
+        with request_timing.span('upstream'):
+            answer, tier = await answer_follow_up(
+                follow_up_prompt,
+                router.route('follow_up', question),
+                application.usage_labels('ask_question', session_id, context, language)
+            )
+
+        with request_timing.span('session'):
+            await asyncio.to_thread(application.record_follow_up, session_id, question, answer)
+
+        with request_timing.span('serialize'):
+            return jsonify({
+                'status': 'success',
+                'answer': answer,
+                'tier': tier
+            })
+
+    except Exception as e:
+        flask_app.logger.error(f"Question error: {str(e)}")
+        status, headers = application.upstream_error_status(e)
+        return jsonify({
+            'status': 'error',
+            'message': f"Failed to process question: {str(e)}"
+        }), status, headers
+
+
+async def get_recommendation_stream():
+    """Async app.get_recommendation_stream: the SSE stream is produced on the event loop"""
+    with request_timing.span('parse'):
+        form_data = application.parse_recommendation_form()
+    with request_timing.span('validate'):
+        is_valid, message = application.validate_form_data(form_data)
+    if not is_valid:
+        return jsonify({'status': 'error', 'message': message}), 400
+
+    # A repeat of a keyed stream that already finished is replayed as a single delta
+    claim, response = await claim_idempotency_key()
+    if response is not None:
+        return response
+
+    with request_timing.span('prompt'):
+        language = form_data.get('language', 'English')
+        prompt = application.construct_base_prompt(form_data, language)
+    with request_timing.span('session'):
+        session_id = await asyncio.to_thread(application.create_session, form_data)
+        session_token = application.issue_session_token(form_data)
+    tier = router.route('recommendation')
+    cache_key = application.recommendation_key(form_data, router.tiers[tier])
+    session_event = {'session_id': session_id, 'session_token': session_token}
+
+    async def finish(recommendation, cached):
+        with request_timing.span('session'):
+            await asyncio.to_thread(application.finish_recommendation, session_id, recommendation)
+        if claim is not None:
+            await asyncio.to_thread(application.complete_idempotent_stream, claim,
+                                    ('session', session_event), ('delta', {'text': recommendation}),
+                                    ('done', {'status': 'success', 'cached': cached}))
+
+    async def generate():
+        status = 'success'
+        flight, pending = None, True
+        try:
+            yield sse_event('session', session_event)
+            with request_timing.span('cache'):
+                recommendation = recommendations.get(cache_key)
+            if recommendation is not None:
+                # Identical spec already generated: send it as a single delta
+                await finish(recommendation, True)
+                pending = False
+                yield sse_event('delta', {'text': recommendation})
+                yield sse_event('done', {'status': 'success', 'cached': True})
+                return
+
+            # Subscribe to the shared token stream for this spec, starting it if needed
+            flight, leader = inflight.acquire(cache_key)
+            if leader:
+                usage = application.usage_labels('get_recommendation_stream', session_id, form_data, language)
+                inflight.start(flight, lambda: stream_recommendation(
+                    form_data, language, prompt, cache_key, tier, usage
+                ))
+
+            parts = []
+            async for text in timed_stream(flight):
+                parts.append(text)
+                yield sse_event('delta', {'text': text})
+
+            await finish(''.join(parts), False)
+            pending = False
+            yield sse_event('done', {'status': 'success', 'cached': False})
+
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client disconnected (or resubmitted): the shared generation stops once nobody reads it
+            status = 'cancelled'
+            application.stream_disconnects.inc(endpoint='get_recommendation_stream')
+            if pending:
+                await asyncio.to_thread(application.finish_recommendation, session_id)
+            raise
+        except Exception as e:
+            status = 'error'
+            flask_app.logger.error(f"Recommendation stream error: {str(e)}")
+            await asyncio.to_thread(application.finish_recommendation, session_id)
+            yield sse_event('error', {
+                'status': 'error',
+                'message': f"Failed to generate recommendation: {str(e)}"
+            })
+        finally:
+            if flight is not None:
+                inflight.leave(flight)
+            if claim is not None and pending:
+                await asyncio.to_thread(application.idempotency_keys.release, claim[0])
+            application.log_stream_timing(status)
+
+    return event_stream(generate())
+
+
+async def ask_question_stream():
+    """Async app.ask_question_stream: the SSE stream is produced on the event loop"""
+    with request_timing.span('parse'):
+        question = request.form.get('question', '').strip()
+        session_id = request.form.get('session_id', '').strip()
+        session_token = request.form.get('session_token', '').strip()
+        language = request.form.get('language', 'English')
+
+    if not question or not (session_id or session_token):
+        return jsonify({'status': 'error', 'message': 'Missing parameters'}), 400
+
+    with request_timing.span('session'):
+        session, context = await resolve_follow_up(session_id, session_token)
+    if not context:
+        return jsonify({'status': 'error', 'message': 'Invalid session'}), 404
+    if session and session.get('status') == 'pending':
+        return jsonify({'status': 'error', 'message': 'Recommendation still in progress'}), 409
+
+    # A repeat of a keyed stream that already finished is replayed as a single delta
+    claim, response = await claim_idempotency_key()
+    if response is not None:
+        return response
+
+    with request_timing.span('prompt'):
+        follow_up_prompt = application.construct_follow_up_prompt(context, question, language)
+
+    async def generate():
+        status = 'success'
+        chunks, completed = None, False
+        try:
+            upstream_started = time.perf_counter()
+            usage = application.usage_labels('ask_question_stream', session_id, context, language)
+            tier = router.route('follow_up', question)
+            parts = []
+            chunks = stream_model(follow_up_prompt, tier, FOLLOW_UP_DEADLINE, usage)
+            async for text in timed_stream(chunks, upstream_started):
+                parts.append(text)
+                yield sse_event('delta', {'text': text})
+
+            reason = router.escalation_reason(tier, ''.join(parts), language)
+            if reason:
+                # Tell the client to discard the streamed answer, then stream the large model's
+                router.record_escalation('ask_question_stream', reason)
+                tier = router.escalation_tier
+                yield sse_event('reset', {'reason': reason, 'tier': tier})
+                parts = []
+                chunks = stream_model(follow_up_prompt, tier, FOLLOW_UP_DEADLINE, usage)
+                async for text in timed_stream(chunks):
+                    parts.append(text)
+                    yield sse_event('delta', {'text': text})
+
+            # Only a completed answer becomes part of the conversation
+            answer = ''.join(parts)
+            with request_timing.span('session'):
+                await asyncio.to_thread(application.record_follow_up, session_id, question, answer)
+            if claim is not None:
+                await asyncio.to_thread(application.complete_idempotent_stream, claim,
+                                        ('delta', {'text': answer}),
+                                        ('done', {'status': 'success', 'tier': tier}))
+            completed = True
+            yield sse_event('done', {'status': 'success', 'tier': tier})
+
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client disconnected: stop the upstream stream and record no turn
+            status = 'cancelled'
+            application.stream_disconnects.inc(endpoint='ask_question_stream')
+            if chunks is not None:
+                await chunks.aclose()
+            raise
+        except Exception as e:
+            status = 'error'
+            flask_app.logger.error(f"Question stream error: {str(e)}")
+            yield sse_event('error', {
+                'status': 'error',
+                'message': f"Failed to process question: {str(e)}"
+            })
+        finally:
+            if claim is not None and not completed:
+                await asyncio.to_thread(application.idempotency_keys.release, claim[0])
+            application.log_stream_timing(status)
+
+    return event_stream(generate())
+
+
+async def get_job(job_id):
+    """Async app.get_job: a ?wait= long-poll waits on the event loop"""
+    try:
+        wait = min(float(request.args.get('wait') or 0), application.JOB_LONG_POLL_MAX)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid wait'}), 400
+    if wait > 0:
+        job = await application.job_store.wait_async(job_id, wait)
+    else:
+        job = await asyncio.to_thread(application.job_store.get, job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+    return jsonify({'status': 'success', 'job': job})
+
+
+async def job_events(job_id):
+    """Async app.job_events: an idle job stream holds no thread between status changes"""
+    job = await asyncio.to_thread(application.job_store.get, job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Unknown or expired job'}), 404
+
+    async def generate():
+        current, seen = job, None
+        while True:
+            if current is None:
+                yield sse_event('error', {'status': 'error', 'message': 'Job expired'})
+                return
+            if current['status'] != seen:
+                seen = current['status']
+                yield sse_event('status', {'job_id': job_id, 'status': seen})
+            if seen == application.jobs.SUCCEEDED:
+                yield sse_event('result', {
+                    'recommendation': current['recommendation'],
+                    'session_id': current['session_id'],
+                    'cached': current['cached']
+                })
+                yield sse_event('done', {'status': 'success'})
+                return
+            if seen == application.jobs.FAILED:
+                yield sse_event('error', {'status': 'error', 'message': current['message']})
+                return
+            current = await application.job_store.wait_async(job_id, application.JOB_EVENTS_KEEPALIVE, seen)
+            if current is not None and current['status'] == seen:
+                yield ": keep-alive\n\n"
+
+    return event_stream(generate())
+
+
+async def admit_request():
+    """Async app.admit_request: queue for an admission slot on the event loop"""
+    try:
+        permit = await application.admission_control.aacquire(*application.admission_identity())
+    except admission.AdmissionRejected as e:
+        return application.reject_admission(e)
+    application.hold_permit(permit)
+    return None
+
+
+def idempotent(view):
+    """Async counterpart of app.idempotent; the key store is consulted off the event loop"""
+    async def wrapper(**view_args):
+        claim, response = await claim_idempotency_key()
+        if response is not None:
+            return response
+        if claim is None:
+            return await view(**view_args)
+        response = None
+        try:
+            response = flask_app.make_response(await view(**view_args))
+            return response
+        finally:
+            await asyncio.to_thread(application.settle_idempotency_key, claim, response)
+    return wrapper
+
+
+# Flask endpoints served by coroutines instead of through the WSGI bridge
+ASYNC_VIEWS = {
+    'get_recommendation': idempotent(get_recommendation),
+    'get_recommendation_stream': get_recommendation_stream,
+    'ask_question': idempotent(ask_question),
+    'ask_question_stream': ask_question_stream,
+    'get_job': get_job,
+    'job_events': job_events,
+}
+
+# Routes requests to endpoints the way the Flask app will, before any request context exists
+url_adapter = flask_app.url_map.bind('localhost')
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP request, so Flask can parse forms and run its hooks"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def stream_body(body, send, receive):
+    """Send an async body as it is produced, stopping it as soon as the client disconnects"""
+    async def pump():
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    # The pump is scheduled first, so the body has entered its try before any disconnect cancels it
+    sending = asyncio.ensure_future(pump())
+    watching = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({sending, watching}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watching.cancel()
+        if not sending.done():
+            # Raises CancelledError inside the body, which handles it as a disconnect
+            sending.cancel()
+        await asyncio.gather(sending, return_exceptions=True)
+        await body.aclose()
+    if not sending.cancelled() and sending.exception() is not None:
+        raise sending.exception()
+
+
+async def serve_async_view(view, scope, receive, send):
+    """Run an async view inside a Flask request context, with the app's before/after hooks"""
+    environ = build_environ(scope, await read_body(receive))
+    environ['admission.deferred'] = True
+    with flask_app.request_context(environ):
+        response = None
+        try:
+            # Request timing, metrics and traffic capture run exactly as for Flask views,
+            # and errors become responses the way Flask's full_dispatch_request makes them
+            try:
+                try:
+                    rv = flask_app.preprocess_request()
+                    if rv is None and request.endpoint in application.LLM_ENDPOINTS:
+                        rv = await admit_request()
+                    if rv is None:
+                        rv = await view(**request.view_args)
+                except Exception as e:
+                    rv = flask_app.handle_user_exception(e)
+                response = flask_app.finalize_request(rv)
+            except Exception as e:
+                response = flask_app.handle_exception(e)
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response.headers.items()],
+            })
+            body = getattr(response, 'async_body', None)
+            if body is None:
+                await send({'type': 'http.response.body', 'body': response.get_data()})
+            else:
+                await stream_body(body, send, receive)
+        finally:
+            # Release the admission permit even if the client went away mid-send
+            if response is not None:
+                response.close()
+            permit = g.pop('admission_permit', None)
+            if permit:
+                permit.release()
+
+def match_async_view(scope):
+    """The coroutine serving an HTTP request, or None to hand it to the Flask app"""
+    try:
+        endpoint, _ = url_adapter.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return None
+    return ASYNC_VIEWS.get(endpoint)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    view = match_async_view(scope) if scope['type'] == 'http' else None
+    if view is None:
+        await wsgi(scope, receive, send)
+        return
+    await serve_async_view(view, scope, receive, send)
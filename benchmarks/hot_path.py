@@ -0,0 +1,159 @@
+"""Micro-benchmarks for the pure-Python per-request work in app.py
+
+Times form parsing, validation, prompt construction, cache-key
+canonicalization, session creation and serialization of an 8k-token answer
+without any network or LLM call, and writes the statistics as JSON so runs
+can be compared as the request path changes.
+
+Examples:
+    python benchmarks/hot_path.py
+    python benchmarks/hot_path.py --repeat 15 --output baseline.json
+    python benchmarks/hot_path.py --compare baseline.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+# Benchmarks never talk to Gemini and keep sessions in memory
+os.environ.setdefault('LLM_BACKEND', 'stub')
+os.environ.setdefault('SESSION_BACKEND', 'memory')
+
+from flask import jsonify  # noqa: E402
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+import app as application  # noqa: E402
+
+FORM = {
+    'product_category': 'Coffee',
+    'printing_type': 'Gravure',
+    'layer_structure': '3-layer',
+    'packaging_material': 'PET',
+    'packaging_type': 'Pouch',
+    'sealing_type': 'Zipper',
+    'barrier_requirements': ['Oxygen', 'Moisture', 'Aroma'],
+    'sustainability_options': ['Recyclable', 'Mono-material'],
+    'special_features': ['Degassing valve', 'Tear notch'],
+    'shelf_life': '12 months',
+    'production_volume': '500,000 units/month',
+    'custom_requirements': 'Must  survive   nitrogen flushing and retain aroma for whole-bean coffee',
+    'language': 'English',
+}
+
+QUESTION = "What thickness should the PE sealant layer be, and can EVOH replace the metallized PET?"
+
+# Roughly 8k output tokens of markdown (about four characters per token)
+LONG_ANSWER = ("## 🔹 RECOMMENDED STRUCTURE\n" + "- PET 12µm / AL 7µm / LLDPE 70µm with solventless adhesive\n" * 560)[:32768]
+
+
+def bench_cases():
+    """Return (name, callable) pairs; each callable performs one operation"""
+    builder = EnvironBuilder(method='POST', path='/get_recommendation', data=FORM)
+    environ = builder.get_environ()
+    body = environ['wsgi.input'].read()
+
+    def parse_form():
+        # A fresh request each time, as form parsing is cached per request
+        fresh = dict(environ, **{'wsgi.input': io.BytesIO(body)})
+        with application.app.request_context(fresh):
+            application.parse_recommendation_form()
+
+    with application.app.test_request_context():
+        form_data = application.parse_recommendation_form()
+    form_data.update(FORM)
+    context = dict(form_data)
+
+    # create_session records the new ID on flask.g, so it needs a request context;
+    # one long-lived context keeps the context setup out of the measurement
+    session_context = application.app.test_request_context()
+    session_context.push()
+
+    def create_session():
+        application.create_session(form_data)
+
+    def serialize_answer():
+        with application.app.app_context():
+            jsonify({'status': 'success', 'answer': LONG_ANSWER}).get_data()
+
+    return [
+        ('parse_form', parse_form),
+        ('validate_form_data', lambda: application.validate_form_data(form_data)),
+        ('construct_base_prompt', lambda: application.construct_base_prompt(form_data, 'English')),
+        ('construct_follow_up_prompt',
+         lambda: application.construct_follow_up_prompt(context, QUESTION, 'English')),
+        ('recommendation_key', lambda: application.recommendation_key(form_data)),
+        ('create_session', create_session),
+        ('json_dumps_8k_answer', lambda: json.dumps({'status': 'success', 'answer': LONG_ANSWER})),
+        ('jsonify_8k_answer', serialize_answer),
+        ('sse_event_delta', lambda: application.sse_event('delta', {'text': LONG_ANSWER[:64]})),
+    ]
+
+
+def run_case(func, repeat, min_time):
+    """Time one case: calibrate the loop count, then collect per-op timings"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    # Scale the loop so every repeat lasts at least min_time seconds
+    probe = timer.timeit(number)
+    if probe < min_time:
+        number = max(number, int(number * min_time / max(probe, 1e-9)))
+    per_op = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    quartiles = statistics.quantiles(per_op, n=4) if len(per_op) > 1 else [per_op[0]] * 3
+    return {
+        'loops': number,
+        'repeat': repeat,
+        'min_us': min(per_op) * 1e6,
+        'median_us': statistics.median(per_op) * 1e6,
+        'mean_us': statistics.mean(per_op) * 1e6,
+        'stdev_us': (statistics.stdev(per_op) if len(per_op) > 1 else 0.0) * 1e6,
+        'iqr_us': (quartiles[2] - quartiles[0]) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=7, help='Timed repeats per case')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds per repeat')
+    parser.add_argument('--filter', help='Only run cases whose name contains this text')
+    parser.add_argument('--output', default='hot_path_results.json', help='JSON result file')
+    parser.add_argument('--compare', help='Previous JSON result file to compare medians against')
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in bench_cases():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = run_case(func, args.repeat, args.min_time)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print(f"{'case':30} {'median µs':>11} {'min µs':>10} {'stdev':>8} {'loops':>9}" + ('   vs base' if baseline else ''))
+    for name, stats in results.items():
+        line = (f"{name:30} {stats['median_us']:>11.2f} {stats['min_us']:>10.2f} "
+                f"{stats['stdev_us']:>8.2f} {stats['loops']:>9}")
+        if name in baseline:
+            line += f"   {stats['median_us'] / baseline[name]['median_us']:>6.2f}x"
+        print(line)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
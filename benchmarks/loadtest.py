@@ -0,0 +1,416 @@
+"""Load generator for /get_recommendation and /ask_question
+
+Simulates users who submit a packaging spec and then ask follow-up questions,
+following a traffic profile, or replays a traffic log captured by the app with
+TRAFFIC_LOG_PATH. Reports throughput, latency percentiles, error rates and
+per-worker memory growth.
+
+Examples:
+    # Spawn gunicorn on the offline LLM stub and run the default profile
+    python benchmarks/loadtest.py --spawn --profile steady --users 32 --duration 60
+
+    # Hit an already running deployment and write the report as JSON
+    python benchmarks/loadtest.py --url http://127.0.0.1:8000 --profile hot-spec --output report.json
+
+    # Replay captured traffic at twice the recorded speed
+    python benchmarks/loadtest.py --spawn --replay traffic.jsonl --speed 2
+
+    # Compare the sync (threaded gunicorn) and async (ASGI) servers on slow upstream calls
+    python benchmarks/loadtest.py --spawn --server sync --users 500 --server-env STUB_LATENCY=fixed:3000
+    python benchmarks/loadtest.py --spawn --server async --users 500 --server-env STUB_LATENCY=fixed:3000
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# follow_ups: mean follow-up questions per recommendation (new specs : follow-ups)
+# spec_pool / spec_skew: number of distinct specs and Zipf exponent of their reuse
+# question_words: range of follow-up question length in words
+PROFILES = {
+    'steady': {
+        'follow_ups': 2, 'spec_pool': 500, 'spec_skew': 1.0,
+        'question_words': [5, 25], 'think_time': [0.5, 2.0], 'stream': False,
+    },
+    'chat-heavy': {
+        'follow_ups': 6, 'spec_pool': 200, 'spec_skew': 1.0,
+        'question_words': [5, 40], 'think_time': [1.0, 4.0], 'stream': False,
+    },
+    'new-specs': {
+        'follow_ups': 0.2, 'spec_pool': 100000, 'spec_skew': 0.0,
+        'question_words': [5, 15], 'think_time': [0.2, 1.0], 'stream': False,
+    },
+    'hot-spec': {
+        'follow_ups': 1, 'spec_pool': 20, 'spec_skew': 1.5,
+        'question_words': [5, 15], 'think_time': [0.0, 0.5], 'stream': False,
+    },
+    'streaming': {
+        'follow_ups': 2, 'spec_pool': 500, 'spec_skew': 1.0,
+        'question_words': [5, 25], 'think_time': [0.5, 2.0], 'stream': True,
+    },
+}
+
+SPEC_OPTIONS = {
+    'product_category': ['Snacks', 'Frozen Food', 'Coffee', 'Confectionery', 'Personal Care',
+                         'Ready Meals', 'Pet Food', 'Pharmaceuticals', 'Dairy Products', 'Beverages'],
+    'printing_type': ['Gravure', 'Digital', 'Flexographic', 'Offset'],
+    'layer_structure': ['2-layer', '3-layer', '4-layer', '5-layer', '7-layer'],
+    'packaging_material': ['PE', 'PP', 'PET', 'BOPP', 'CPP', 'PA', 'EVOH', 'Aluminum', 'Paper'],
+    'packaging_type': ['Pouch', 'Sachet', 'Stick Pack', 'Flow Wrap', 'Bag', 'Tray'],
+    'sealing_type': ['Heat Seal', 'Zipper', 'Peelable', 'Ultrasonic'],
+    'barrier_requirements': ['Oxygen', 'Moisture', 'Light', 'Aroma', 'Grease', 'Puncture'],
+    'sustainability_options': ['Recyclable', 'Compostable', 'PCR', 'Mono-material'],
+}
+
+QUESTION_WORDS = (
+    "what thickness should the PE sealant layer be for a retort pouch and how does "
+    "EVOH compare with metallized PET for oxygen barrier at high humidity can we "
+    "switch to a recyclable mono-material structure without losing shelf life"
+).split()
+
+
+def make_spec(index):
+    """Deterministic form data for spec number `index` in the pool"""
+    rng = random.Random(index)
+    form = {field: rng.choice(options) for field, options in SPEC_OPTIONS.items()
+            if field not in ('barrier_requirements', 'sustainability_options')}
+    form['barrier_requirements'] = rng.sample(SPEC_OPTIONS['barrier_requirements'], rng.randint(1, 3))
+    form['sustainability_options'] = rng.sample(SPEC_OPTIONS['sustainability_options'], rng.randint(0, 2))
+    form['language'] = 'English'
+    return form
+
+
+def make_question(rng, words):
+    count = rng.randint(*words)
+    return ' '.join(rng.choice(QUESTION_WORDS) for _ in range(count)) + '?'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class Recorder:
+    """Thread-safe collection of per-request results"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.results = []
+
+    def add(self, path, status, latency, ttfb, error=None):
+        with self._lock:
+            self.results.append({
+                'path': path, 'status': status, 'latency': latency, 'ttfb': ttfb, 'error': error,
+            })
+
+    def summary(self, elapsed):
+        by_path = defaultdict(list)
+        for result in self.results:
+            by_path[result['path']].append(result)
+
+        endpoints = {}
+        for path, results in sorted(by_path.items()):
+            ok = [r for r in results if r['error'] is None]
+            latencies = [r['latency'] for r in ok]
+            ttfbs = [r['ttfb'] for r in ok if r['ttfb'] is not None]
+            statuses = defaultdict(int)
+            for r in results:
+                statuses[str(r['status'])] += 1
+            endpoints[path] = {
+                'requests': len(results),
+                'errors': len(results) - len(ok),
+                'error_rate': (len(results) - len(ok)) / len(results),
+                'statuses': dict(statuses),
+                'throughput_rps': len(results) / elapsed,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95),
+                'latency_p99': percentile(latencies, 99),
+                'ttfb_p50': percentile(ttfbs, 50),
+                'ttfb_p95': percentile(ttfbs, 95),
+                'ttfb_p99': percentile(ttfbs, 99),
+            }
+        total = len(self.results)
+        errors = sum(1 for r in self.results if r['error'] is not None)
+        return {
+            'elapsed_seconds': elapsed,
+            'requests': total,
+            'errors': errors,
+            'error_rate': errors / total if total else 0.0,
+            'throughput_rps': total / elapsed if elapsed else 0.0,
+            'endpoints': endpoints,
+        }
+
+
+def post(http, base_url, path, form, stream, recorder):
+    """POST a form, record the outcome and return the response payload (or None)"""
+    started = time.perf_counter()
+    ttfb = None
+    response = None
+    try:
+        response = http.post(base_url + path, data=form, stream=stream, timeout=600)
+        if stream and response.headers.get('Content-Type', '').startswith('text/event-stream'):
+            payload, event = {}, None
+            for line in response.iter_lines(decode_unicode=True):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:'):
+                    data = json.loads(line[5:])
+                    if event == 'session':
+                        payload.update(data)
+                    elif event == 'error':
+                        raise RuntimeError(data.get('message'))
+                    elif event == 'done':
+                        payload['status'] = 'success'
+            if payload.get('status') != 'success':
+                raise RuntimeError("Stream ended without a done event")
+        else:
+            ttfb = time.perf_counter() - started
+            payload = response.json()
+            if response.status_code != 200:
+                raise RuntimeError(payload.get('message'))
+        recorder.add(path, response.status_code, time.perf_counter() - started, ttfb)
+        return payload
+    except Exception as e:
+        status = response.status_code if response is not None else 'exception'
+        recorder.add(path, status, time.perf_counter() - started, ttfb, error=str(e))
+        return None
+
+
+def run_profile(base_url, profile, users, duration, seed, recorder):
+    """Closed-loop virtual users following a traffic profile until the duration ends"""
+    weights = [1 / (rank + 1) ** profile['spec_skew'] for rank in range(profile['spec_pool'])]
+    deadline = time.monotonic() + duration
+    suffix = '/stream' if profile['stream'] else ''
+
+    def user(user_index):
+        rng = random.Random(seed * 100003 + user_index)
+        http = requests.Session()
+        while time.monotonic() < deadline:
+            spec_index = rng.choices(range(profile['spec_pool']), weights)[0]
+            form = make_spec(spec_index)
+            result = post(http, base_url, '/get_recommendation' + suffix, form, profile['stream'], recorder)
+            if not result:
+                continue
+            follow_ups = int(profile['follow_ups']) + (rng.random() < profile['follow_ups'] % 1)
+            for _ in range(follow_ups):
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(rng.uniform(*profile['think_time']))
+                question = {
+                    'question': make_question(rng, profile['question_words']),
+                    'session_id': result.get('session_id', ''),
+                    'session_token': result.get('session_token') or '',
+                    'language': 'English',
+                }
+                post(http, base_url, '/ask_question' + suffix, question, profile['stream'], recorder)
+            time.sleep(rng.uniform(*profile['think_time']))
+
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(user, range(users)))
+
+
+def run_replay(base_url, log_path, speed, concurrency, recorder):
+    """Replay a captured traffic log with its original pacing scaled by `speed`"""
+    with open(log_path, encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if not entries:
+        return
+    entries.sort(key=lambda entry: entry['ts'])
+
+    # Recorded session IDs -> session IDs created during this replay
+    sessions = {}
+    created = defaultdict(threading.Event)
+    replayed_ids = {entry['created_session_id'] for entry in entries if entry.get('created_session_id')}
+    start_ts = entries[0]['ts']
+    started = time.monotonic()
+    local = threading.local()
+
+    def replay(entry):
+        http = getattr(local, 'http', None) or requests.Session()
+        local.http = http
+        form = dict(entry['form'])
+        recorded_session = (form.get('session_id') or [''])[0]
+        if recorded_session in replayed_ids:
+            # Follow-ups wait (bounded) for the recommendation that created their session
+            created[recorded_session].wait(timeout=120)
+            form['session_id'] = [sessions.get(recorded_session, recorded_session)]
+        stream = entry['path'].endswith('/stream')
+        result = post(http, base_url, entry['path'], form, stream, recorder)
+        if entry.get('created_session_id'):
+            if result:
+                sessions[entry['created_session_id']] = result.get('session_id')
+            created[entry['created_session_id']].set()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry in entries:
+            delay = (entry['ts'] - start_ts) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(replay, entry)
+
+
+def worker_pids(master_pid):
+    """PIDs of the master's child processes (gunicorn workers), or the master itself"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            children.append(int(entry))
+    return children or [master_pid]
+
+
+def rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# Server commands for --spawn: sync is threaded gunicorn on app:app, async the ASGI entry point
+SERVER_COMMANDS = {
+    'sync': 'exec gunicorn --workers 4 --threads 8 --bind 127.0.0.1:{port} app:app',
+    'async': 'exec gunicorn --workers 4 -k uvicorn.workers.UvicornWorker --bind 127.0.0.1:{port} asgi:app',
+}
+
+
+def spawn_server(command, port, extra_env):
+    """Start the app (gunicorn on the LLM stub by default) and wait for its port"""
+    env = dict(os.environ, LLM_BACKEND='stub')
+    env.update(extra_env)
+    process = subprocess.Popen(command.format(port=port), shell=True, cwd=PROJECT_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not start listening within 30 seconds")
+
+
+def warm_up(base_url, seconds):
+    """Hit the index page so every worker has finished importing the app"""
+    deadline = time.monotonic() + seconds
+    http = requests.Session()
+    while time.monotonic() < deadline:
+        try:
+            http.get(base_url + '/', timeout=5)
+        except requests.RequestException:
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of a running deployment')
+    parser.add_argument('--profile', default='steady', choices=sorted(PROFILES))
+    parser.add_argument('--profile-file', help='JSON file overriding profile fields')
+    parser.add_argument('--users', type=int, default=16, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to run a profile')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay', help='Traffic log captured with TRAFFIC_LOG_PATH')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier')
+    parser.add_argument('--spawn', action='store_true', help='Start a local server on the LLM stub')
+    parser.add_argument('--server', default='sync', choices=sorted(SERVER_COMMANDS),
+                        help='Server to spawn: threaded WSGI (sync) or the ASGI entry point (async)')
+    parser.add_argument('--server-cmd', help='Custom spawn command, overriding --server ({port} is filled in)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment for the spawned server (e.g. STUB_LATENCY=fixed:500)')
+    parser.add_argument('--warmup', type=float, default=3,
+                        help='Seconds of index page requests before memory is baselined')
+    parser.add_argument('--pid', type=int, help='Master PID of a running server, for memory tracking')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    profile = dict(PROFILES[args.profile])
+    if args.profile_file:
+        with open(args.profile_file) as f:
+            profile.update(json.load(f))
+
+    process = None
+    base_url, master_pid = args.url, args.pid
+    if args.spawn:
+        extra_env = dict(item.split('=', 1) for item in args.server_env)
+        command = args.server_cmd or SERVER_COMMANDS[args.server]
+        process = spawn_server(command, args.port, extra_env)
+        base_url, master_pid = f'http://127.0.0.1:{args.port}', process.pid
+
+    try:
+        warm_up(base_url, args.warmup)
+        pids = worker_pids(master_pid) if master_pid else []
+        memory_before = {pid: rss_kb(pid) for pid in pids}
+
+        recorder = Recorder()
+        started = time.monotonic()
+        if args.replay:
+            run_replay(base_url, args.replay, args.speed, args.users, recorder)
+        else:
+            run_profile(base_url, profile, args.users, args.duration, args.seed, recorder)
+        report = recorder.summary(time.monotonic() - started)
+
+        report['memory_kb'] = {
+            str(pid): {
+                'start': memory_before[pid],
+                'end': rss_kb(pid),
+                'growth': (rss_kb(pid) or 0) - (memory_before[pid] or 0),
+            }
+            for pid in pids
+        }
+        report['profile'] = None if args.replay else dict(profile, name=args.profile)
+        report['users'] = args.users
+        report['server'] = (args.server_cmd or args.server) if args.spawn else args.url
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def print_report(report):
+    ms = lambda value: '-' if value is None else f"{value * 1000:.0f}"
+    print(f"\n{report['requests']} requests in {report['elapsed_seconds']:.1f}s "
+          f"({report['throughput_rps']:.1f} req/s), error rate {report['error_rate']:.2%}\n")
+    print(f"{'endpoint':32} {'reqs':>6} {'err%':>6} {'p50':>7} {'p95':>7} {'p99':>7} {'ttfb50':>7} {'ttfb99':>7}")
+    for path, stats in report['endpoints'].items():
+        print(f"{path:32} {stats['requests']:>6} {stats['error_rate']:>6.1%} "
+              f"{ms(stats['latency_p50']):>7} {ms(stats['latency_p95']):>7} {ms(stats['latency_p99']):>7} "
+              f"{ms(stats['ttfb_p50']):>7} {ms(stats['ttfb_p99']):>7}")
+    if report['memory_kb']:
+        print("\nworker RSS (KiB): " + ', '.join(
+            f"{pid}: {m['start']} -> {m['end']} ({m['growth']:+d})" for pid, m in report['memory_kb'].items()
+        ))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+# Loaded by gunicorn from the working directory, for both the sync (app:app)
+# and the ASGI (asgi:app with UvicornWorker) servers
+import os
+
+import metrics
+
+
+def on_starting(server):
+    # Snapshots left by the last run's workers would be summed into this run's counters
+    directory = os.getenv("METRICS_DIR")
+    if directory and os.path.isdir(directory):
+        metrics.clear_directory(directory)
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import time
+
+# Record statuses
+IN_FLIGHT, COMPLETED = 'in_flight', 'completed'
+
+
+class IdempotencyConflict(Exception):
+    """Raised when a key is reused for a request with a different payload"""
+
+
+def fingerprint(*parts):
+    """Stable digest of a request's payload, to tell a retry from a different request"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """Outcomes of requests by Idempotency-Key, kept in a session store for window seconds
+
+    The first request with a key leaves an in-flight marker, so repeats
+    arriving while it runs wait for its outcome rather than starting a
+    second generation. A marker older than lease seconds is treated as
+    abandoned (its worker died), and one whose request failed is removed
+    so the client's retry runs afresh.
+    """
+
+    def __init__(self, store, conditions, window=600, lease=120, prefix='idempotency:'):
+        self.store = store
+        self.conditions = conditions
+        self.window = window
+        self.lease = lease
+        self.prefix = prefix
+
+    def _live(self, record, now):
+        if record is None:
+            return None
+        age = now - record['created']
+        if age > self.window or (record['status'] == IN_FLIGHT and age > self.lease):
+            return None
+        return record
+
+    def claim(self, key, digest, timeout):
+        """Return None if the caller should run the request, else the stored outcome
+
+        Waits up to timeout seconds for an in-flight original; if it is still
+        running then, the in-flight record is returned.
+        """
+        store_key = self.prefix + key
+        deadline = time.monotonic() + timeout
+        condition = self.conditions.condition_for(store_key)
+        with condition:
+            while True:
+                record = self._take(store_key, digest)
+                if record is None:
+                    return None
+                if record['digest'] != digest:
+                    raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+                remaining = deadline - time.monotonic()
+                if record['status'] == COMPLETED or remaining <= 0:
+                    return record
+                condition.wait(min(remaining, 0.25))
+
+    async def aclaim(self, key, digest, timeout):
+        """Async claim: waits for an in-flight original on the event loop, not a thread"""
+        store_key = self.prefix + key
+        deadline = time.monotonic() + timeout
+        condition = self.conditions.condition_for(store_key)
+        while True:
+            record = await asyncio.to_thread(self._take, store_key, digest)
+            if record is None:
+                return None
+            if record['digest'] != digest:
+                raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+            remaining = deadline - time.monotonic()
+            if record['status'] == COMPLETED or remaining <= 0:
+                return record
+            await condition.wait_async(min(remaining, 0.25))
+
+    def _take(self, store_key, digest):
+        """Leave an in-flight marker unless a live record exists; returns that record, else None
+
+        The marker is written with an atomic insert-if-absent, so of several
+        workers claiming the same key at once exactly one gets None.
+        """
+        marker = {'status': IN_FLIGHT, 'digest': digest, 'created': time.time()}
+        if self.store.add(store_key, marker):
+            return None
+
+        def replace_stale(record):
+            # May run again if the store retries, so only the last call's record counts
+            found[:] = [self._live(record, time.time())]
+            return marker if found[0] is None else None
+
+        found = [None]
+        # A stale record (expired window or lapsed lease) is swapped for the marker atomically
+        self.store.update(store_key, replace_stale)
+        return found[0]
+
+    def complete(self, key, digest, status, body, mimetype):
+        """Store a finished request's response and wake repeats waiting on it"""
+        self._settle(key, {'status': COMPLETED, 'digest': digest, 'created': time.time(),
+                           'response': {'status': status, 'body': body, 'mimetype': mimetype}})
+
+    def release(self, key):
+        """Drop the marker of a request that failed, so a retry runs again"""
+        self._settle(key, None)
+
+    def _settle(self, key, record):
+        store_key = self.prefix + key
+        condition = self.conditions.condition_for(store_key)
+        with condition:
+            if record is None:
+                self.store.delete(store_key)
+            else:
+                self.store.set(store_key, record)
+            condition.notify_all()
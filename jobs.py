@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+import uuid
+
+# Job statuses; a job never leaves a terminal status
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+TERMINAL = (SUCCEEDED, FAILED)
+
+
+class JobStore:
+    """Job state kept in a session store under a key prefix, so it expires like sessions
+
+    Every update wakes local waiters through the striped conditions; waiters
+    also poll the store, so updates made by another worker sharing the
+    session backend are picked up too.
+    """
+
+    def __init__(self, store, conditions, prefix='job:'):
+        self.store = store
+        self.conditions = conditions
+        self.prefix = prefix
+
+    def create(self, **fields):
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id, 'status': QUEUED, 'created': time.time(), **fields}
+        self.store.set(self.prefix + job_id, job)
+        return job
+
+    def get(self, job_id):
+        return self.store.get(self.prefix + job_id)
+
+    def update(self, job_id, **fields):
+        """Merge fields into a job and wake its waiters; returns None if the job expired"""
+        def merge(job):
+            if job is None:
+                return None
+            job.update(fields)
+            return job
+
+        condition = self.conditions.condition_for(self.prefix + job_id)
+        with condition:
+            job = self.store.update(self.prefix + job_id, merge)
+            condition.notify_all()
+            return job
+
+    def wait(self, job_id, timeout, seen_status=None):
+        """Return the job once its status differs from seen_status (or it is terminal), or at timeout"""
+        deadline = time.monotonic() + timeout
+        condition = self.conditions.condition_for(self.prefix + job_id)
+        with condition:
+            while True:
+                job = self.store.get(self.prefix + job_id)
+                if job is None or job['status'] in TERMINAL or (
+                        seen_status is not None and job['status'] != seen_status):
+                    return job
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return job
+                condition.wait(min(remaining, 0.25))
+
+    async def wait_async(self, job_id, timeout, seen_status=None):
+        """Async wait: awaits on the event loop, with only the store reads on a thread"""
+        deadline = time.monotonic() + timeout
+        condition = self.conditions.condition_for(self.prefix + job_id)
+        while True:
+            job = await asyncio.to_thread(self.store.get, self.prefix + job_id)
+            if job is None or job['status'] in TERMINAL or (
+                    seen_status is not None and job['status'] != seen_status):
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            await condition.wait_async(min(remaining, 0.25))
+
+
+class JobQueue:
+    """Bounded queue drained by a fixed pool of worker threads
+
+    Bursts wait in the queue instead of failing; submit only refuses work
+    once max_queued jobs are already waiting. Threads start on first use so
+    they are created in the serving process, not a pre-fork parent.
+    """
+
+    def __init__(self, workers=4, max_queued=1000):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args):
+        """Queue fn(*args); False if the queue is full"""
+        self._start()
+        try:
+            self._queue.put_nowait((fn, args, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            fn, args, queued_at = self._queue.get()
+            with self._lock:
+                self.running += 1
+            try:
+                fn(*args, queued_seconds=time.monotonic() - queued_at)
+            except Exception:
+                logging.getLogger(__name__).exception("Job failed outside its own error handling")
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+    def stats(self):
+        """Return queued, running, completed and rejected job counts"""
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'running': self.running,
+                'workers': self.workers,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
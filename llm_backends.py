@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+from google.generativeai.types import BlockedPromptException
+
+# Section headings the recommendation prompt asks for, mirrored by the stub
+STUB_SECTIONS = [
+    "## 🔹 RECOMMENDED STRUCTURE",
+    "## 🔸 MATERIALS DESCRIPTION",
+    "## 🔹 KEY PROPERTIES",
+    "## 🔸 BENEFITS FOR APPLICATION",
+]
+
+# Labels the follow-up prompt asks for, mirrored by the stub for follow-up prompts
+STUB_FOLLOW_UP_SECTIONS = [
+    "📌 **Key Analysis**:",
+    "🔍 **Considerations**:",
+    "💡 **Recommendation**:",
+]
+
+STUB_VOCABULARY = (
+    "barrier laminate PET BOPP CPP LDPE EVOH aluminium foil metallized adhesive "
+    "solventless gravure flexo seal strength oxygen transmission rate moisture "
+    "vapour micron thickness recyclable mono-material pouch retort lamination "
+    "coextruded tie layer puncture resistance heat seal initiation temperature"
+).split()
+
+
+class GeminiBackend:
+    """Real Gemini models through google-generativeai"""
+
+    name = 'gemini'
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+        if not self.api_key:
+            raise ValueError("GEMINI_API_KEY environment variable not set")
+        self._configured_pid = None
+
+    def create_model(self, model_name, generation_config, safety_settings):
+        """Build a GenerativeModel; its gRPC client is created on the model's first call"""
+        self._configure()
+        return genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings
+        )
+
+    def _configure(self):
+        # genai keeps its clients process-wide; configuring again in a forked worker
+        # drops any inherited from the parent, so each worker opens its own channels
+        if self._configured_pid != os.getpid():
+            genai.configure(api_key=self.api_key)
+            self._configured_pid = os.getpid()
+
+
+def parse_latency(spec):
+    """Parse a latency distribution such as 'fixed:200', 'uniform:100,400',
+    'lognormal:800,0.5' (median ms, sigma) or 'exponential:300' (mean ms)
+
+    Returns a function that draws a latency in seconds from a random.Random.
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',') if v]
+    if kind == 'fixed':
+        return lambda rng: values[0] / 1000
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) / 1000
+    if kind == 'exponential':
+        return lambda rng: rng.expovariate(1 / values[0]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_error_rates(spec):
+    """Parse error injection rates such as '429:0.02,503:0.01,safety:0.005'"""
+    rates = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        kind, _, rate = item.partition(':')
+        if kind not in ('429', '503', 'safety'):
+            raise ValueError(f"Unknown stub error kind: {kind}")
+        rates.append((kind, float(rate)))
+    return rates
+
+
+def parse_speedups(spec):
+    """Parse per-model speedups such as 'flash=3' (matched as a substring of the model name)"""
+    speedups = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        pattern, _, factor = item.partition('=')
+        speedups[pattern.strip()] = float(factor)
+    return speedups
+
+
+def count_words(text):
+    """Rough token count used by the stub (one token per whitespace-separated word)"""
+    return len(text.split())
+
+
+class StubResponse:
+    """Mimics GenerateContentResponse: .text, .usage_metadata and (async) chunk iteration"""
+
+    def __init__(self, chunks, prompt_tokens, delay_first, delay_per_chunk):
+        self._chunks = chunks
+        self._delay_first = delay_first
+        self._delay_per_chunk = delay_per_chunk
+        output_tokens = sum(count_words(chunk) for chunk in chunks)
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+
+    @property
+    def text(self):
+        return ''.join(self._chunks)
+
+    def generation_seconds(self):
+        """Time to produce the whole response: first token plus every later chunk"""
+        return self._delay_first + self._delay_per_chunk * (len(self._chunks) - 1)
+
+    def __iter__(self):
+        time.sleep(self._delay_first)
+        for index, chunk in enumerate(self._chunks):
+            if index:
+                time.sleep(self._delay_per_chunk)
+            yield SimpleNamespace(text=chunk, usage_metadata=self.usage_metadata)
+
+    async def __aiter__(self):
+        await asyncio.sleep(self._delay_first)
+        for index, chunk in enumerate(self._chunks):
+            if index:
+                await asyncio.sleep(self._delay_per_chunk)
+            yield SimpleNamespace(text=chunk, usage_metadata=self.usage_metadata)
+
+
+class StubModel:
+    """Offline stand-in for GenerativeModel with deterministic, prompt-derived text"""
+
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.model_name = model_name
+
+    def count_tokens(self, contents, **kwargs):
+        return SimpleNamespace(total_tokens=count_words(contents))
+
+    def _prepare(self, contents, request_options):
+        """Draw one call: (response, seconds to wait, error to raise after waiting or None)"""
+        backend = self.backend
+        ttft, error = backend.draw()
+        chunks = backend.render(contents)
+        speedup = backend.speedup(self.model_name)
+        ttft /= speedup
+        per_chunk = backend.chunk_tokens / (backend.tokens_per_sec * speedup)
+        response = StubResponse(chunks, count_words(contents), ttft, per_chunk)
+
+        timeout = (request_options or {}).get('timeout')
+        if timeout is not None and ttft > timeout:
+            return response, timeout, 'deadline'
+        if error:
+            return response, ttft, error
+        return response, ttft, None
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        response, wait, error = self._prepare(contents, request_options)
+        if error:
+            time.sleep(wait)
+            self.backend.raise_error(error)
+        if stream:
+            return response
+        # A blocking call pays the whole generation time up front
+        time.sleep(response.generation_seconds())
+        response._delay_first = response._delay_per_chunk = 0
+        return response
+
+    async def generate_content_async(self, contents, stream=False, request_options=None, **kwargs):
+        response, wait, error = self._prepare(contents, request_options)
+        if error:
+            await asyncio.sleep(wait)
+            self.backend.raise_error(error)
+        if stream:
+            return response  # Consumed with async for
+        await asyncio.sleep(response.generation_seconds())
+        response._delay_first = response._delay_per_chunk = 0
+        return response
+
+
+class StubBackend:
+    """Local LLM stand-in with configurable latency, token rate, chunking and errors"""
+
+    name = 'stub'
+
+    def __init__(self, latency='lognormal:800,0.4', tokens_per_sec=60, output_tokens=600,
+                 chunk_tokens=12, errors='', seed=None, speedups=''):
+        self.latency = parse_latency(latency)
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.chunk_tokens = chunk_tokens
+        self.error_rates = parse_error_rates(errors)
+        self.speedups = parse_speedups(speedups)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Configure the stub from STUB_* environment variables"""
+        seed = os.getenv("STUB_SEED")
+        return cls(
+            latency=os.getenv("STUB_LATENCY", "lognormal:800,0.4"),
+            tokens_per_sec=float(os.getenv("STUB_TOKENS_PER_SEC", "60")),
+            output_tokens=int(os.getenv("STUB_OUTPUT_TOKENS", "600")),
+            chunk_tokens=int(os.getenv("STUB_CHUNK_TOKENS", "12")),
+            errors=os.getenv("STUB_ERRORS", ""),
+            seed=int(seed) if seed else None,
+            speedups=os.getenv("STUB_MODEL_SPEEDUPS", "flash=3"),
+        )
+
+    def create_model(self, model_name, generation_config, safety_settings):
+        return StubModel(self, model_name)
+
+    def speedup(self, model_name):
+        """Latency and token-rate factor for a model (e.g. flash tiers answer faster)"""
+        return next((factor for pattern, factor in self.speedups.items() if pattern in model_name), 1.0)
+
+    def draw(self):
+        """Draw time-to-first-token and an injected error (or None) for one call"""
+        with self._lock:
+            ttft = self.latency(self._rng)
+            roll = self._rng.random()
+        for kind, rate in self.error_rates:
+            if roll < rate:
+                return ttft, kind
+            roll -= rate
+        return ttft, None
+
+    def render(self, prompt):
+        """Build deterministic markdown for a prompt, split into stream chunks"""
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).digest())
+        if 'User Question:' in prompt:
+            sections = STUB_FOLLOW_UP_SECTIONS
+        else:
+            # A section-wise prompt names only its own heading
+            sections = [heading for heading in STUB_SECTIONS if heading in prompt] or STUB_SECTIONS
+        per_prompt = len(STUB_FOLLOW_UP_SECTIONS) if sections is STUB_FOLLOW_UP_SECTIONS else len(STUB_SECTIONS)
+        words_per_section = max(1, self.output_tokens // per_prompt)
+        lines = []
+        for heading in sections:
+            lines.append(heading)
+            for start in range(0, words_per_section, 12):
+                count = min(12, words_per_section - start)
+                lines.append("- " + " ".join(rng.choice(STUB_VOCABULARY) for _ in range(count)))
+            lines.append("")
+        words = "\n".join(lines).split(" ")
+        return [
+            " ".join(words[i:i + self.chunk_tokens]) + (" " if i + self.chunk_tokens < len(words) else "")
+            for i in range(0, len(words), self.chunk_tokens)
+        ]
+
+    @staticmethod
+    def raise_error(kind):
+        if kind == 'deadline':
+            raise api_exceptions.DeadlineExceeded("Stub: deadline exceeded before first token")
+        if kind == '429':
+            raise api_exceptions.ResourceExhausted("Stub: resource exhausted (429)")
+        if kind == '503':
+            raise api_exceptions.ServiceUnavailable("Stub: service unavailable (503)")
+        raise BlockedPromptException("Stub: prompt blocked by safety filters")
+
+
+def create_backend(name=None):
+    """Build the LLM backend selected by LLM_BACKEND (gemini or stub)"""
+    name = name or os.getenv("LLM_BACKEND", "gemini")
+    if name == 'gemini':
+        return GeminiBackend()
+    if name == 'stub':
+        return StubBackend.from_env()
+    raise ValueError(f"Unknown LLM_BACKEND: {name}")
@@ -0,0 +1,275 @@
+import atexit
+import glob
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, math.inf)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Base for metrics: a named family of samples keyed by label values"""
+
+    type = None
+
+    def __init__(self, registry, name, help, labelnames=(), mode='sum'):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # How samples from several worker processes combine: 'sum' or 'max'
+        self.mode = mode
+        self.samples = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        return {
+            'type': self.type,
+            'help': self.help,
+            'labelnames': list(self.labelnames),
+            'mode': self.mode,
+            'samples': [[list(key), value] for key, value in self.samples.items()],
+        }
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def set_total(self, value, **labels):
+        """Mirror a cumulative count kept elsewhere (e.g. a cache's hit counter)"""
+        with self.registry.lock:
+            self.samples[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.samples[self._key(labels)] = value
+        self.registry.maybe_flush()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(buckets) if buckets[-1] == math.inf else tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                sample = self.samples[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[index] += 1
+                    break
+            sample[-2] += value
+            sample[-1] += 1
+        self.registry.maybe_flush()
+
+    def snapshot(self):
+        data = super().snapshot()
+        data['buckets'] = [_format_value(bound) for bound in self.buckets]
+        return data
+
+
+def clear_directory(directory):
+    """Remove every worker's snapshot, so a new server run does not count the last one's"""
+    for pattern in ('metrics_*.json', '*.tmp'):
+        for path in glob.glob(os.path.join(directory, pattern)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class Registry:
+    """In-process metrics registry with optional multiprocess aggregation
+
+    With a metrics directory (METRICS_DIR), every worker writes a snapshot of
+    its metrics to its own file every flush_interval seconds, from a
+    background thread, and a scrape on any worker merges all files: counters
+    and histograms are summed across live and exited workers, gauges across
+    live workers only. The directory must be emptied when the server starts
+    (see gunicorn.conf.py), or exited workers of the last run are counted too.
+
+    Collectors run only when a snapshot is taken, on that thread or at scrape
+    time, never on a request thread recording a sample.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.metrics = {}
+        self.collectors = []
+        # The flusher thread does not survive a fork, so each worker starts its own
+        self._flusher_pid = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self.flush)
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), mode='sum'):
+        return self._register(Gauge(self, name, help, labelnames, mode=mode))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def add_collector(self, collect):
+        """Register a function called before every snapshot to refresh derived values"""
+        self.collectors.append(collect)
+
+    def _register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        for collect in self.collectors:
+            collect()
+        with self.lock:
+            return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def maybe_flush(self):
+        """Make sure this process has a flusher thread writing its snapshot in the background"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._flush_periodically, name='metrics-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # A failing collector or a full disk must not stop later flushes
+                pass
+
+    def flush(self):
+        """Atomically write this process's snapshot to the metrics directory"""
+        if not self.directory:
+            return
+        data = json.dumps({'pid': os.getpid(), 'metrics': self.snapshot()})
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(path, os.path.join(self.directory, f'metrics_{os.getpid()}.json'))
+
+    def collect(self):
+        """Return the merged snapshot across every worker (or just this process)"""
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _pid_alive(data['pid'])
+            for name, metric in data['metrics'].items():
+                if metric['type'] == 'gauge' and not alive:
+                    continue
+                _merge(merged, name, metric)
+        return merged
+
+    def exposition(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            labelnames = metric['labelnames']
+            for labels, value in sorted(metric['samples'], key=lambda sample: sample[0]):
+                if metric['type'] == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric['buckets'], value):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labelnames, labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {_format_value(value[-2])}")
+                    lines.append(f"{name}_count{_format_labels(labelnames, labels)} {value[-1]}")
+                else:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(merged, name, metric):
+    target = merged.get(name)
+    if target is None:
+        merged[name] = dict(metric, samples=[[labels, value] for labels, value in metric['samples']])
+        return
+    index = {tuple(labels): position for position, (labels, _) in enumerate(target['samples'])}
+    for labels, value in metric['samples']:
+        position = index.get(tuple(labels))
+        if position is None:
+            target['samples'].append([labels, value])
+        elif metric['type'] == 'histogram':
+            current = target['samples'][position][1]
+            target['samples'][position][1] = [a + b for a, b in zip(current, value)]
+        elif metric.get('mode') == 'max':
+            target['samples'][position][1] = max(target['samples'][position][1], value)
+        else:
+            target['samples'][position][1] += value
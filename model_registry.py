@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+
+# Process-wide registry of configured model handles (one set per gunicorn worker)
+_handles = {}
+_registry_lock = threading.Lock()
+
+# Process that created _handles; a forked worker builds its own rather than reuse its parent's
+_handles_pid = os.getpid()
+
+# LLM backend that builds the models (see llm_backends), set once at startup
+_backend = None
+
+# Callables notified after every model call (e.g. to export metrics)
+_listeners = []
+
+
+def add_listener(listener):
+    """Register listener(model_name, stream, seconds, usage_metadata, error) for every call
+
+    For streamed calls the listener fires once the stream is exhausted or abandoned.
+    """
+    _listeners.append(listener)
+
+
+def set_backend(backend):
+    """Select the backend used for new handles and drop handles from the previous one"""
+    global _backend
+    with _registry_lock:
+        _backend = backend
+        _handles.clear()
+
+
+def _handle_key(model_name, generation_config, safety_settings):
+    """Build a hashable registry key from the model name and its configuration"""
+    return (
+        model_name,
+        json.dumps(generation_config or {}, sort_keys=True),
+        json.dumps(safety_settings or [], sort_keys=True),
+    )
+
+
+class ModelHandle:
+    """A configured model shared by every request in this worker"""
+
+    def __init__(self, model_name, generation_config, safety_settings):
+        self.model_name = model_name
+        self.model = _backend.create_model(model_name, generation_config, safety_settings)
+
+        self._stats_lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.created_at = time.time()
+        self.last_used = None
+
+    def generate_content(self, *args, **kwargs):
+        """Call the underlying model and record call statistics"""
+        stream = kwargs.get('stream', False)
+        started = time.perf_counter()
+        try:
+            response = self.model.generate_content(*args, **kwargs)
+        except Exception as e:
+            self.finish_call(started, stream, None, e)
+            raise
+        if stream:
+            return ObservedStream(self, response, started)
+        self.finish_call(started, stream, getattr(response, 'usage_metadata', None), None)
+        return response
+
+    async def generate_content_async(self, *args, **kwargs):
+        """Await the underlying model's async call and record call statistics (no streaming)"""
+        started = time.perf_counter()
+        try:
+            response = await self.model.generate_content_async(*args, **kwargs)
+        except BaseException as e:
+            # Includes cancellation, e.g. when a deadline or a hedge race abandons the call
+            self.finish_call(started, False, None, e)
+            raise
+        self.finish_call(started, False, getattr(response, 'usage_metadata', None), None)
+        return response
+
+    def count_tokens(self, *args, **kwargs):
+        """Ask the model how many tokens a prompt would use, without generating"""
+        return self.model.count_tokens(*args, **kwargs)
+
+    def finish_call(self, started, stream, usage_metadata, error):
+        """Record a completed call and notify listeners"""
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self.calls += 1
+            self.total_seconds += elapsed
+            self.last_used = time.time()
+            if error is not None:
+                self.errors += 1
+        for listener in _listeners:
+            listener(self.model_name, stream, elapsed, usage_metadata, error)
+
+    def stats(self):
+        """Return a snapshot of this handle's call statistics"""
+        with self._stats_lock:
+            return {
+                'model_name': self.model_name,
+                'calls': self.calls,
+                'errors': self.errors,
+                'avg_seconds': self.total_seconds / self.calls if self.calls else 0.0,
+                'created_at': self.created_at,
+                'last_used': self.last_used,
+            }
+
+
+class ObservedStream:
+    """Iterates a streamed response and records the call when the stream ends"""
+
+    def __init__(self, handle, response, started):
+        self.handle = handle
+        self.response = response
+        self.started = started
+        # Latest usage reported by a chunk; complete once the stream is exhausted
+        self.usage_metadata = None
+
+    def __iter__(self):
+        error = None
+        try:
+            for chunk in self.response:
+                self.usage_metadata = getattr(chunk, 'usage_metadata', None) or self.usage_metadata
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.handle.finish_call(self.started, True, self.usage_metadata, error)
+
+
+def get_model(model_name, generation_config=None, safety_settings=None):
+    """Return the shared handle for a model name + configuration, creating it once"""
+    global _handles_pid
+    key = _handle_key(model_name, generation_config, safety_settings)
+    handle = _handles.get(key) if _handles_pid == os.getpid() else None
+    if handle is None:
+        with _registry_lock:
+            if _handles_pid != os.getpid():
+                _handles.clear()
+                _handles_pid = os.getpid()
+            handle = _handles.get(key)
+            if handle is None:
+                handle = ModelHandle(model_name, generation_config, safety_settings)
+                _handles[key] = handle
+    return handle
+
+
+def warm_up(model_configs):
+    """Create handles ahead of the first request, in the worker process that will use them
+
+    model_configs is an iterable of (model_name, generation_config, safety_settings)
+    """
+    return [get_model(*config) for config in model_configs]
+
+
+def registry_stats():
+    """Return call statistics for every handle in this worker"""
+    with _registry_lock:
+        handles = list(_handles.values())
+    return [handle.stats() for handle in handles]
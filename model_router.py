@@ -0,0 +1,138 @@
+import json
+import os
+import re
+import threading
+
+DEFAULT_TIERS = {
+    'pro': 'gemini-1.5-pro',
+    'flash': 'gemini-1.5-flash',
+}
+
+# Words that mark a follow-up as needing the large model's reasoning
+COMPLEX_KEYWORDS = [
+    'compare', 'comparison', 'alternative', 'alternatives', 'why', 'explain', 'design',
+    'optimize', 'optimise', 'trade-off', 'tradeoff', 'versus', 'vs', 'redesign', 'analyse', 'analyze',
+]
+
+# First matching rule wins; a rule matches its endpoint and every condition it sets
+DEFAULT_RULES = [
+    {'endpoint': 'recommendation', 'tier': 'pro'},
+    {'endpoint': 'follow_up', 'tier': 'flash', 'max_words': 30, 'exclude': COMPLEX_KEYWORDS},
+    {'endpoint': 'follow_up', 'tier': 'pro'},
+]
+
+# Section labels the follow-up prompt asks for, by response language; an answer missing
+# them is escalated. Answers in other languages carry translated labels, so only their
+# length is checked
+FOLLOW_UP_MARKERS = {'English': ['key analysis', 'recommendation']}
+
+
+def parse_tiers(spec):
+    """Parse tiers such as 'pro=gemini-1.5-pro,flash=gemini-1.5-flash'"""
+    tiers = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        tier, _, model_name = item.partition('=')
+        tiers[tier.strip()] = model_name.strip()
+    return tiers
+
+
+def load_rules(spec):
+    """Load routing rules from a JSON list or the path of a JSON file"""
+    if os.path.isfile(spec):
+        with open(spec, encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(spec)
+
+
+class ModelRouter:
+    """Pick a model tier per request and decide when a cheap tier's answer must be escalated
+
+    Rules are dicts with an endpoint ('recommendation' or 'follow_up'), the
+    tier to use, and optional conditions on the question: max_words,
+    max_chars, exclude (keywords that veto the rule) and include (keywords
+    of which at least one must appear).
+    """
+
+    def __init__(self, tiers=None, rules=None, escalation_tier='pro',
+                 min_answer_words=40, required_markers=FOLLOW_UP_MARKERS):
+        self.tiers = tiers or dict(DEFAULT_TIERS)
+        self.rules = rules if rules is not None else DEFAULT_RULES
+        self.escalation_tier = escalation_tier
+        self.min_answer_words = min_answer_words
+        self.required_markers = {language: [marker.lower() for marker in markers]
+                                 for language, markers in required_markers.items()}
+        for rule in self.rules:
+            if rule['tier'] not in self.tiers:
+                raise ValueError(f"Routing rule uses unknown tier: {rule['tier']}")
+        if escalation_tier not in self.tiers:
+            raise ValueError(f"Unknown escalation tier: {escalation_tier}")
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.escalations = {}
+
+    @classmethod
+    def from_env(cls):
+        """Configure tiers, rules and the quality check from MODEL_* environment variables"""
+        tiers = parse_tiers(os.getenv("MODEL_TIERS", "")) or None
+        rules = os.getenv("MODEL_ROUTING_RULES")
+        return cls(
+            tiers=tiers,
+            rules=load_rules(rules) if rules else None,
+            escalation_tier=os.getenv("MODEL_ESCALATION_TIER", "pro"),
+            min_answer_words=int(os.getenv("MODEL_ESCALATION_MIN_WORDS", "40")),
+        )
+
+    def model_names(self):
+        return sorted(set(self.tiers.values()))
+
+    def route(self, endpoint, question=''):
+        """Return the tier for a request, falling back to the escalation tier"""
+        tier = next((rule['tier'] for rule in self.rules if self._matches(rule, endpoint, question)),
+                    self.escalation_tier)
+        with self._lock:
+            self.routes[(endpoint, tier)] = self.routes.get((endpoint, tier), 0) + 1
+        return tier
+
+    @staticmethod
+    def _matches(rule, endpoint, question):
+        if rule.get('endpoint', endpoint) != endpoint:
+            return False
+        words = re.findall(r"[\w'-]+", question.lower())
+        if 'max_words' in rule and len(words) > rule['max_words']:
+            return False
+        if 'max_chars' in rule and len(question) > rule['max_chars']:
+            return False
+        if any(keyword.lower() in words for keyword in rule.get('exclude', [])):
+            return False
+        if rule.get('include') and not any(keyword.lower() in words for keyword in rule['include']):
+            return False
+        return True
+
+    def escalation_reason(self, tier, answer, language='English'):
+        """Why an answer from tier in language fails the quality check, or None if it passes"""
+        if tier == self.escalation_tier:
+            return None
+        text = (answer or '').strip()
+        if not text:
+            return 'empty'
+        if len(text.split()) < self.min_answer_words:
+            return 'too_short'
+        lowered = text.lower()
+        if not all(marker in lowered for marker in self.required_markers.get(language, [])):
+            return 'missing_sections'
+        return None
+
+    def record_escalation(self, endpoint, reason):
+        with self._lock:
+            key = (endpoint, reason)
+            self.escalations[key] = self.escalations.get(key, 0) + 1
+
+    def stats(self):
+        """Return routed and escalated request counts"""
+        with self._lock:
+            return {
+                'routes': [{'endpoint': endpoint, 'tier': tier, 'count': count}
+                           for (endpoint, tier), count in self.routes.items()],
+                'escalations': [{'endpoint': endpoint, 'reason': reason, 'count': count}
+                                for (endpoint, reason), count in self.escalations.items()],
+            }
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import re
+import threading
+
+from cachetools import TTLCache
+
+# Form fields that determine the generated recommendation
+SPEC_FIELDS = [
+    'product_category',
+    'printing_type',
+    'layer_structure',
+    'packaging_material',
+    'packaging_type',
+    'sealing_type',
+    'shelf_life',
+    'production_volume',
+    'language',
+]
+
+MULTI_SELECT_FIELDS = [
+    'barrier_requirements',
+    'sustainability_options',
+    'special_features',
+]
+
+
+def normalize_text(value):
+    """Collapse whitespace and case so equivalent free text compares equal"""
+    return re.sub(r'\s+', ' ', value or '').strip().lower()
+
+
+def canonical_spec(form_data):
+    """Reduce form data to a canonical spec independent of field and option order"""
+    spec = {field: (form_data.get(field) or '').strip() for field in SPEC_FIELDS}
+    for field in MULTI_SELECT_FIELDS:
+        spec[field] = sorted(set(form_data.get(field, [])))
+    spec['custom_requirements'] = normalize_text(form_data.get('custom_requirements'))
+    return spec
+
+
+def spec_key(spec, model_name, generation_config, prompt_version):
+    """Hash the canonical spec together with everything that shapes the output"""
+    payload = json.dumps({
+        'spec': spec,
+        'model': model_name,
+        'generation_config': generation_config,
+        'prompt_version': prompt_version,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _CountingTTLCache(TTLCache):
+    """TTLCache that counts LRU evictions and TTL expirations"""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.evictions = 0
+        self.expirations = 0
+
+    def popitem(self):
+        # Only called by cachetools when the cache is full
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.expirations += len(expired)
+        return expired
+
+
+class RecommendationCache:
+    """Thread-safe bounded LRU/TTL cache of generated recommendations"""
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self._cache = _CountingTTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached recommendation for a key, or None"""
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, recommendation):
+        """Store a generated recommendation"""
+        with self._lock:
+            self._cache[key] = recommendation
+
+    def stats(self):
+        """Return cache size and hit/miss/eviction counters"""
+        with self._lock:
+            self._cache.expire()
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'maxsize': self._cache.maxsize,
+                'ttl': self._cache.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self._cache.evictions,
+                'expirations': self._cache.expirations,
+            }
@@ -0,0 +1,79 @@
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager, nullcontext
+
+from flask import g
+
+# Structured timing log: one JSON object per sampled request
+logger = logging.getLogger('request_timing')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class RequestTimer:
+    """Named stage durations for one request; repeated stages accumulate"""
+
+    def __init__(self, endpoint, request_id=None):
+        self.endpoint = endpoint
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans = {}
+
+    def record(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def server_timing(self):
+        """Format the spans recorded so far as a Server-Timing header value"""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.spans.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ', '.join(entries)
+
+    def log(self, status, **fields):
+        """Emit the request's spans as one structured log line"""
+        logger.info(json.dumps({
+            'event': 'request_timing',
+            'endpoint': self.endpoint,
+            'request_id': self.request_id,
+            'status': status,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'spans_ms': {name: round(seconds * 1000, 2) for name, seconds in self.spans.items()},
+            **fields,
+        }))
+
+
+def start(endpoint, sample_rate, request_id=None):
+    """Start timing the current request if it is sampled"""
+    if sample_rate > 0 and random.random() < sample_rate:
+        g.timer = RequestTimer(endpoint, request_id)
+
+
+def current():
+    """The current request's timer, or None if the request is not sampled"""
+    return g.get('timer')
+
+
+def span(name):
+    """Time a stage of the current request (a no-op for unsampled requests)"""
+    timer = g.get('timer')
+    return timer.span(name) if timer else nullcontext()
+
+
+def record(name, seconds):
+    """Record an already measured stage, such as time-to-first-token"""
+    timer = g.get('timer')
+    if timer:
+        timer.record(name, seconds)
@@ -0,0 +1,196 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# Priority classes, most latency-sensitive first
+INTERACTIVE, RECOMMENDATION, BACKGROUND = 'interactive', 'recommendation', 'background'
+PRIORITIES = (INTERACTIVE, RECOMMENDATION, BACKGROUND)
+
+DEFAULT_WEIGHTS = {INTERACTIVE: 6, RECOMMENDATION: 3, BACKGROUND: 1}
+
+
+class SlotTimeout(Exception):
+    """Raised when no upstream slot was granted before the caller's timeout"""
+
+
+def parse_weights(spec):
+    """Parse class weights such as 'interactive=6,recommendation=3,background=1'"""
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        priority, _, weight = item.partition('=')
+        if priority.strip() not in weights:
+            raise ValueError(f"Unknown priority class: {priority.strip()}")
+        weights[priority.strip()] = float(weight)
+    return weights
+
+
+class Slot:
+    """A granted upstream slot; release it once the call (or its stream) is finished"""
+
+    def __init__(self, scheduler, priority, waited):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.waited = waited
+        self.granted = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.scheduler._release(self, time.monotonic() - self.granted)
+
+
+class _Waiter:
+    def __init__(self, priority, notify):
+        self.priority = priority
+        self.notify = notify
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class PriorityScheduler:
+    """Share a fixed number of upstream slots between priority classes
+
+    While slots are free calls start at once. Otherwise each class queues
+    FIFO and freed slots go to the waiting class with the lowest virtual
+    time (stride scheduling): a class of weight w advances 1/w per grant, so
+    under contention classes get slots in proportion to their weights. A
+    class that was idle rejoins at the current virtual time instead of
+    cashing in credit. A class whose oldest waiter has waited max_age
+    seconds, with no slot for the class in that time while other classes
+    were being served, is served first, so background work cannot starve.
+    Age alone promotes nothing: when every slot is busy with long
+    generations a whole backlog ages together, and promoting it would turn
+    dispatch into FIFO ahead of follow-ups.
+    """
+
+    def __init__(self, slots=16, weights=None, max_age=5.0):
+        self.slots = slots
+        self.weights = weights or dict(DEFAULT_WEIGHTS)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._queues = {priority: deque() for priority in self.weights}
+        self._pass = {priority: 0.0 for priority in self.weights}
+        self._virtual = 0.0
+        self._listeners = []
+        self.active = 0
+        self.granted = {priority: 0 for priority in self.weights}
+        self.promoted = {priority: 0 for priority in self.weights}
+        self.timeouts = {priority: 0 for priority in self.weights}
+        self._last_grant = {priority: 0.0 for priority in self.weights}
+
+    def add_listener(self, listener):
+        """Register listener(priority, waited, held) for every released slot"""
+        self._listeners.append(listener)
+
+    def acquire(self, priority, timeout):
+        """Block until a slot is granted; raises SlotTimeout after timeout seconds"""
+        event = threading.Event()
+        waiter = self._enqueue(priority, event.set)
+        if not waiter.granted:
+            event.wait(timeout)
+        return self._settle(waiter)
+
+    async def aacquire(self, priority, timeout):
+        """Await a slot without blocking the event loop; raises SlotTimeout after timeout seconds"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+
+        waiter = self._enqueue(priority, lambda: loop.call_soon_threadsafe(resolve))
+        if not waiter.granted:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                self._abandon(waiter)
+                raise
+        return self._settle(waiter)
+
+    def _enqueue(self, priority, notify):
+        waiter = _Waiter(priority, notify)
+        with self._lock:
+            if self.active < self.slots and not any(self._queues.values()):
+                self._grant(waiter)
+                return waiter
+            queue = self._queues[priority]
+            if not queue:
+                self._pass[priority] = max(self._pass[priority], self._virtual)
+            queue.append(waiter)
+        return waiter
+
+    def _settle(self, waiter):
+        with self._lock:
+            if not waiter.granted:
+                self._queues[waiter.priority].remove(waiter)
+                self.timeouts[waiter.priority] += 1
+                raise SlotTimeout(f"No upstream slot for {waiter.priority} work in time")
+        return Slot(self, waiter.priority, time.monotonic() - waiter.enqueued)
+
+    def _abandon(self, waiter):
+        """Withdraw a cancelled waiter, giving back its slot if one was already granted"""
+        with self._lock:
+            if not waiter.granted:
+                self._queues[waiter.priority].remove(waiter)
+                return
+            self.active -= 1
+            self._dispatch()
+
+    def _grant(self, waiter):
+        self._last_grant[waiter.priority] = time.monotonic()
+        self.active += 1
+        self.granted[waiter.priority] += 1
+        waiter.granted = True
+        waiter.notify()
+
+    def _dispatch(self):
+        while self.active < self.slots:
+            heads = [queue[0] for queue in self._queues.values() if queue]
+            if not heads:
+                return
+            now = time.monotonic()
+            starved = [waiter for waiter in heads if self._starved(waiter, now)]
+            if starved:
+                waiter = min(starved, key=lambda waiter: waiter.enqueued)
+                self.promoted[waiter.priority] += 1
+            else:
+                waiter = min(heads, key=lambda waiter: self._pass[waiter.priority])
+            priority = waiter.priority
+            self._virtual = self._pass[priority]
+            self._pass[priority] += 1 / self.weights[priority]
+            self._queues[priority].popleft()
+            self._grant(waiter)
+
+    def _starved(self, waiter, now):
+        """Whether a waiter's class has gone max_age without a slot while others were served"""
+        last = self._last_grant[waiter.priority]
+        return (now - waiter.enqueued >= self.max_age and now - last >= self.max_age
+                and any(granted > last for priority, granted in self._last_grant.items()
+                        if priority != waiter.priority))
+
+    def _release(self, slot, held):
+        with self._lock:
+            self.active -= 1
+            self._dispatch()
+        for listener in self._listeners:
+            listener(slot.priority, slot.waited, held)
+
+    def stats(self):
+        """Return active slots and per-class queued, granted, promoted and timed-out counts"""
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'active': self.active,
+                'queued': {priority: len(queue) for priority, queue in self._queues.items()},
+                'granted': dict(self.granted),
+                'promoted': dict(self.promoted),
+                'timeouts': dict(self.timeouts),
+            }
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import zlib
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class StripeCondition(threading.Condition):
+    """A condition that can also be awaited on an event loop without holding a thread"""
+
+    def __init__(self):
+        super().__init__()
+        self._futures_lock = threading.Lock()
+        self._futures = set()
+
+    def notify_all(self):
+        super().notify_all()
+        with self._futures_lock:
+            futures, self._futures = self._futures, set()
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    async def wait_async(self, timeout):
+        """Await the next notify_all or timeout seconds, whichever comes first
+
+        Unlike wait() the lock is neither required nor taken, so the event loop
+        never blocks on a thread holding it; callers re-check the store after
+        waking, as they do after a timed wait().
+        """
+        loop = asyncio.get_running_loop()
+        entry = (loop, loop.create_future())
+        with self._futures_lock:
+            self._futures.add(entry)
+        try:
+            await asyncio.wait_for(entry[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._futures_lock:
+                self._futures.discard(entry)
+
+
+class StripedLocks:
+    """A fixed pool of conditions that session IDs hash onto
+
+    Sessions on different stripes never contend, and memory stays constant
+    no matter how many sessions are live.
+    """
+
+    def __init__(self, stripes=64):
+        self._conditions = [StripeCondition() for _ in range(stripes)]
+
+    def condition_for(self, key):
+        """Return the condition guarding a session"""
+        return self._conditions[zlib.crc32(key.encode('utf-8')) % len(self._conditions)]
@@ -0,0 +1,619 @@
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+def estimate_size(value):
+    """Approximate the memory held by a session as its serialized UTF-8 size"""
+    return len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+
+class SessionStore:
+    """Interface shared by every session backend
+
+    Values are JSON-serializable dicts. Backends other than memory return
+    copies, so callers must write a mutated session back with set(), or use
+    update() when other workers may change the same key concurrently.
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def update(self, key, fn):
+        """Atomically replace a value with fn(current), across every worker sharing the store
+
+        current is None if the key is absent or expired. fn returns the value
+        to store, or None to leave the store untouched, and may be called
+        more than once if a concurrent write forces a retry. Returns what fn
+        returned last.
+        """
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """Store value only if the key is absent or expired; True if it was stored"""
+        return self.update(key, lambda current: value if current is None else None) is not None
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class MemorySessionStore(SessionStore):
+    """In-memory session store with idle-TTL expiry and LRU eviction
+
+    Sessions are kept in least-recently-used order, so expired entries are
+    always at the front and the amortized sweep only touches what it removes.
+    """
+
+    def __init__(self, ttl=3600, max_sessions=10000, max_bytes=100 * 1024 * 1024,
+                 sweep_interval=30):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+
+        # key -> (value, size, last_access)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._last_sweep = time.monotonic()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Return a session and mark it as recently used"""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_sweep(now)
+            value = self._lookup(key, now)
+            return default if value is None else value
+
+    def set(self, key, value):
+        """Store a session, evicting least-recently-used sessions over the caps"""
+        size = estimate_size(value)
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_sweep(now)
+            self._store(key, value, size, now)
+
+    def update(self, key, fn):
+        """Replace a session with fn(current) under the store lock; fn must not use the store"""
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_sweep(now)
+            value = fn(self._lookup(key, now))
+            if value is not None:
+                self._store(key, value, estimate_size(value), now)
+            return value
+
+    def delete(self, key):
+        """Remove a session if present"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def sweep(self):
+        """Drop every session that has been idle for longer than the TTL"""
+        with self._lock:
+            self._sweep(time.monotonic())
+
+    def stats(self):
+        """Return live session count, bytes held and eviction counters"""
+        with self._lock:
+            return {
+                'sessions': len(self._entries),
+                'bytes': self._bytes,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, size, last_access = entry
+        if now - last_access > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries[key] = (value, size, now)
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value, size, now):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, now)
+        self._bytes += size
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_sessions or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _maybe_sweep(self, now):
+        if now - self._last_sweep >= self.sweep_interval:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        while self._entries:
+            key, (_, _, last_access) = next(iter(self._entries.items()))
+            if now - last_access <= self.ttl:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store in a local SQLite database shared by all workers on a host
+
+    The database runs in WAL mode so readers never block the writer. Each
+    thread keeps its own connection, and last-access updates from reads are
+    buffered and flushed in a single batch instead of one write per lookup.
+    """
+
+    def __init__(self, path, ttl=3600, max_sessions=10000, max_bytes=100 * 1024 * 1024,
+                 sweep_interval=30, touch_flush_interval=1.0, table='sessions'):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.touch_flush_interval = touch_flush_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending_touches = {}
+        self._last_flush = time.monotonic()
+        self._last_sweep = time.monotonic()
+        self.evictions = 0
+        self.expirations = 0
+
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_last_access ON {self.table} (last_access)"
+            )
+
+    @contextmanager
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        yield conn
+
+    def get(self, key, default=None):
+        """Return a copy of a session and record the access"""
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                f"SELECT value, last_access FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return default
+        value, last_access = row
+        with self._lock:
+            last_access = max(last_access, self._pending_touches.get(key, 0))
+        if now - last_access > self.ttl:
+            self.delete(key)
+            with self._lock:
+                self.expirations += 1
+            return default
+        with self._lock:
+            self._pending_touches[key] = now
+        self._maybe_maintain()
+        return json.loads(value)
+
+    def set(self, key, value):
+        """Write a session through to the database"""
+        data = json.dumps(value, ensure_ascii=False)
+        with self._connection() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, size, last_access)"
+                " VALUES (?, ?, ?, ?)",
+                (key, data, len(data.encode('utf-8')), time.time())
+            )
+        with self._lock:
+            self._pending_touches.pop(key, None)
+        self._maybe_maintain()
+
+    def update(self, key, fn):
+        """Replace a session with fn(current) inside one write transaction
+
+        BEGIN IMMEDIATE takes the database write lock before the read, so
+        workers updating the same session run one after another.
+        """
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    f"SELECT value, last_access FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                current = None
+                if row is not None:
+                    data, last_access = row
+                    with self._lock:
+                        last_access = max(last_access, self._pending_touches.get(key, 0))
+                    if time.time() - last_access <= self.ttl:
+                        current = json.loads(data)
+                value = fn(current)
+                if value is not None:
+                    data = json.dumps(value, ensure_ascii=False)
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, size, last_access)"
+                        " VALUES (?, ?, ?, ?)",
+                        (key, data, len(data.encode('utf-8')), time.time())
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if value is not None:
+            with self._lock:
+                self._pending_touches.pop(key, None)
+        self._maybe_maintain()
+        return value
+
+    def add(self, key, value):
+        """Insert a session unless the key is taken; True if it was stored"""
+        data = json.dumps(value, ensure_ascii=False)
+        with self._connection() as conn:
+            inserted = conn.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, value, size, last_access)"
+                " VALUES (?, ?, ?, ?)",
+                (key, data, len(data.encode('utf-8')), time.time())
+            ).rowcount
+        if inserted:
+            return True
+        # The key may only be held by an expired row the sweep has not removed yet
+        return super().add(key, value)
+
+    def delete(self, key):
+        """Remove a session if present"""
+        with self._connection() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        with self._lock:
+            self._pending_touches.pop(key, None)
+
+    def flush(self):
+        """Write buffered last-access times in one transaction"""
+        with self._lock:
+            touches = list(self._pending_touches.items())
+            self._pending_touches.clear()
+            self._last_flush = time.monotonic()
+        if touches:
+            with self._connection() as conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    f"UPDATE {self.table} SET last_access = MAX(last_access, ?) WHERE key = ?",
+                    [(last_access, key) for key, last_access in touches]
+                )
+                conn.execute("COMMIT")
+
+    def sweep(self):
+        """Expire idle sessions and evict the least recently used over the caps"""
+        self.flush()
+        with self._lock:
+            self._last_sweep = time.monotonic()
+        with self._connection() as conn:
+            expired = conn.execute(
+                f"DELETE FROM {self.table} WHERE last_access < ?", (time.time() - self.ttl,)
+            ).rowcount
+
+            count, total = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}"
+            ).fetchone()
+            evict = []
+            if count > self.max_sessions or total > self.max_bytes:
+                rows = conn.execute(
+                    f"SELECT key, size FROM {self.table} ORDER BY last_access"
+                ).fetchall()
+                for key, size in rows:
+                    if count <= self.max_sessions and total <= self.max_bytes:
+                        break
+                    evict.append((key,))
+                    count -= 1
+                    total -= size
+                conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", evict)
+
+        with self._lock:
+            self.expirations += expired
+            self.evictions += len(evict)
+
+    def stats(self):
+        """Return live session count, bytes held and eviction counters"""
+        with self._connection() as conn:
+            count, total = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}"
+            ).fetchone()
+        with self._lock:
+            return {
+                'sessions': count,
+                'bytes': total,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def _maybe_maintain(self):
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+        elif now - self._last_flush >= self.touch_flush_interval:
+            self.flush()
+
+
+class RedisError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RedisConnection:
+    """Minimal RESP2 client connection, enough for the session store"""
+
+    def __init__(self, host, port, db=0, password=None, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+        if db:
+            self.execute('SELECT', db)
+
+    def execute(self, *args):
+        """Send one command and return its reply"""
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        """Send several commands in one round trip and return all replies"""
+        self.sock.sendall(b''.join(self._encode(args) for args in commands))
+        replies = [self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by Redis server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            return RedisError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply type: {line!r}")
+
+
+class RedisConnectionPool:
+    """Bounded pool of Redis connections shared by the threads of a worker"""
+
+    def __init__(self, url, max_connections=16, timeout=5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.password = parsed.password
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, discarding it if the command fails mid-flight"""
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = RedisConnection(self.host, self.port, self.db, self.password, self.timeout)
+            try:
+                yield conn
+            except (OSError, ConnectionError):
+                conn.close()
+                raise
+            else:
+                self._pool.put(conn)
+        finally:
+            self._slots.release()
+
+
+class RedisSessionStore(SessionStore):
+    """Session store on any Redis-protocol server shared by all workers and nodes
+
+    Idle expiry uses key TTLs that are refreshed on read in the same round
+    trip as the GET. Size caps are left to the server's maxmemory policy.
+    """
+
+    def __init__(self, url, ttl=3600, prefix='session:', max_connections=16):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.pool = RedisConnectionPool(url, max_connections=max_connections)
+
+    def get(self, key, default=None):
+        """Return a copy of a session and refresh its idle TTL"""
+        with self.pool.connection() as conn:
+            value, _ = conn.pipeline([
+                ('GET', self.prefix + key),
+                ('EXPIRE', self.prefix + key, self.ttl),
+            ])
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value):
+        """Write a session with the idle TTL"""
+        data = json.dumps(value, ensure_ascii=False)
+        with self.pool.connection() as conn:
+            conn.execute('SET', self.prefix + key, data, 'EX', self.ttl)
+
+    def update(self, key, fn):
+        """Replace a session with fn(current) in a WATCH/MULTI/EXEC transaction
+
+        If another client writes the key between the read and EXEC, the
+        transaction is discarded and fn runs again on the new value.
+        """
+        with self.pool.connection() as conn:
+            while True:
+                conn.execute('WATCH', self.prefix + key)
+                try:
+                    data = conn.execute('GET', self.prefix + key)
+                    value = fn(None if data is None else json.loads(data))
+                except BaseException:
+                    conn.execute('UNWATCH')
+                    raise
+                if value is None:
+                    conn.execute('UNWATCH')
+                    return None
+                data = json.dumps(value, ensure_ascii=False)
+                _, _, committed = conn.pipeline([
+                    ('MULTI',),
+                    ('SET', self.prefix + key, data, 'EX', self.ttl),
+                    ('EXEC',),
+                ])
+                if committed is not None:
+                    return value
+
+    def add(self, key, value):
+        """Store a session only if the key is free (SET NX); True if it was stored"""
+        data = json.dumps(value, ensure_ascii=False)
+        with self.pool.connection() as conn:
+            return conn.execute('SET', self.prefix + key, data, 'NX', 'EX', self.ttl) is not None
+
+    def delete(self, key):
+        """Remove a session if present"""
+        with self.pool.connection() as conn:
+            conn.execute('DEL', self.prefix + key)
+
+    def stats(self):
+        """Return live session count and server memory usage"""
+        with self.pool.connection() as conn:
+            info = conn.execute('INFO', 'memory').decode('utf-8')
+        used_memory = 0
+        for line in info.splitlines():
+            if line.startswith('used_memory:'):
+                used_memory = int(line.split(':', 1)[1])
+        return {
+            'sessions': len(self),
+            'bytes': used_memory,
+        }
+
+    def __len__(self):
+        count = 0
+        cursor = b'0'
+        with self.pool.connection() as conn:
+            while True:
+                cursor, keys = conn.execute('SCAN', cursor, 'MATCH', self.prefix + '*', 'COUNT', 1000)
+                count += len(keys)
+                if cursor in (b'0', 0):
+                    return count
+
+
+def create_session_store(backend=None, namespace=None, **options):
+    """Build the session store selected by SESSION_BACKEND (memory, sqlite or redis)
+
+    A namespace keeps other records on the same backend apart from sessions:
+    its own sqlite table or redis key prefix, with its own caps and count.
+    """
+    backend = backend or os.getenv("SESSION_BACKEND", "memory")
+    ttl = options.pop('ttl', int(os.getenv("SESSION_TTL", "3600")))
+    max_sessions = options.pop('max_sessions', int(os.getenv("SESSION_MAX_COUNT", "10000")))
+    max_bytes = options.pop('max_bytes', int(os.getenv("SESSION_MAX_BYTES", str(100 * 1024 * 1024))))
+
+    if backend == 'memory':
+        return MemorySessionStore(ttl=ttl, max_sessions=max_sessions, max_bytes=max_bytes, **options)
+    if backend == 'sqlite':
+        path = options.pop('path', os.getenv("SESSION_SQLITE_PATH", "sessions.db"))
+        if namespace:
+            options.setdefault('table', namespace)
+        return SQLiteSessionStore(path, ttl=ttl, max_sessions=max_sessions,
+                                  max_bytes=max_bytes, **options)
+    if backend == 'redis':
+        url = options.pop('url', os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        max_connections = options.pop(
+            'max_connections', int(os.getenv("REDIS_MAX_CONNECTIONS", "16"))
+        )
+        if namespace:
+            options.setdefault('prefix', namespace + ':')
+        return RedisSessionStore(url, ttl=ttl, max_connections=max_connections, **options)
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
@@ -0,0 +1,34 @@
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+class InvalidSessionToken(Exception):
+    """Raised when a session token is tampered with, expired or outdated"""
+
+
+class SessionTokens:
+    """Signed, compressed tokens that carry a follow-up's context to any worker
+
+    The token holds the canonical spec and the prompt version it was issued
+    for, so answering a follow-up needs no server-side session lookup.
+    """
+
+    def __init__(self, secret_key, prompt_version, max_age=86400):
+        # URLSafe serializers zlib-compress the payload whenever that is shorter
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='follow-up-context')
+        self.prompt_version = prompt_version
+        self.max_age = max_age
+
+    def issue(self, spec):
+        """Sign a canonical spec, dropping empty fields to keep the token short"""
+        compact = {field: value for field, value in spec.items() if value}
+        return self.serializer.dumps({'v': self.prompt_version, 's': compact})
+
+    def context(self, token):
+        """Verify a token and return the spec it carries"""
+        try:
+            payload = self.serializer.loads(token, max_age=self.max_age)
+        except BadSignature as e:
+            raise InvalidSessionToken(str(e)) from e
+        if payload.get('v') != self.prompt_version:
+            raise InvalidSessionToken("Session token was issued for another prompt version")
+        return payload['s']
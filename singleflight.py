@@ -0,0 +1,263 @@
+import asyncio
+import contextlib
+import threading
+
+
+class FlightCancelled(Exception):
+    """Ends a flight whose every subscriber went away before it finished"""
+
+
+class Flight:
+    """One in-flight generation whose text chunks are shared by every subscriber"""
+
+    def __init__(self, key):
+        self.key = key
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+        # Requests that acquired the flight and have not left it; guarded by SingleFlight's lock
+        self.subscribers = 0
+
+    def publish(self, text):
+        """Append a chunk and wake every subscriber"""
+        with self._condition:
+            self._chunks.append(text)
+            self._condition.notify_all()
+
+    def close(self, error=None):
+        """Mark the flight finished, optionally with the error that ended it"""
+        with self._condition:
+            self._done = True
+            self._error = error
+            self._condition.notify_all()
+
+    def __iter__(self):
+        """Yield every chunk from the start, then block for new ones until done"""
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._chunks) and not self._done:
+                    self._condition.wait()
+                chunks = self._chunks[index:]
+                done, error = self._done, self._error
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self._chunks):
+                if error is not None:
+                    raise error
+                return
+
+    def result(self):
+        """Wait for the flight to finish and return the assembled text"""
+        return ''.join(self)
+
+
+class SingleFlight:
+    """Collapse concurrent identical generations onto one upstream call
+
+    Streaming subscribers leave() a flight when their client goes away; once
+    none is left, the generation is stopped at its next chunk instead of
+    running to completion for nobody.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def acquire(self, key):
+        """Return (flight, is_leader); only the leader must start the generation"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = Flight(key)
+            flight.subscribers = 1
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def leave(self, flight):
+        """Unsubscribe from a flight; the last subscriber leaving cancels it"""
+        with self._lock:
+            flight.subscribers -= 1
+
+    def _abandoned(self, flight):
+        """Retire a flight nobody is subscribed to, so later requests start afresh"""
+        with self._lock:
+            if flight.subscribers > 0:
+                return False
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            self.cancelled += 1
+            return True
+
+    def run(self, flight, make_chunks):
+        """Drive the generation in the calling thread, publishing every chunk
+
+        Errors are delivered to all subscribers through the flight, so the
+        leader reads its result the same way followers do.
+        """
+        try:
+            chunks = make_chunks()
+            for text in chunks:
+                flight.publish(text)
+                if self._abandoned(flight):
+                    # Closing the generator stops the upstream stream underneath it
+                    chunks.close()
+                    flight.close(FlightCancelled("Every subscriber left"))
+                    return
+        except Exception as e:
+            flight.close(e)
+        else:
+            flight.close()
+        finally:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+
+    def run_in_background(self, flight, make_chunks):
+        """Drive the generation on its own thread so no single client owns it"""
+        thread = threading.Thread(target=self.run, args=(flight, make_chunks), daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        """Return in-flight, leader, coalesced-hit and cancelled counters"""
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'cancelled': self.cancelled,
+            }
+
+
+class AsyncFlight:
+    """Flight on one event loop: subscribers await new chunks instead of blocking a thread"""
+
+    def __init__(self, key):
+        self.key = key
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._changed = asyncio.Event()
+        # Requests that acquired the flight and have not left it
+        self.subscribers = 0
+
+    def publish(self, text):
+        """Append a chunk and wake every subscriber"""
+        self._chunks.append(text)
+        self._wake()
+
+    def close(self, error=None):
+        """Mark the flight finished, optionally with the error that ended it"""
+        self._done = True
+        self._error = error
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def __aiter__(self):
+        """Yield every chunk from the start, then await new ones until done"""
+        index = 0
+        while True:
+            changed = self._changed
+            if index < len(self._chunks):
+                chunks = self._chunks[index:]
+                index += len(chunks)
+                for text in chunks:
+                    yield text
+            elif self._done:
+                if self._error is not None:
+                    raise self._error
+                return
+            else:
+                await changed.wait()
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop
+
+    run() shares a coroutine's result: followers await the leader's task.
+    acquire() and start() share a stream of chunks, as SingleFlight does,
+    driven by a task that stops once every subscriber has left.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._flights = {}
+        self._drivers = set()
+        self.leaders = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def run(self, key, make_coroutine):
+        """Return the result for key, starting make_coroutine() only if none is in flight"""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coroutine())
+            self._tasks[key] = task
+            self.leaders += 1
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A cancelled follower must not cancel the generation the others wait on
+        return await asyncio.shield(task)
+
+    def acquire(self, key):
+        """Return (flight, is_leader) for a streamed generation; only the leader start()s it"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.subscribers += 1
+            self.coalesced += 1
+            return flight, False
+        flight = AsyncFlight(key)
+        flight.subscribers = 1
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight, True
+
+    def leave(self, flight):
+        """Unsubscribe from a flight; the last subscriber leaving cancels it"""
+        flight.subscribers -= 1
+
+    def start(self, flight, make_chunks):
+        """Drive make_chunks(), an async generator, in its own task so no single client owns it"""
+        task = asyncio.ensure_future(self._drive(flight, make_chunks))
+        self._drivers.add(task)
+        task.add_done_callback(self._drivers.discard)
+        return task
+
+    async def _drive(self, flight, make_chunks):
+        try:
+            # Leaving the block closes the generator, which stops the upstream stream underneath it
+            async with contextlib.aclosing(make_chunks()) as chunks:
+                async for text in chunks:
+                    flight.publish(text)
+                    if flight.subscribers <= 0:
+                        self.cancelled += 1
+                        flight.close(FlightCancelled("Every subscriber left"))
+                        return
+        except Exception as e:
+            flight.close(e)
+        else:
+            flight.close()
+        finally:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def stats(self):
+        return {
+            'in_flight': len(self._tasks) + len(self._flights),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'cancelled': self.cancelled,
+        }
@@ -6,8 +6,13 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Session ID to track conversation context
     let currentSessionId = null;
+    let currentSessionToken = null;
     let currentLanguage = 'English';
     
+    // In-flight requests, aborted when a newer request supersedes them
+    let recommendationController = null;
+    let questionController = null;
+    
     // Form submission handler (existing from the original code)
     const form = document.getElementById('packaging-form');
     const submitBtn = document.getElementById('submit-btn');
@@ -36,64 +41,168 @@ document.addEventListener('DOMContentLoaded', function() {
         // Clear chat history
         chatHistory.innerHTML = '';
         
+        // A new recommendation supersedes the previous one and its follow-ups
+        abortRequest(recommendationController);
+        abortRequest(questionController);
+        currentSessionId = null;
+        currentSessionToken = null;
+        const controller = new AbortController();
+        recommendationController = controller;
+        
         // Get form data
         const formData = new FormData(form);
         currentLanguage = formData.get('language');
         
-        // Send API request
-        fetch('/get_recommendation', {
+        // Stream the recommendation so text renders as soon as it arrives
+        let recommendationText = '';
+        let contentDiv = null;
+        let completed = false;
+        
+        // One key per submission, so a resent request is answered once
+        const idempotencyKey = newRequestId();
+        
+        fetch('/get_recommendation/stream', {
             method: 'POST',
-            body: formData
+            body: formData,
+            headers: { 'X-Request-ID': newRequestId(), 'Idempotency-Key': idempotencyKey },
+            signal: controller.signal
         })
-        .then(response => response.json())
-        .then(data => {
-            // Hide loading state
-            normalText.classList.remove('d-none');
-            loadingText.classList.add('d-none');
-            loadingIndicator.classList.add('d-none');
+        .then(response => {
+            // Validation errors come back as a plain JSON body
+            if (!isEventStream(response)) {
+                return response.json().then(data => {
+                    throw new Error(data.message || 'Failed to get recommendation. Please try again.');
+                });
+            }
             
-            if (data.status === 'success') {
-                // Display recommendation with enhanced formatting
-                outputDiv.innerHTML = `<div class="alert alert-success">
-                    <h4 class="alert-heading">Recommendation Ready!</h4>
-                </div>
-                <div class="recommendation-content">
-                    ${formatRecommendation(data.recommendation)}
-                </div>`;
-                
-                // Store session ID for follow-up questions
-                currentSessionId = data.session_id;
-                
-                // Show chat container
-                chatContainer.style.display = 'block';
-                
-                // Enable speak button
-                speakBtn.disabled = false;
-                stopBtn.disabled = false;
-                
-                // Add welcome message to chat
-                addChatMessage("How can I help answer questions about this packaging recommendation?", 'assistant');
-            } else {
-                // Show error
-                outputDiv.innerHTML = `<div class="alert alert-danger">
-                    <h4 class="alert-heading">Error</h4>
-                    <p>${data.message || 'Failed to get recommendation. Please try again.'}</p>
-                </div>`;
+            return readEventStream(response, function(event, data) {
+                if (event === 'session') {
+                    // Store session ID for follow-up questions
+                    currentSessionId = data.session_id;
+                    currentSessionToken = data.session_token;
+                } else if (event === 'delta') {
+                    if (!contentDiv) {
+                        // Hide loading state on the first token
+                        hideLoadingState();
+                        outputDiv.innerHTML = '<div class="recommendation-content"></div>';
+                        contentDiv = outputDiv.querySelector('.recommendation-content');
+                    }
+                    recommendationText += data.text;
+                    contentDiv.innerHTML = formatRecommendation(recommendationText);
+                } else if (event === 'done') {
+                    completed = true;
+                } else if (event === 'error') {
+                    throw new Error(data.message);
+                }
+            });
+        })
+        .then(() => {
+            if (!completed) {
+                throw new Error('Connection closed before the recommendation finished.');
             }
+            
+            hideLoadingState();
+            
+            // Display recommendation with enhanced formatting
+            outputDiv.innerHTML = `<div class="alert alert-success">
+                <h4 class="alert-heading">Recommendation Ready!</h4>
+            </div>
+            <div class="recommendation-content">
+                ${formatRecommendation(recommendationText)}
+            </div>`;
+            
+            // Show chat container
+            chatContainer.style.display = 'block';
+            
+            // Enable speak button
+            speakBtn.disabled = false;
+            stopBtn.disabled = false;
+            
+            // Add welcome message to chat
+            addChatMessage("How can I help answer questions about this packaging recommendation?", 'assistant');
         })
         .catch(error => {
+            // A superseded request leaves the page to the request that replaced it
+            if (error.name === 'AbortError') return;
+            
             // Handle error
-            normalText.classList.remove('d-none');
-            loadingText.classList.add('d-none');
-            loadingIndicator.classList.add('d-none');
+            hideLoadingState();
             
             outputDiv.innerHTML = `<div class="alert alert-danger">
                 <h4 class="alert-heading">Error</h4>
-                <p>Network error: ${error.message}</p>
+                <p>${error.message || 'Failed to get recommendation. Please try again.'}</p>
             </div>`;
         });
     });
     
+    // Function to abort a request that is no longer wanted
+    function abortRequest(controller) {
+        if (controller) {
+            controller.abort();
+        }
+    }
+    
+    // Function to create a unique ID (request IDs and idempotency keys)
+    function newRequestId() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
+    
+    // Function to restore the submit button after a request
+    function hideLoadingState() {
+        normalText.classList.remove('d-none');
+        loadingText.classList.add('d-none');
+        loadingIndicator.classList.add('d-none');
+    }
+    
+    // Function to check whether a response is a Server-Sent Events stream
+    function isEventStream(response) {
+        const contentType = response.headers.get('Content-Type') || '';
+        return response.ok && contentType.indexOf('text/event-stream') !== -1;
+    }
+    
+    // Function to read a Server-Sent Events stream from a fetch response
+    function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        function dispatch(block) {
+            let event = 'message';
+            const dataLines = [];
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trim());
+                }
+            });
+            if (dataLines.length) {
+                onEvent(event, JSON.parse(dataLines.join('\n')));
+            }
+        }
+        
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                if (done) {
+                    if (buffer.trim()) dispatch(buffer);
+                    return;
+                }
+                buffer += decoder.decode(value, { stream: true });
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    dispatch(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                }
+                return pump();
+            });
+        }
+        
+        return pump();
+    }
+    
     // Send question handler
     sendQuestionBtn.addEventListener('click', sendQuestion);
     
@@ -132,35 +241,74 @@ document.addEventListener('DOMContentLoaded', function() {
         const formData = new FormData();
         formData.append('question', question);
         formData.append('session_id', currentSessionId);
+        if (currentSessionToken) {
+            formData.append('session_token', currentSessionToken);
+        }
         formData.append('language', currentLanguage);
         
-        // Send question to API
-        fetch('/ask_question', {
+        // Stream the answer into a chat bubble that grows as tokens arrive
+        let answerText = '';
+        let answerDiv = null;
+        let completed = false;
+        
+        const controller = new AbortController();
+        questionController = controller;
+        
+        const idempotencyKey = newRequestId();
+        
+        fetch('/ask_question/stream', {
             method: 'POST',
-            body: formData
+            body: formData,
+            headers: { 'X-Request-ID': newRequestId(), 'Idempotency-Key': idempotencyKey },
+            signal: controller.signal
         })
-        .then(response => response.json())
-        .then(data => {
-            // Remove thinking message
-            removeThinkingMessage(thinkingId);
+        .then(response => {
+            if (!isEventStream(response)) {
+                return response.json().then(data => {
+                    throw new Error(data.message || 'Failed to process question.');
+                });
+            }
             
-            if (data.status === 'success') {
-                // Add assistant response to chat
-                addChatMessage(data.answer, 'assistant');
-                
-                // Scroll to bottom of chat
-                chatHistory.scrollTop = chatHistory.scrollHeight;
-            } else {
-                // Show error in chat
-                addChatMessage("Sorry, I encountered an error: " + data.message, 'assistant');
+            return readEventStream(response, function(event, data) {
+                if (event === 'delta') {
+                    if (!answerDiv) {
+                        // Replace the thinking message with the live answer
+                        removeThinkingMessage(thinkingId);
+                        answerDiv = addChatMessage('', 'assistant');
+                    }
+                    answerText += data.text;
+                    answerDiv.innerHTML = formatRecommendation(answerText);
+                    
+                    // Scroll to bottom of chat
+                    chatHistory.scrollTop = chatHistory.scrollHeight;
+                } else if (event === 'reset') {
+                    // The answer is being regenerated by a larger model: start over
+                    answerText = '';
+                    if (answerDiv) {
+                        answerDiv.innerHTML = formatRecommendation(answerText);
+                    }
+                } else if (event === 'done') {
+                    completed = true;
+                } else if (event === 'error') {
+                    throw new Error(data.message);
+                }
+            });
+        })
+        .then(() => {
+            if (!completed) {
+                throw new Error('Connection closed before the answer finished.');
             }
+            removeThinkingMessage(thinkingId);
         })
         .catch(error => {
             // Remove thinking message
             removeThinkingMessage(thinkingId);
             
+            // Aborted because a new recommendation replaced this conversation
+            if (error.name === 'AbortError') return;
+            
             // Show error in chat
-            addChatMessage("Sorry, there was a problem with your request: " + error.message, 'assistant');
+            addChatMessage("Sorry, I encountered an error: " + error.message, 'assistant');
         });
     }
     
@@ -180,6 +328,8 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Scroll to bottom of chat
         chatHistory.scrollTop = chatHistory.scrollHeight;
+        
+        return messageDiv;
     }
     
     // Function to add a "thinking" message
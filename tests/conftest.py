@@ -0,0 +1,9 @@
+import os
+
+# The app is imported with the offline stub backend and in-process stores
+os.environ.setdefault('LLM_BACKEND', 'stub')
+os.environ.setdefault('STUB_LATENCY', 'fixed:20')
+os.environ.setdefault('STUB_TOKENS_PER_SEC', '100000')
+os.environ.setdefault('SESSION_BACKEND', 'memory')
+os.environ.setdefault('ADMISSION_IP_RATE', '0')
+os.environ.setdefault('ADMISSION_SESSION_RATE', '0')
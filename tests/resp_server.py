@@ -0,0 +1,179 @@
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+
+
+class _NullArray:
+    """Reply for an EXEC discarded because a watched key changed"""
+
+
+NULL_ARRAY = _NullArray()
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    """In-process stand-in for a Redis server, covering the commands the session store sends
+
+    Keys carry a version bumped on every write, which is what WATCH compares
+    at EXEC. Expiry runs on a clock tests can advance() instead of sleeping.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _RespHandler)
+        self.lock = threading.Lock()
+        # key -> (value, expires_at or None)
+        self.data = {}
+        self.versions = {}
+        self.offset = 0.0
+        self.commands = []
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f'redis://{host}:{port}/0'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def advance(self, seconds):
+        """Move the expiry clock forward"""
+        with self.lock:
+            self.offset += seconds
+
+    def now(self):
+        return time.monotonic() + self.offset
+
+    def count(self, name):
+        """How many times a command was received"""
+        with self.lock:
+            return self.commands.count(name)
+
+    def lookup(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and self.now() >= expires_at:
+            self.write(key, None)
+            return None
+        return value
+
+    def write(self, key, value, ttl=None):
+        if value is None:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = (value, None if ttl is None else self.now() + ttl)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.watched = {}
+        self.queued = None
+
+    def handle(self):
+        while True:
+            try:
+                args = self._read_command()
+            except ConnectionError:
+                return
+            self.wfile.write(self._encode(self._dispatch(args)))
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _dispatch(self, args):
+        name = args[0].decode('utf-8').upper()
+        server = self.server
+        with server.lock:
+            server.commands.append(name)
+            if self.queued is not None and name not in ('EXEC', 'MULTI'):
+                self.queued.append((name, args[1:]))
+                return 'QUEUED'
+            if name == 'MULTI':
+                self.queued = []
+                return 'OK'
+            if name == 'EXEC':
+                queued, self.queued = self.queued, None
+                watched, self.watched = self.watched, {}
+                if any(server.versions.get(key, 0) != version for key, version in watched.items()):
+                    return NULL_ARRAY
+                return [self._execute(queued_name, queued_args) for queued_name, queued_args in queued]
+            return self._execute(name, args[1:])
+
+    def _execute(self, name, args):
+        server = self.server
+        if name in ('AUTH', 'SELECT'):
+            return 'OK'
+        if name == 'WATCH':
+            for key in args:
+                server.lookup(key)
+                self.watched[key] = server.versions.get(key, 0)
+            return 'OK'
+        if name == 'UNWATCH':
+            self.watched = {}
+            return 'OK'
+        if name == 'GET':
+            return server.lookup(args[0])
+        if name == 'SET':
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            ttl = int(options[options.index(b'EX') + 1]) if b'EX' in options else None
+            if b'NX' in options and server.lookup(key) is not None:
+                return None
+            server.write(key, value, ttl)
+            return 'OK'
+        if name == 'EXPIRE':
+            value = server.lookup(args[0])
+            if value is None:
+                return 0
+            server.data[args[0]] = (value, server.now() + int(args[1]))
+            return 1
+        if name == 'DEL':
+            removed = [key for key in args if server.lookup(key) is not None]
+            for key in removed:
+                server.write(key, None)
+            return len(removed)
+        if name == 'SCAN':
+            pattern = args[args.index(b'MATCH') + 1].decode('utf-8') if b'MATCH' in args else '*'
+            keys = [key for key in list(server.data) if server.lookup(key) is not None
+                    and fnmatch.fnmatchcase(key.decode('utf-8'), pattern)]
+            return [b'0', keys]
+        if name == 'INFO':
+            used = sum(len(key) + len(value) for key, (value, _) in server.data.items())
+            return f'# Memory\r\nused_memory:{used}\r\n'.encode('utf-8')
+        return RuntimeError(f"ERR unknown command '{name}'")
+
+    @classmethod
+    def _encode(cls, reply):
+        if reply is NULL_ARRAY:
+            return b'*-1\r\n'
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, str):
+            return b'+%s\r\n' % reply.encode('utf-8')
+        if isinstance(reply, Exception):
+            return b'-%s\r\n' % str(reply).encode('utf-8')
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, bytes):
+            return b'$%d\r\n%s\r\n' % (len(reply), reply)
+        return b'*%d\r\n' % len(reply) + b''.join(cls._encode(item) for item in reply)
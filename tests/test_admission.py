@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import admission
+
+
+def test_requests_beyond_the_limit_queue_in_order_then_are_rejected():
+    controller = admission.AdmissionController(max_concurrent=1, max_queued=2, max_wait=5,
+                                               ip_rate=0, session_rate=0)
+    held = controller.acquire()
+    order = []
+
+    def wait(name):
+        permit = controller.acquire()
+        order.append(name)
+        permit.release()
+
+    threads = []
+    for name in ('first', 'second'):
+        threads.append(threading.Thread(target=wait, args=(name,)))
+        threads[-1].start()
+        while controller.stats()['queued'] < len(threads):
+            time.sleep(0.005)
+
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        controller.acquire()
+    assert rejected.value.reason == 'queue_full'
+
+    held.release()
+    for thread in threads:
+        thread.join()
+    assert order == ['first', 'second']
+    assert controller.stats()['active'] == 0
+
+
+def test_queued_request_times_out():
+    controller = admission.AdmissionController(max_concurrent=1, max_wait=0.05, ip_rate=0, session_rate=0)
+    controller.acquire()
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        controller.acquire()
+    assert rejected.value.reason == 'queue_timeout'
+    assert controller.stats()['queued'] == 0
+
+
+def test_client_over_its_rate_is_rejected_with_retry_after():
+    controller = admission.AdmissionController(ip_rate=0.5, ip_burst=2, session_rate=0)
+    for _ in range(2):
+        controller.acquire(client_ip='10.0.0.1').release()
+
+    with pytest.raises(admission.AdmissionRejected) as rejected:
+        controller.acquire(client_ip='10.0.0.1')
+    assert rejected.value.reason == 'ip_rate'
+    assert rejected.value.retry_after == 2
+    # Other clients have their own bucket
+    controller.acquire(client_ip='10.0.0.2').release()
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    controller = admission.AdmissionController(max_concurrent=1, max_wait=5, ip_rate=0, session_rate=0)
+
+    async def main():
+        held = await controller.aacquire()
+        waiter = asyncio.ensure_future(controller.aacquire())
+        await asyncio.sleep(0.01)
+        assert controller.stats()['queued'] == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        held.release()
+
+    asyncio.run(main())
+    assert controller.stats()['queued'] == 0
+    assert controller.stats()['active'] == 0
@@ -0,0 +1,17 @@
+import app
+
+
+def sample(exposition, line_prefix):
+    return next(float(line.rsplit(' ', 1)[1]) for line in exposition.splitlines() if line.startswith(line_prefix))
+
+
+def test_session_store_size_is_exported_per_namespace():
+    app.conversation_history.set('metrics-session', {'history': ['x' * 100]})
+    exposition = app.app.test_client().get('/metrics').get_data(as_text=True)
+    stats = app.conversation_history.stats()
+
+    assert sample(exposition, 'session_store_entries{store="sessions"}') == stats['sessions']
+    assert sample(exposition, 'session_store_bytes{store="sessions"}') == stats['bytes'] > 100
+    assert sample(exposition, 'session_store_evictions_total{store="sessions"}') == stats['evictions']
+    assert 'session_store_entries{store="idempotency"}' in exposition
+    assert 'session_store_entries{store="jobs"}' in exposition
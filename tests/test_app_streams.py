@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import app
+
+FORM = {
+    'product_category': 'snacks',
+    'printing_type': 'flexo',
+    'layer_structure': 'triplex',
+    'packaging_material': 'PET/AL/PE',
+    'packaging_type': 'pouch',
+}
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def first_event(response):
+    chunk = next(iter(response.response))
+    event, data = chunk.decode('utf-8').strip().split('\n')
+    return event.split(': ', 1)[1], json.loads(data.split(': ', 1)[1])
+
+
+def test_disconnect_after_session_event_fails_session_and_releases_key(client):
+    response = client.post('/get_recommendation/stream', data={**FORM, 'product_category': 'dropped'},
+                           headers={'Idempotency-Key': 'drop-1'}, buffered=False)
+    event, data = first_event(response)
+    assert event == 'session'
+    response.close()
+
+    assert app.conversation_history[data['session_id']]['status'] == 'failed'
+    # The key was released, so a retry runs afresh instead of waiting on a dead in-flight marker
+    retry = client.post('/get_recommendation/stream', data={**FORM, 'product_category': 'dropped'},
+                        headers={'Idempotency-Key': 'drop-1'})
+    assert retry.status_code == 200
+    assert 'Idempotent-Replayed' not in retry.headers
+    assert 'event: done' in retry.get_data(as_text=True)
+
+
+def test_finished_stream_is_replayed_for_its_key(client):
+    first = client.post('/get_recommendation/stream', data=FORM, headers={'Idempotency-Key': 'replay-1'})
+    session_id = json.loads(first.get_data(as_text=True).split('\n')[1].split(': ', 1)[1])['session_id']
+    repeat = client.post('/get_recommendation/stream', data=FORM, headers={'Idempotency-Key': 'replay-1'})
+    assert repeat.headers['Idempotent-Replayed'] == 'true'
+    assert session_id in repeat.get_data(as_text=True)
+    assert repeat.get_data(as_text=True).count('event: delta') == 1
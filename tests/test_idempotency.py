@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import idempotency
+import session_locks
+import session_store
+
+
+def make_store(**options):
+    return idempotency.IdempotencyStore(session_store.MemorySessionStore(),
+                                        session_locks.StripedLocks(), **options)
+
+
+def test_repeat_waits_for_the_original_and_gets_its_outcome():
+    store = make_store()
+    digest = idempotency.fingerprint('recommend', {'query': 'laptops'})
+    assert store.claim('key', digest, timeout=0) is None
+
+    # A repeat while the original runs sees the in-flight marker once its wait runs out
+    assert store.claim('key', digest, timeout=0)['status'] == idempotency.IN_FLIGHT
+
+    threading.Timer(0.05, store.complete, args=('key', digest, 200, '{"ok": true}', 'application/json')).start()
+    record = store.claim('key', digest, timeout=5)
+    assert record['status'] == idempotency.COMPLETED
+    assert record['response'] == {'status': 200, 'body': '{"ok": true}', 'mimetype': 'application/json'}
+
+
+def test_key_reused_for_another_payload_is_a_conflict():
+    store = make_store()
+    assert store.claim('key', idempotency.fingerprint('a'), timeout=0) is None
+    with pytest.raises(idempotency.IdempotencyConflict):
+        store.claim('key', idempotency.fingerprint('b'), timeout=0)
+
+
+def test_released_or_abandoned_marker_lets_a_retry_run():
+    store = make_store(lease=0.05)
+    digest = idempotency.fingerprint('a')
+    assert store.claim('key', digest, timeout=0) is None
+    store.release('key')
+    assert store.claim('key', digest, timeout=0) is None
+
+    # Nobody completes or releases this one: its worker died
+    time.sleep(0.1)
+    assert store.claim('key', digest, timeout=0) is None
+
+
+def test_exactly_one_of_concurrent_claims_runs_the_request():
+    store = make_store()
+    digest = idempotency.fingerprint('a')
+    results = []
+    barrier = threading.Barrier(8)
+
+    def claim():
+        barrier.wait()
+        results.append(store.claim('key', digest, timeout=0))
+
+    threads = [threading.Thread(target=claim) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(None) == 1
+
+
+def test_async_claim_is_woken_by_completion_on_another_thread():
+    store = make_store()
+    digest = idempotency.fingerprint('a')
+    assert store.claim('key', digest, timeout=0) is None
+
+    async def repeat():
+        threading.Timer(0.05, store.complete, args=('key', digest, 200, 'done', 'text/plain')).start()
+        started = time.monotonic()
+        record = await store.aclaim('key', digest, timeout=5)
+        return record, time.monotonic() - started
+
+    record, waited = asyncio.run(repeat())
+    assert record['response']['body'] == 'done'
+    assert waited < 1
@@ -0,0 +1,45 @@
+import json
+import os
+import time
+
+import metrics
+
+
+def test_recording_samples_never_runs_collectors(tmp_path):
+    registry = metrics.Registry(str(tmp_path), flush_interval=60)
+    calls = []
+    registry.add_collector(lambda: calls.append(1))
+    requests = registry.counter('requests_total', 'Requests')
+
+    for _ in range(100):
+        requests.inc()
+    assert calls == []
+
+    assert 'requests_total 100' in registry.exposition()
+    assert calls == [1]
+
+
+def test_snapshots_are_flushed_in_the_background(tmp_path):
+    registry = metrics.Registry(str(tmp_path), flush_interval=0.05)
+    registry.gauge('live', 'Live things').set(3)
+    path = tmp_path / f'metrics_{os.getpid()}.json'
+
+    deadline = time.monotonic() + 5
+    while not path.exists():
+        assert time.monotonic() < deadline, "no snapshot was flushed"
+        time.sleep(0.01)
+    assert json.loads(path.read_text())['metrics']['live']['samples'] == [[[], 3]]
+
+
+def test_cleared_directory_forgets_the_last_runs_workers(tmp_path):
+    stale = {'pid': 2 ** 22 + 1, 'metrics': {'requests_total': {
+        'type': 'counter', 'help': 'Requests', 'labelnames': [], 'mode': 'sum', 'samples': [[[], 7]]}}}
+    (tmp_path / 'metrics_1.json').write_text(json.dumps(stale))
+    registry = metrics.Registry(str(tmp_path), flush_interval=60)
+    registry.counter('requests_total', 'Requests').inc()
+    # An exited worker's counters still count...
+    assert registry.collect()['requests_total']['samples'] == [[[], 8]]
+
+    # ...until the server restarts and empties the directory
+    metrics.clear_directory(str(tmp_path))
+    assert registry.collect()['requests_total']['samples'] == [[[], 1]]
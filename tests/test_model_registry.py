@@ -0,0 +1,27 @@
+import llm_backends
+import model_registry
+
+
+def test_handles_are_shared_within_a_worker_and_rebuilt_after_a_fork(monkeypatch):
+    first = model_registry.get_model('stub-model', {'temperature': 0.2})
+    assert model_registry.get_model('stub-model', {'temperature': 0.2}) is first
+    assert model_registry.get_model('stub-model', {'temperature': 0.9}) is not first
+
+    monkeypatch.setattr(model_registry.os, 'getpid', lambda: -1)
+    assert model_registry.get_model('stub-model', {'temperature': 0.2}) is not first
+
+
+def test_gemini_clients_are_configured_once_per_worker(monkeypatch):
+    configured = []
+    monkeypatch.setattr(llm_backends.genai, 'configure', lambda **options: configured.append(options))
+    backend = llm_backends.GeminiBackend(api_key='test-key')
+    assert configured == []
+
+    model = backend.create_model('gemini-1.5-flash', {'temperature': 0.2}, [])
+    backend.create_model('gemini-1.5-pro', {'temperature': 0.2}, [])
+    assert configured == [{'api_key': 'test-key'}]
+    assert model.model_name == 'models/gemini-1.5-flash'
+
+    monkeypatch.setattr(llm_backends.os, 'getpid', lambda: -1)
+    backend.create_model('gemini-1.5-flash', {'temperature': 0.2}, [])
+    assert len(configured) == 2
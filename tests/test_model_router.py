@@ -0,0 +1,22 @@
+import model_router
+
+
+def answer(words, *labels):
+    return ' '.join(list(labels) + ['detail'] * words)
+
+
+def test_english_answer_missing_its_sections_is_escalated():
+    router = model_router.ModelRouter()
+    assert router.escalation_reason('flash', answer(50)) == 'missing_sections'
+    assert router.escalation_reason('flash', answer(50, '**Key Analysis**', '**Recommendation**')) is None
+    assert router.escalation_reason('flash', answer(5, '**Key Analysis**', '**Recommendation**')) == 'too_short'
+    # The escalation tier's own answers are never re-asked
+    assert router.escalation_reason('pro', answer(5)) is None
+
+
+def test_answer_in_another_language_is_not_held_to_english_labels():
+    router = model_router.ModelRouter()
+    hindi = answer(50, '📌 **मुख्य विश्लेषण**', '💡 **सिफारिश**')
+    assert router.escalation_reason('flash', hindi, 'Hindi') is None
+    assert router.escalation_reason('flash', answer(5, 'संक्षिप्त'), 'Hindi') == 'too_short'
+    assert router.escalation_reason('flash', '', 'Hindi') == 'empty'
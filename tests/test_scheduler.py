@@ -0,0 +1,73 @@
+import queue
+import threading
+import time
+
+import scheduler
+
+
+def start_waiter(sched, priority, granted):
+    """Queue an acquire on its own thread; granted receives (priority, slot) once it is served"""
+    def run():
+        slot = sched.acquire(priority, 10)
+        granted.put((priority, slot))
+    threading.Thread(target=run, daemon=True).start()
+
+
+def wait_queued(sched, priority, count):
+    deadline = time.monotonic() + 5
+    while sched.stats()['queued'][priority] < count:
+        assert time.monotonic() < deadline, f"{count} {priority} waiters never queued"
+        time.sleep(0.005)
+
+
+def test_follow_up_overtakes_an_aged_recommendation_backlog():
+    sched = scheduler.PriorityScheduler(slots=2, max_age=0.1)
+    held = [sched.acquire(scheduler.RECOMMENDATION, 1) for _ in range(2)]
+    granted = queue.Queue()
+    for _ in range(30):
+        start_waiter(sched, scheduler.RECOMMENDATION, granted)
+    wait_queued(sched, scheduler.RECOMMENDATION, 30)
+    # Every queued recommendation is now older than max_age
+    time.sleep(0.2)
+    start_waiter(sched, scheduler.INTERACTIVE, granted)
+    wait_queued(sched, scheduler.INTERACTIVE, 1)
+
+    held[0].release()
+    priority, slot = granted.get(timeout=5)
+
+    assert priority == scheduler.INTERACTIVE
+    assert sched.stats()['promoted'] == {priority: 0 for priority in scheduler.PRIORITIES}
+    slot.release()
+    held[1].release()
+
+
+def test_starved_class_is_promoted_while_others_are_served():
+    weights = {scheduler.INTERACTIVE: 6, scheduler.RECOMMENDATION: 3, scheduler.BACKGROUND: 0.0001}
+    sched = scheduler.PriorityScheduler(slots=1, weights=weights, max_age=0.1)
+    slot = sched.acquire(scheduler.INTERACTIVE, 1)
+    granted = queue.Queue()
+    for _ in range(40):
+        start_waiter(sched, scheduler.INTERACTIVE, granted)
+    wait_queued(sched, scheduler.INTERACTIVE, 40)
+    start_waiter(sched, scheduler.BACKGROUND, granted)
+    wait_queued(sched, scheduler.BACKGROUND, 1)
+
+    def serve_until_background():
+        nonlocal slot
+        served = []
+        while scheduler.BACKGROUND not in served:
+            time.sleep(0.02)
+            slot.release()
+            priority, slot = granted.get(timeout=5)
+            served.append(priority)
+        return served
+
+    # The first background grant spends its tiny weight: it now trails every follow-up
+    serve_until_background()
+    start_waiter(sched, scheduler.BACKGROUND, granted)
+    wait_queued(sched, scheduler.BACKGROUND, 1)
+    served = serve_until_background()
+
+    assert len(served) < 20
+    assert sched.stats()['promoted'][scheduler.BACKGROUND] == 1
+    slot.release()
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+import time
+
+import session_locks
+
+
+def test_a_session_always_maps_to_the_same_stripe():
+    locks = session_locks.StripedLocks(stripes=4)
+    assert locks.condition_for('session-1') is locks.condition_for('session-1')
+    assert len({id(locks.condition_for(f'session-{n}')) for n in range(100)}) == 4
+
+
+def test_async_wait_is_woken_by_notify_from_a_thread():
+    condition = session_locks.StripeCondition()
+
+    def notify():
+        with condition:
+            condition.notify_all()
+
+    async def wait():
+        threading.Timer(0.05, notify).start()
+        started = time.monotonic()
+        await condition.wait_async(5)
+        return time.monotonic() - started
+
+    assert asyncio.run(wait()) < 1
+    assert not condition._futures
+
+
+def test_async_wait_times_out_without_a_notify():
+    condition = session_locks.StripeCondition()
+
+    async def wait():
+        started = time.monotonic()
+        await condition.wait_async(0.05)
+        return time.monotonic() - started
+
+    assert 0.04 < asyncio.run(wait()) < 1
+    assert not condition._futures
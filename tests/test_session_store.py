@@ -0,0 +1,164 @@
+import io
+import threading
+
+import pytest
+
+import session_store
+from resp_server import RespServer
+
+
+@pytest.fixture
+def redis_server():
+    server = RespServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def store(request, tmp_path):
+    options = {'ttl': 60}
+    if request.param == 'sqlite':
+        options['path'] = str(tmp_path / 'sessions.db')
+    if request.param == 'redis':
+        options['url'] = request.getfixturevalue('redis_server').url
+    return session_store.create_session_store(request.param, **options)
+
+
+def read_reply(data):
+    conn = object.__new__(session_store.RedisConnection)
+    conn.reader = io.BytesIO(data)
+    return conn._read_reply()
+
+
+def test_resp_parser_reads_every_reply_type():
+    assert read_reply(b'+OK\r\n') == 'OK'
+    assert read_reply(b':42\r\n') == 42
+    assert read_reply(b'$-1\r\n') is None
+    assert read_reply(b'*-1\r\n') is None
+    # Bulk strings are length-prefixed, so they may hold CRLF
+    assert read_reply(b'$7\r\nab\r\ncd\xc3\r\n') == b'ab\r\ncd\xc3'
+    assert read_reply(b'*3\r\n$1\r\n0\r\n*2\r\n$1\r\na\r\n$-1\r\n:1\r\n') == [b'0', [b'a', None], 1]
+
+    error = read_reply(b'-WRONGTYPE wrong kind of value\r\n')
+    assert isinstance(error, session_store.RedisError)
+    assert str(error) == 'WRONGTYPE wrong kind of value'
+
+    with pytest.raises(ConnectionError):
+        read_reply(b'')
+
+
+def test_round_trip_add_and_update(store):
+    session = {'history': ['Привет'], 'turns': 1}
+    store.set('a', session)
+    assert store.get('a') == session
+    assert 'a' in store and 'b' not in store
+
+    assert store.add('b', {'turns': 0})
+    assert not store.add('b', {'turns': 99})
+    assert store.get('b') == {'turns': 0}
+
+    assert store.update('b', lambda current: {'turns': current['turns'] + 1}) == {'turns': 1}
+    # Returning None leaves the value alone
+    assert store.update('b', lambda current: None) is None
+    assert store.get('b') == {'turns': 1}
+    assert store.update('c', lambda current: None) is None
+    assert store.get('c') is None
+
+    store.delete('a')
+    assert store.get('a') is None
+    assert len(store) == 1
+
+
+def test_concurrent_updates_are_not_lost(store):
+    store.set('counter', {'n': 0})
+
+    def increment():
+        for _ in range(20):
+            store.update('counter', lambda current: {'n': current['n'] + 1})
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert store.get('counter') == {'n': 160}
+
+
+def test_redis_update_retries_when_the_key_changes_under_it(redis_server):
+    store = session_store.create_session_store('redis', url=redis_server.url)
+    other = session_store.create_session_store('redis', url=redis_server.url)
+    store.set('s', {'n': 1})
+    seen = []
+
+    def bump(current):
+        seen.append(current['n'])
+        if len(seen) == 1:
+            # Another worker commits between this worker's WATCH and EXEC
+            other.set('s', {'n': 10})
+        return {'n': current['n'] + 1}
+
+    assert store.update('s', bump) == {'n': 11}
+    assert seen == [1, 10]
+    assert store.get('s') == {'n': 11}
+    assert redis_server.count('EXEC') == 2
+
+
+def test_redis_add_is_a_single_set_nx(redis_server):
+    store = session_store.create_session_store('redis', url=redis_server.url)
+    assert store.add('k', {'owner': 1})
+    assert not store.add('k', {'owner': 2})
+    assert store.get('k') == {'owner': 1}
+    assert redis_server.count('WATCH') == 0
+
+
+def test_redis_namespaces_keep_records_apart(redis_server):
+    sessions = session_store.create_session_store('redis', url=redis_server.url)
+    records = session_store.create_session_store('redis', namespace='idempotency', url=redis_server.url)
+    sessions.set('k', {'kind': 'session'})
+    records.set('k', {'kind': 'record'})
+
+    assert sessions.get('k') == {'kind': 'session'}
+    assert records.get('k') == {'kind': 'record'}
+    assert set(redis_server.data) == {b'session:k', b'idempotency:k'}
+    assert len(sessions) == 1 and len(records) == 1
+    assert sessions.stats()['sessions'] == 1
+
+
+def test_redis_ttl_is_idle_time_refreshed_by_reads(redis_server):
+    store = session_store.create_session_store('redis', url=redis_server.url, ttl=60)
+    store.set('k', {'n': 1})
+
+    redis_server.advance(40)
+    assert store.get('k') == {'n': 1}
+    redis_server.advance(40)
+    assert store.get('k') == {'n': 1}
+
+    redis_server.advance(61)
+    assert store.get('k') is None
+    # An expired key is free again for an insert-if-absent
+    assert store.add('k', {'n': 2})
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = session_store.MemorySessionStore(max_sessions=2)
+    store.set('a', {'n': 1})
+    store.set('b', {'n': 2})
+    store.get('a')
+    store.set('c', {'n': 3})
+
+    assert store.get('b') is None
+    assert store.get('a') == {'n': 1}
+    assert store.stats()['evictions'] == 1
+
+
+def test_sqlite_namespaces_use_their_own_table(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    sessions = session_store.create_session_store('sqlite', path=path)
+    records = session_store.create_session_store('sqlite', namespace='idempotency', path=path)
+    sessions.set('k', {'kind': 'session'})
+    records.set('k', {'kind': 'record'})
+
+    assert sessions.get('k') == {'kind': 'session'}
+    assert records.get('k') == {'kind': 'record'}
+    assert records.table == 'idempotency'
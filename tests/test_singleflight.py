@@ -0,0 +1,111 @@
+import asyncio
+import threading
+
+import pytest
+
+import singleflight
+
+
+def test_concurrent_identical_requests_share_one_generation():
+    flights = singleflight.SingleFlight()
+    flight, leader = flights.acquire('query')
+    follower, is_leader = flights.acquire('query')
+    assert leader and not is_leader and follower is flight
+
+    flights.run_in_background(flight, lambda: iter(['a', 'b', 'c']))
+    assert flight.result() == 'abc'
+    assert follower.result() == 'abc'
+    assert flights.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 1, 'cancelled': 0}
+
+
+def test_error_reaches_every_subscriber():
+    flights = singleflight.SingleFlight()
+    flight, _ = flights.acquire('query')
+
+    def chunks():
+        yield 'a'
+        raise RuntimeError("upstream failed")
+
+    flights.run(flight, chunks)
+    with pytest.raises(RuntimeError):
+        flight.result()
+    # A finished flight is retired, so the next request starts afresh
+    assert flights.acquire('query')[1]
+
+
+def test_generation_stops_once_every_subscriber_left():
+    flights = singleflight.SingleFlight()
+    flight, _ = flights.acquire('query')
+    flights.acquire('query')
+    produced, closed = [], threading.Event()
+
+    def chunks():
+        try:
+            for n in range(100):
+                produced.append(n)
+                yield str(n)
+        finally:
+            closed.set()
+
+    flights.leave(flight)
+    flights.leave(flight)
+    flights.run(flight, chunks)
+
+    assert closed.is_set()
+    assert len(produced) == 1
+    with pytest.raises(singleflight.FlightCancelled):
+        flight.result()
+    assert flights.stats()['cancelled'] == 1
+
+
+def test_async_run_coalesces_and_survives_a_cancelled_follower():
+    flights = singleflight.AsyncSingleFlight()
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'text'
+
+    async def main():
+        leader = asyncio.ensure_future(flights.run('query', generate))
+        follower = asyncio.ensure_future(flights.run('query', generate))
+        await asyncio.sleep(0)
+        follower.cancel()
+        return await leader
+
+    assert asyncio.run(main()) == 'text'
+    assert calls == [1]
+    assert flights.stats()['coalesced'] == 1
+
+
+def test_async_stream_stops_once_every_subscriber_left():
+    flights = singleflight.AsyncSingleFlight()
+    closed = []
+
+    async def chunks():
+        try:
+            for n in range(100):
+                await asyncio.sleep(0.01)
+                yield str(n)
+        finally:
+            closed.append(True)
+
+    async def main():
+        flight, leader = flights.acquire('query')
+        follower, _ = flights.acquire('query')
+        assert leader and follower is flight
+        driver = flights.start(flight, chunks)
+        received = []
+        async for text in flight:
+            received.append(text)
+            if len(received) == 2:
+                break
+        flights.leave(flight)
+        flights.leave(flight)
+        await driver
+        return received
+
+    assert asyncio.run(main()) == ['0', '1']
+    assert closed == [True]
+    assert flights.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 1, 'cancelled': 1}
@@ -0,0 +1,52 @@
+import time
+from types import SimpleNamespace
+
+import scheduler
+import upstream_client
+
+
+class TimedModel:
+    """A blocking model handle whose prompt is the number of seconds the call takes"""
+
+    model_name = 'gemini-1.5-pro'
+
+    def generate_content(self, prompt, request_options=None):
+        time.sleep(float(prompt))
+        return SimpleNamespace(text=prompt, usage_metadata=None)
+
+
+def hedging_client():
+    policy = upstream_client.HedgePolicy(
+        quantile=0.9, initial_delay=1.0, min_delay=0.001, min_samples=10,
+        budget=upstream_client.RetryBudget(ratio=1.0, min_per_sec=100, max_tokens=100)
+    )
+    return upstream_client.UpstreamClient(hedge=policy)
+
+
+def hedges(client):
+    stats = client.stats()['hedges']
+    return stats['won'] + stats['lost']
+
+
+def test_mixed_workload_hedges_only_slow_outliers():
+    client = hedging_client()
+    model = TimedModel()
+    # Follow-ups take ~10 ms and recommendations ~100 ms on the same model and mode
+    for latency in ['0.008'] * 8 + ['0.012'] * 2:
+        client.generate(model, latency, 5, priority=scheduler.INTERACTIVE)
+    for latency in ['0.08'] * 8 + ['0.12'] * 2:
+        client.generate(model, latency, 5, priority=scheduler.RECOMMENDATION)
+
+    # Ordinary calls of either class stay under their own class's quantile
+    for _ in range(5):
+        client.generate(model, '0.008', 5, priority=scheduler.INTERACTIVE)
+        client.generate(model, '0.08', 5, priority=scheduler.RECOMMENDATION)
+    assert hedges(client) == 0
+
+    # A follow-up slower than its class, though quicker than any recommendation, is hedged
+    client.generate(model, '0.05', 5, priority=scheduler.INTERACTIVE)
+    assert hedges(client) == 1
+
+    delays = client.stats()['hedge_delay']
+    assert delays[(model.model_name, scheduler.INTERACTIVE, 'blocking')] < 0.05
+    assert delays[(model.model_name, scheduler.RECOMMENDATION, 'blocking')] >= 0.08
@@ -0,0 +1,137 @@
+import json
+import logging
+import threading
+
+from cachetools import TTLCache
+
+# Structured usage log: one JSON object per LLM call
+logger = logging.getLogger('token_usage')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+USAGE_FIELDS = ('calls', 'prompt_tokens', 'output_tokens', 'total_tokens',
+                'estimated_prompt_tokens', 'cost_usd')
+
+
+def parse_prices(spec):
+    """Parse per-model prices such as 'gemini-1.5-pro=1.25/5.00,gemini-1.5-flash=0.075/0.30'
+
+    Prices are USD per million prompt/output tokens.
+    """
+    prices = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        model_name, _, pair = item.partition('=')
+        prompt_price, _, output_price = pair.partition('/')
+        prices[model_name.strip()] = (float(prompt_price), float(output_price or prompt_price))
+    return prices
+
+
+def usage_counts(usage_metadata):
+    """Return (prompt, output, total) tokens from a response's usage_metadata"""
+    if usage_metadata is None:
+        return 0, 0, 0
+    prompt = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+    output = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    total = getattr(usage_metadata, 'total_token_count', 0) or prompt + output
+    return prompt, output, total
+
+
+class TokenLedger:
+    """Per-worker token and cost totals by endpoint, spec and session
+
+    Sessions are kept for session_ttl seconds after their last call, at most
+    max_sessions of them, so the ledger stays bounded like the session store.
+    Specs come from client-supplied form text, so they are bounded the same
+    way, at most max_specs of them.
+    """
+
+    def __init__(self, prices=None, max_sessions=10000, session_ttl=3600, max_specs=1000):
+        self.prices = prices or {}
+        self._lock = threading.Lock()
+        self._totals = self._empty()
+        self._by_endpoint = {}
+        self._by_spec = TTLCache(maxsize=max_specs, ttl=session_ttl)
+        self._by_model = {}
+        self._by_session = TTLCache(maxsize=max_sessions, ttl=session_ttl)
+
+    @staticmethod
+    def _empty():
+        return dict.fromkeys(USAGE_FIELDS, 0)
+
+    def cost(self, model_name, prompt_tokens, output_tokens):
+        """USD cost of a call, or 0 for models without a configured price"""
+        prompt_price, output_price = self.prices.get(model_name, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + output_tokens * output_price) / 1_000_000
+
+    def record(self, model_name, usage_metadata, endpoint, session_id=None,
+               product_category=None, language=None, estimated_prompt_tokens=None):
+        """Add one call's usage to every aggregate and log it"""
+        prompt, output, total = usage_counts(usage_metadata)
+        entry = {
+            'calls': 1,
+            'prompt_tokens': prompt,
+            'output_tokens': output,
+            'total_tokens': total,
+            'estimated_prompt_tokens': estimated_prompt_tokens or 0,
+            'cost_usd': self.cost(model_name, prompt, output),
+        }
+        spec = f"{product_category or 'unknown'}|{language or 'unknown'}"
+        with self._lock:
+            targets = [
+                self._totals,
+                self._by_endpoint.setdefault(endpoint, self._empty()),
+                self._by_model.setdefault(model_name, self._empty()),
+            ]
+            spec_usage = self._by_spec.get(spec) or self._empty()
+            # Re-assign so the spec's TTL restarts on every call
+            self._by_spec[spec] = spec_usage
+            targets.append(spec_usage)
+            if session_id:
+                session = self._by_session.get(session_id) or self._empty()
+                # Re-assign so the session's TTL restarts on every call
+                self._by_session[session_id] = session
+                targets.append(session)
+            for target in targets:
+                for field, value in entry.items():
+                    target[field] += value
+
+        logger.info(json.dumps({
+            'event': 'token_usage',
+            'model': model_name,
+            'endpoint': endpoint,
+            'session_id': session_id,
+            'product_category': product_category,
+            'language': language,
+            **entry,
+        }, ensure_ascii=False))
+        return entry
+
+    def session(self, session_id):
+        """Totals for one session, or None if it has no recorded calls"""
+        with self._lock:
+            usage = self._by_session.get(session_id)
+            return dict(usage) if usage else None
+
+    def top_sessions(self, limit=20):
+        """Sessions with the highest total token use"""
+        with self._lock:
+            sessions = [(key, dict(value)) for key, value in self._by_session.items()]
+        sessions.sort(key=lambda item: item[1]['total_tokens'], reverse=True)
+        return [{'session_id': key, **usage} for key, usage in sessions[:limit]]
+
+    def stats(self, top=20):
+        """Return totals by endpoint, spec (product_category|language), model and top sessions"""
+        with self._lock:
+            data = {
+                'totals': dict(self._totals),
+                'by_endpoint': {key: dict(value) for key, value in self._by_endpoint.items()},
+                'by_spec': {key: dict(value) for key, value in self._by_spec.items()},
+                'by_model': {key: dict(value) for key, value in self._by_model.items()},
+                'sessions_tracked': len(self._by_session),
+            }
+        data['top_sessions'] = self.top_sessions(top)
+        return data
@@ -0,0 +1,29 @@
+import json
+import threading
+import time
+
+
+class TrafficLog:
+    """Append-only JSON-lines log of LLM endpoint requests for load-test replay
+
+    Each line holds the request path, its form fields, the response status and
+    the session ID a recommendation created, so benchmarks/loadtest.py can map
+    recorded follow-ups onto the sessions created during replay.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, path, form, status, created_session_id=None):
+        entry = {
+            'ts': time.time(),
+            'path': path,
+            'form': form,
+            'status': status,
+            'created_session_id': created_session_id,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        # One write per line in append mode keeps lines from different workers intact
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
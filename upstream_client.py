@@ -0,0 +1,591 @@
+import asyncio
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from google.api_core import exceptions as api_exceptions
+
+import scheduler as priority_scheduler
+
+# Upstream error classes worth retrying, keyed by the exception types that signal them
+RETRYABLE_ERRORS = (
+    ('429', api_exceptions.TooManyRequests),
+    ('503', api_exceptions.ServiceUnavailable),
+    ('deadline', api_exceptions.GatewayTimeout),
+)
+
+# Breaker states, exported as a gauge value
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+STATE_NAMES = {CLOSED: 'closed', HALF_OPEN: 'half_open', OPEN: 'open'}
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while the circuit breaker is open"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Upstream unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def classify(error):
+    """Return the retryable class of an upstream error ('429', '503', 'deadline') or None"""
+    for name, types in RETRYABLE_ERRORS:
+        if isinstance(error, types):
+            return name
+    return None
+
+
+def retry_after(error):
+    """Seconds the upstream asked us to wait (RetryInfo detail or Retry-After header), or None"""
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryBudget:
+    """Token bucket capping retries at a fraction of calls plus a small steady allowance
+
+    Each call deposits ratio tokens, min_per_sec tokens accrue every second
+    and each retry withdraws one, so a struggling upstream sees at most
+    about (1 + ratio) times its normal load from us.
+    """
+
+    def __init__(self, ratio=0.1, min_per_sec=1.0, max_tokens=10.0):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_sec)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Take one retry token; False if the budget is spent"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def available(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures, then lets one probe through after a cool-down"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go upstream now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == OPEN and remaining <= 0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(max(remaining, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def record_neutral(self):
+        """End a call that says nothing about upstream health (e.g. a safety block)"""
+        with self._lock:
+            self._probing = False
+
+
+class LatencyTracker:
+    """Sliding window of recent latencies for percentile estimates"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q, min_samples=1):
+        """The q-quantile of the window, or None with fewer than min_samples"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class HedgePolicy:
+    """When to start a second attempt for a call that has not produced its first token
+
+    The delay follows the observed quantile of the first attempt's
+    time-to-first-token for streams (or of its whole call for blocking
+    calls), sampled whether or not a hedge beat it. It is tracked per
+    model and priority class, since a short follow-up and a long
+    recommendation on the same model have nothing in common.
+    It falls back to initial_delay until min_samples calls have been seen.
+    The budget caps hedges at a fraction of calls.
+    """
+
+    def __init__(self, quantile=0.9, initial_delay=2.0, min_delay=0.05, min_samples=20, budget=None):
+        self.quantile = quantile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget = budget or RetryBudget(ratio=0.05, min_per_sec=0.1, max_tokens=5.0)
+        self.trackers = {}
+        self._lock = threading.Lock()
+
+    def _tracker(self, model_name, priority, stream):
+        with self._lock:
+            return self.trackers.setdefault((model_name, priority, stream), LatencyTracker())
+
+    def delay(self, model_name, priority, stream):
+        observed = self._tracker(model_name, priority, stream).percentile(self.quantile, self.min_samples)
+        return self.initial_delay if observed is None else max(self.min_delay, observed)
+
+    def observe(self, model_name, priority, stream, seconds):
+        self._tracker(model_name, priority, stream).observe(seconds)
+
+    def delays(self):
+        """Current delay per (model name, priority class, 'stream' or 'blocking')"""
+        with self._lock:
+            keys = list(self.trackers)
+        return {
+            (model_name, priority, 'stream' if stream else 'blocking'): self.delay(model_name, priority, stream)
+            for model_name, priority, stream in keys
+        }
+
+
+class FirstChunkStream:
+    """A stream whose first chunk was already pulled while retries were still possible"""
+
+    def __init__(self, response, iterator, first):
+        self.response = response
+        self._iterator = iterator
+        self._first = first
+        self._on_close = None
+
+    @property
+    def usage_metadata(self):
+        return self.response.usage_metadata
+
+    def __iter__(self):
+        try:
+            if self._first is not None:
+                yield self._first
+            yield from self._iterator
+        finally:
+            self._close()
+
+    def on_close(self, callback):
+        """Call callback once the stream is exhausted, abandoned or cancelled"""
+        self._on_close = callback
+
+    def _close(self):
+        callback, self._on_close = self._on_close, None
+        if callback:
+            callback()
+
+    def cancel(self):
+        """Stop consuming the stream; the library cancels the RPC once it is released"""
+        self._close()
+        close = getattr(self._iterator, 'close', None)
+        if close:
+            close()
+        cancel = getattr(self.response, 'cancel', None)
+        if cancel:
+            cancel()
+
+
+class AsyncFirstChunkStream(FirstChunkStream):
+    """A FirstChunkStream of an async response, consumed with async for"""
+
+    async def __aiter__(self):
+        try:
+            if self._first is not None:
+                yield self._first
+            async for chunk in self._iterator:
+                yield chunk
+        finally:
+            self._close()
+
+    async def acancel(self):
+        """Stop consuming the stream and close the response's iterator"""
+        self._close()
+        aclose = getattr(self._iterator, 'aclose', None)
+        if aclose:
+            await aclose()
+        cancel = getattr(self.response, 'cancel', None)
+        if cancel:
+            cancel()
+
+
+class UpstreamClient:
+    """Calls a model handle under a deadline with classified retries and a circuit breaker
+
+    Only 429, 503 and deadline errors are retried, with full-jitter
+    exponential backoff (or the upstream's retry-after hint) while the
+    deadline and the retry budget allow. A streamed call is only retried
+    until its first chunk arrives; after that errors reach the caller.
+
+    With a HedgePolicy, an attempt that has no first token within the
+    policy's delay is raced by a second one. The first to answer wins; the
+    other is cancelled (streams) or its result discarded (blocking calls).
+
+    With a PriorityScheduler, each attempt first waits (within the
+    deadline) for a slot of its priority class; a stream keeps its slot
+    until it is exhausted or cancelled. Hedge attempts ride on the slot of
+    the attempt they race.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0,
+                 budget=None, breaker=None, hedge=None, scheduler=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+        self.retries = {}
+        self.failures = {}
+        self.rejected = 0
+        self.budget_exhausted = 0
+        self.hedges = {'won': 0, 'lost': 0, 'skipped': 0}
+        # Losing async attempts left to finish in the background (a beaten primary is still sampled)
+        self._lingering = set()
+
+    def generate(self, model, prompt, deadline, stream=False, priority=priority_scheduler.RECOMMENDATION):
+        """Generate content within deadline seconds, retrying transient upstream errors"""
+        expires = time.monotonic() + deadline
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            slot = self._start_attempt(priority, expires)
+            try:
+                remaining = self._time_left(expires)
+                if self.hedge:
+                    result = self._hedged_attempt(model, prompt, remaining, stream, priority)
+                else:
+                    result = self._attempt(model, prompt, remaining, stream)
+            except Exception as e:
+                if slot:
+                    slot.release()
+                delay = self._after_failure(e, attempt, expires)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            if slot and stream:
+                result.on_close(slot.release)
+            elif slot:
+                slot.release()
+            self.breaker.record_success()
+            return result
+
+    async def agenerate(self, model, prompt, deadline, stream=False, priority=priority_scheduler.RECOMMENDATION):
+        """Async generate: the same deadline, retries, breaker and hedging; streams are async iterables"""
+        expires = time.monotonic() + deadline
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            slot = await self._start_attempt_async(priority, expires)
+            try:
+                remaining = self._time_left(expires)
+                if self.hedge:
+                    result = await self._hedged_attempt_async(model, prompt, remaining, stream, priority)
+                else:
+                    result = await self._attempt_async(model, prompt, remaining, stream)
+            except BaseException as e:
+                if slot:
+                    slot.release()
+                if not isinstance(e, Exception):
+                    raise
+                delay = self._after_failure(e, attempt, expires)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            if slot and stream:
+                result.on_close(slot.release)
+            elif slot:
+                slot.release()
+            self.breaker.record_success()
+            return result
+
+    def _start_attempt(self, priority, expires):
+        """Wait for a scheduler slot within the deadline, then pass the breaker; returns the slot"""
+        slot = None
+        if self.scheduler:
+            try:
+                slot = self.scheduler.acquire(priority, self._time_left(expires))
+            except priority_scheduler.SlotTimeout:
+                raise api_exceptions.DeadlineExceeded("Upstream deadline exceeded waiting for a slot") from None
+        return self._pass_breaker(slot)
+
+    async def _start_attempt_async(self, priority, expires):
+        slot = None
+        if self.scheduler:
+            try:
+                slot = await self.scheduler.aacquire(priority, self._time_left(expires))
+            except priority_scheduler.SlotTimeout:
+                raise api_exceptions.DeadlineExceeded("Upstream deadline exceeded waiting for a slot") from None
+        return self._pass_breaker(slot)
+
+    def _pass_breaker(self, slot):
+        try:
+            self._before_attempt()
+        except CircuitOpenError:
+            if slot:
+                slot.release()
+            raise
+        return slot
+
+    def _before_attempt(self):
+        """Let an attempt through the circuit breaker, counting fast-fail rejections"""
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+    @staticmethod
+    def _time_left(expires):
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise api_exceptions.DeadlineExceeded("Upstream deadline exceeded before the call")
+        return remaining
+
+    def _after_failure(self, error, attempt, expires):
+        """Record a failed attempt; return the backoff before retrying, or None to give up"""
+        error_class = classify(error)
+        if error_class is None:
+            self.breaker.record_neutral()
+            return None
+        self.breaker.record_failure()
+        with self._lock:
+            self.failures[error_class] = self.failures.get(error_class, 0) + 1
+        delay = self._backoff(attempt, error)
+        if attempt >= self.max_attempts or time.monotonic() + delay >= expires:
+            return None
+        if not self.budget.withdraw():
+            with self._lock:
+                self.budget_exhausted += 1
+            return None
+        with self._lock:
+            self.retries[error_class] = self.retries.get(error_class, 0) + 1
+        return delay
+
+    def _attempt(self, model, prompt, timeout, stream):
+        # The client library must not retry on its own underneath us
+        request_options = {'timeout': timeout, 'retry': None}
+        if not stream:
+            return model.generate_content(prompt, request_options=request_options)
+        response = model.generate_content(prompt, stream=True, request_options=request_options)
+        iterator = iter(response)
+        first = next(iterator, None)
+        return FirstChunkStream(response, iterator, first)
+
+    def _hedged_attempt(self, model, prompt, timeout, stream, priority=priority_scheduler.RECOMMENDATION):
+        """Run an attempt, racing a second one against it if its first token is late"""
+        results = queue.Queue()
+        started = time.monotonic()
+        model_name = getattr(model, 'model_name', None)
+        self.hedge.budget.deposit()
+
+        def run(index):
+            try:
+                result, error = self._attempt(model, prompt, timeout, stream), None
+            except Exception as e:
+                result, error = None, e
+            if index == 0 and error is None:
+                # Sample the primary whether it wins or loses: the winner alone is the
+                # faster of two draws, and would drag the hedge delay ever lower
+                self.hedge.observe(model_name, priority, stream, time.monotonic() - started)
+            results.put((index, result, error))
+
+        threading.Thread(target=run, args=(0,), daemon=True).start()
+        attempts = 1
+        try:
+            outcome = results.get(timeout=self.hedge.delay(model_name, priority, stream))
+        except queue.Empty:
+            if self.hedge.budget.withdraw():
+                threading.Thread(target=run, args=(1,), daemon=True).start()
+                attempts = 2
+            else:
+                with self._lock:
+                    self.hedges['skipped'] += 1
+            outcome = results.get()
+        finished = 1
+        if outcome[2] is not None and finished < attempts:
+            # The other attempt may still succeed
+            outcome = results.get()
+            finished += 1
+        if finished < attempts:
+            threading.Thread(target=self._cancel_late, args=(results,), daemon=True).start()
+
+        index, result, error = outcome
+        if attempts == 2:
+            with self._lock:
+                self.hedges['won' if index == 1 and error is None else 'lost'] += 1
+        if error is not None:
+            raise error
+        return result
+
+    @staticmethod
+    def _cancel_late(results):
+        """Cancel the losing attempt of a hedged call once it answers"""
+        _, result, _ = results.get()
+        cancel = getattr(result, 'cancel', None)
+        if cancel:
+            cancel()
+
+    @staticmethod
+    async def _attempt_async(model, prompt, timeout, stream=False):
+        request_options = {'timeout': timeout, 'retry': None}
+
+        async def first_chunk():
+            response = await model.generate_content_async(prompt, stream=True, request_options=request_options)
+            iterator = response.__aiter__()
+            first = await anext(iterator, None)
+            return AsyncFirstChunkStream(response, iterator, first)
+
+        call = first_chunk() if stream else model.generate_content_async(prompt, request_options=request_options)
+        try:
+            return await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError:
+            raise api_exceptions.DeadlineExceeded("Upstream deadline exceeded") from None
+
+    async def _hedged_attempt_async(self, model, prompt, timeout, stream=False,
+                                    priority=priority_scheduler.RECOMMENDATION):
+        """Async hedging: race a second task if the first is late, cancelling the loser"""
+        started = time.monotonic()
+        model_name = getattr(model, 'model_name', None)
+        self.hedge.budget.deposit()
+
+        async def primary():
+            result = await self._attempt_async(model, prompt, timeout, stream)
+            # Sampled whether it wins or loses, as in _hedged_attempt
+            self.hedge.observe(model_name, priority, stream, time.monotonic() - started)
+            return result
+
+        tasks = [asyncio.ensure_future(primary())]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge.delay(model_name, priority, stream))
+            if not done:
+                if self.hedge.budget.withdraw():
+                    tasks.append(asyncio.ensure_future(self._attempt_async(model, prompt, timeout, stream)))
+                else:
+                    with self._lock:
+                        self.hedges['skipped'] += 1
+            error, pending = None, set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if task.done() or (task is tasks[0] and winner is not None):
+                    # A beaten primary runs out (within its timeout) so it is sampled
+                    self._linger(task)
+                else:
+                    task.cancel()
+
+        if len(tasks) == 2:
+            with self._lock:
+                self.hedges['won' if winner is tasks[1] else 'lost'] += 1
+        if winner is None:
+            raise error
+        return winner.result()
+
+    def _linger(self, task):
+        """Let a losing attempt finish in the background, then discard its result"""
+        async def discard():
+            try:
+                result = await task
+            except Exception:
+                return
+            acancel = getattr(result, 'acancel', None)
+            if acancel:
+                await acancel()
+
+        lingering = asyncio.ensure_future(discard())
+        self._lingering.add(lingering)
+        lingering.add_done_callback(self._lingering.discard)
+
+    def _backoff(self, attempt, error):
+        hint = retry_after(error)
+        if hint is not None:
+            return hint
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def stats(self):
+        """Return breaker state, retry budget, retry/failure/rejection and hedge counters"""
+        with self._lock:
+            return {
+                'breaker_state': STATE_NAMES[self.breaker.state],
+                'breaker_state_value': self.breaker.state,
+                'breaker_opened': self.breaker.opened,
+                'retry_budget_tokens': self.budget.available(),
+                'retries': dict(self.retries),
+                'failures': dict(self.failures),
+                'rejected': self.rejected,
+                'budget_exhausted': self.budget_exhausted,
+                'hedges': dict(self.hedges),
+                'hedge_delay': self.hedge.delays() if self.hedge else {},
+            }